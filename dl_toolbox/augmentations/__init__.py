@@ -6,6 +6,7 @@ from .histograms import HistEq
 from .mixup import Mixup, Mixup2
 from .cutmix import Cutmix, Cutmix2
 from .merge_label import MergeLabels
-from .normalizations import ImagenetNormalize
+from .normalizations import ImagenetNormalize, normalize_raw, normalize_raw_batch
 #from .getters import get_image_level_aug, get_batch_level_aug, image_level_aug
 from .crop import RandomCrop2
+from .batch import get_batch_transforms, d4_transform, d4_elements, BatchD4, BatchColor
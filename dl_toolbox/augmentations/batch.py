@@ -0,0 +1,204 @@
+"""
+Batch-level versions of the per-sample augmentations, applied on a whole
+(B,C,H,W) batch on its device, with parameters drawn independently for each
+sample. They are built from the same img_aug strings as get_transforms, and
+draw their parameters from the generator given, on the device of the batch,
+or from the global one.
+"""
+
+import torch
+
+from .utils import Compose, NoOp
+from .cutmix import Cutmix, Cutmix2
+from .geometric import Sharpness
+from .normalizations import ImagenetNormalize
+
+
+# D4 elements are encoded on 3 bits: 1 flips columns (hflip), 2 flips rows
+# (vflip), 4 swaps rows and columns, applied after the flips.
+d4_elements = {
+    'no': 0,
+    'hflip': 1,
+    'vflip': 2,
+    'rot180': 3,
+    'd1flip': 4,
+    'rot270': 5,
+    'rot90': 6,
+    'd2flip': 7
+}
+
+def d4_index(elements, height, width, device):
+    """
+    For each sample, flat indices in the source image of the pixels of the
+    transformed image. Elements with a transposition require square images.
+    """
+    transpose = (elements & 4).bool().view(-1, 1, 1)
+    if transpose.any() and height != width:
+        raise ValueError('Transposing D4 elements need square images')
+    rows = torch.arange(height, device=device).view(1, -1, 1)
+    cols = torch.arange(width, device=device).view(1, 1, -1)
+    rows = torch.where((elements & 2).bool().view(-1, 1, 1), height - 1 - rows, rows)
+    cols = torch.where((elements & 1).bool().view(-1, 1, 1), width - 1 - cols, cols)
+    rows, cols = torch.broadcast_tensors(rows, cols)
+    src_rows = torch.where(transpose, cols, rows)
+    src_cols = torch.where(transpose, rows, cols)
+
+    return (src_rows * width + src_cols).flatten(1)
+
+def d4_transform(x, elements, inverse=False):
+    """
+    Applies to each sample of x (B,...,H,W) its D4 element with one gather,
+    or the inverse transform with one scatter.
+    """
+    B, H, W = x.shape[0], x.shape[-2], x.shape[-1]
+    index = d4_index(elements.to(x.device), H, W, x.device)
+    flat = x.reshape(B, -1, H * W)
+    index = index.unsqueeze(1).expand_as(flat)
+    if inverse:
+        out = torch.empty_like(flat).scatter_(2, index, flat)
+    else:
+        out = flat.gather(2, index)
+
+    return out.view_as(x)
+
+def _draw(B, device, p, generator=None):
+
+    return torch.rand(B, device=device, generator=generator) < p
+
+def _factors(B, bounds, p, device, generator=None):
+
+    factors = torch.empty(B, device=device).uniform_(*bounds, generator=generator)
+    factors = torch.where(_draw(B, device, p, generator), factors, torch.ones_like(factors))
+
+    return factors.view(-1, 1, 1, 1)
+
+def _grayscale(img):
+
+    if img.shape[1] == 3:
+        r, g, b = img.unbind(dim=1)
+        return (0.2989 * r + 0.587 * g + 0.114 * b).unsqueeze(1)
+
+    return img.mean(dim=1, keepdim=True)
+
+def _blend(img1, img2, factors):
+
+    return (factors * img1 + (1 - factors) * img2).clamp_(0, 1)
+
+
+class BatchD4:
+
+    def __init__(self, elements=tuple(range(8)), p=1.):
+        self.elements = list(elements)
+        self.p = p
+
+    def __call__(self, img, label=None, generator=None):
+
+        B, device = img.shape[0], img.device
+        choice = torch.tensor(self.elements, device=device)
+        choice = choice[torch.randint(len(self.elements), (B,), device=device, generator=generator)]
+        elements = torch.where(_draw(B, device, self.p, generator), choice, torch.zeros_like(choice))
+        img = d4_transform(img, elements)
+        if label is not None and label.dim() > 2:
+            label = d4_transform(label, elements)
+
+        return img, label
+
+class BatchBrightness:
+
+    def __init__(self, bound=0.2, p=0.5):
+        self.bounds = (1-bound, 1+bound)
+        self.p = p
+
+    def __call__(self, img, label=None, generator=None):
+
+        factors = _factors(img.shape[0], self.bounds, self.p, img.device, generator)
+        return (img * factors).clamp_(0, 1), label
+
+class BatchContrast:
+
+    def __init__(self, bound=0.4, p=0.5):
+        self.bounds = (1-bound, 1+bound)
+        self.p = p
+
+    def __call__(self, img, label=None, generator=None):
+
+        factors = _factors(img.shape[0], self.bounds, self.p, img.device, generator)
+        mean = _grayscale(img).mean(dim=(-3, -2, -1), keepdim=True)
+        return _blend(img, mean, factors), label
+
+class BatchSaturation:
+
+    def __init__(self, bound=0.5, p=0.5):
+        self.bounds = (1-bound, 1+bound)
+        self.p = p
+
+    def __call__(self, img, label=None, generator=None):
+
+        factors = _factors(img.shape[0], self.bounds, self.p, img.device, generator)
+        return _blend(img, _grayscale(img), factors), label
+
+class BatchGamma:
+
+    def __init__(self, bound=0.5, p=2.5):
+        self.bounds = (1-bound, 1+bound)
+        self.p = p
+
+    def __call__(self, img, label=None, generator=None):
+
+        factors = _factors(img.shape[0], self.bounds, self.p, img.device, generator)
+        return img.clamp(min=0).pow(factors).clamp_(0, 1), label
+
+class BatchColor:
+
+    def __init__(self, bound=0.3):
+        self.color_aug = Compose(
+            [
+                BatchSaturation(p=1, bound=bound),
+                BatchContrast(p=1, bound=bound),
+                BatchGamma(p=1, bound=bound),
+                BatchBrightness(p=1, bound=bound)
+            ]
+        )
+
+    def __call__(self, img, label=None, generator=None):
+        return self.color_aug(img, label, generator=generator)
+
+batch_aug_dict = {
+    'no': NoOp,
+    'imagenet': ImagenetNormalize,
+    'd4': BatchD4,
+    'hflip': lambda: BatchD4([d4_elements['hflip']], p=0.5),
+    'vflip': lambda: BatchD4([d4_elements['vflip']], p=0.5),
+    'd1flip': lambda: BatchD4([d4_elements['d1flip']], p=0.5),
+    'd2flip': lambda: BatchD4([d4_elements['d2flip']], p=0.5),
+    'rot90': lambda: BatchD4([d4_elements['rot90']], p=0.5),
+    'rot180': lambda: BatchD4([d4_elements['rot180']], p=0.5),
+    'rot270': lambda: BatchD4([d4_elements['rot270']], p=0.5),
+    'saturation': BatchSaturation,
+    'contrast': BatchContrast,
+    'gamma': BatchGamma,
+    'brightness': BatchBrightness,
+    'color': BatchColor,
+    'cutmix': Cutmix,
+    # No per-sample version: one factor for the whole batch
+    'sharpness': Sharpness
+}
+
+def get_batch_transforms(name):
+
+    if name:
+        parts = name.split('_')
+        aug_list = []
+        for part in parts:
+            if part.startswith('color'):
+                bounds = part.split('-')[-1]
+                augment = BatchColor(bound=0.1*int(bounds))
+            elif part.startswith('cutmix2'):
+                alpha = part.split('-')[-1]
+                augment = Cutmix2(alpha=0.1*int(alpha))
+            else:
+                augment = batch_aug_dict[part]()
+            aug_list.append(augment)
+        return Compose(aug_list)
+    else:
+        return NoOp()
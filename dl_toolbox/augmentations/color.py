@@ -13,10 +13,10 @@ class Gamma(torch.nn.Module):
 
         return F.adjust_gamma(img, factor), label
 
-    def forward(self, img, label=None):
+    def forward(self, img, label=None, generator=None):
 
-        if torch.rand(1).item() < self.p:
-            factor = float(torch.empty(1).uniform_(self.bounds[0], self.bounds[1]))
+        if torch.rand(1, generator=generator).item() < self.p:
+            factor = float(torch.empty(1).uniform_(self.bounds[0], self.bounds[1], generator=generator))
             return self.apply(img, label, factor)
 
         return img, label
@@ -29,10 +29,10 @@ class Saturation(torch.nn.Module):
         self.bounds = (1-bound, 1+bound)
         self.p = p
 
-    def forward(self, img, label=None):
+    def forward(self, img, label=None, generator=None):
 
-        factor = float(torch.empty(1).uniform_(self.bounds[0], self.bounds[1]))
-        if torch.rand(1).item() < self.p:
+        factor = float(torch.empty(1).uniform_(self.bounds[0], self.bounds[1], generator=generator))
+        if torch.rand(1, generator=generator).item() < self.p:
             return F.adjust_saturation(img, factor), label
         return img, label
 
@@ -43,10 +43,10 @@ class Brightness(torch.nn.Module):
         self.bounds = (1-bound, 1+bound)
         self.p = p
 
-    def forward(self, img, label=None):
+    def forward(self, img, label=None, generator=None):
 
-        factor = float(torch.empty(1).uniform_(self.bounds[0], self.bounds[1]))
-        if torch.rand(1).item() < self.p:
+        factor = float(torch.empty(1).uniform_(self.bounds[0], self.bounds[1], generator=generator))
+        if torch.rand(1, generator=generator).item() < self.p:
             return F.adjust_brightness(img, factor), label
         return img, label
 
@@ -58,10 +58,10 @@ class Contrast(torch.nn.Module):
         self.bounds = (1-bound, 1+bound)
         self.p = p
 
-    def forward(self, img, label=None):
+    def forward(self, img, label=None, generator=None):
 
-        factor = float(torch.empty(1).uniform_(self.bounds[0], self.bounds[1]))
-        if torch.rand(1).item() < self.p:
+        factor = float(torch.empty(1).uniform_(self.bounds[0], self.bounds[1], generator=generator))
+        if torch.rand(1, generator=generator).item() < self.p:
             return F.adjust_contrast(img, factor), label
         return img, label
 
@@ -79,5 +79,5 @@ class Color():
             ]
         )
 
-    def __call__(self, image, label=None):
-        return self.color_aug(image, label)
+    def __call__(self, image, label=None, generator=None):
+        return self.color_aug(image, label, generator=generator)
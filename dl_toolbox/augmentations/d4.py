@@ -9,9 +9,9 @@ class Vflip(torch.nn.Module):
         super().__init__()
         self.p = p
 
-    def __call__(self, img, label=None):
+    def __call__(self, img, label=None, generator=None):
 
-        if torch.rand(1).item() < self.p:
+        if torch.rand(1, generator=generator).item() < self.p:
             img = F.vflip(img)
             if label is not None and label.dim()>2:
                 label = F.vflip(label)
@@ -25,9 +25,9 @@ class Hflip:
         super().__init__()
         self.p = p
 
-    def __call__(self, img, label=None):
+    def __call__(self, img, label=None, generator=None):
 
-        if torch.rand(1).item() < self.p:
+        if torch.rand(1, generator=generator).item() < self.p:
             img = F.hflip(img)
             if label is not None and label.dim()>2:
                 label = F.hflip(label)
@@ -41,9 +41,9 @@ class Transpose1(torch.nn.Module):
         super().__init__()
         self.p = p
 
-    def __call__(self, img, label=None):
+    def __call__(self, img, label=None, generator=None):
 
-        if torch.rand(1).item() < self.p:
+        if torch.rand(1, generator=generator).item() < self.p:
             img = torch.transpose(img, -2, -1)
             if label is not None and label.dim()>2: 
                 label = torch.transpose(label, -2, -1)
@@ -57,9 +57,9 @@ class Transpose2(torch.nn.Module):
         super().__init__()
         self.p = p
 
-    def __call__(self, img, label=None):
+    def __call__(self, img, label=None, generator=None):
 
-        if torch.rand(1).item() < self.p:
+        if torch.rand(1, generator=generator).item() < self.p:
             img = img.flip(-1)
             img = img.flip(-2)
             img = torch.transpose(img, -2, -1)
@@ -77,9 +77,9 @@ class Rot90:
         super().__init__()
         self.p = p
 
-    def __call__(self, img, label=None):
+    def __call__(self, img, label=None, generator=None):
 
-        if torch.rand(1).item() < self.p:
+        if torch.rand(1, generator=generator).item() < self.p:
             img = torch.transpose(F.hflip(img), -2, -1)
             if label is not None and label.dim()>2:
                 label = torch.transpose(F.hflip(label), -2, -1)
@@ -94,9 +94,9 @@ class Rot180:
         super().__init__()
         self.p = p
 
-    def __call__(self, img, label=None):
+    def __call__(self, img, label=None, generator=None):
 
-        if torch.rand(1).item() < self.p:
+        if torch.rand(1, generator=generator).item() < self.p:
             img = F.vflip(F.hflip(img))
             if label is not None and label.dim()>2:
                 label = F.vflip(F.hflip(label))
@@ -111,9 +111,9 @@ class Rot270:
         super().__init__()
         self.p = p
 
-    def __call__(self, img, label=None):
+    def __call__(self, img, label=None, generator=None):
 
-        if torch.rand(1).item() < self.p:
+        if torch.rand(1, generator=generator).item() < self.p:
             img = torch.transpose(F.vflip(img), -2, -1)
             if label is not None and label.dim()>2:
                 label = torch.transpose(F.vflip(label), -2, -1)
@@ -147,5 +147,5 @@ class D4:
             ]
         )
 
-    def __call__(self, img, label=None):
-        return self.d4(img, label)
\ No newline at end of file
+    def __call__(self, img, label=None, generator=None):
+        return self.d4(img, label, generator=generator)
\ No newline at end of file
@@ -8,9 +8,9 @@ class Sharpness(torch.nn.Module):
         self.bounds = bounds
         self.p = p
 
-    def forward(self, img, label=None):
+    def forward(self, img, label=None, generator=None):
 
-        factor = float(torch.empty(1).uniform_(self.bounds[0], self.bounds[1]))
-        if torch.rand(1).item() < self.p:
+        factor = float(torch.empty(1).uniform_(self.bounds[0], self.bounds[1], generator=generator))
+        if torch.rand(1, generator=generator).item() < self.p:
             return F.adjust_sharpness(img, factor), label
         return img, label
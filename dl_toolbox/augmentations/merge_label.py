@@ -1,21 +1 @@
-import numpy as np
-
-class MergeLabels:
-    def __init__(self, labels):
-
-        self.labels = labels
-
-    def __call__(self, L):
-        """
-        If self.labels is [[0,1,2],[3,4,5]], then all pixels in classes [0,1,2]
-        will be set to label 0 and all pixels in classes [3,4,5] will be set to
-        label 1.
-        :param L:
-        :return:
-        """
-        ret = np.zeros(L.shape, dtype=L.dtype)
-        for i, lab in enumerate(self.labels):
-            for j in lab:
-                ret[L == j] = i
-
-        return ret
\ No newline at end of file
+from dl_toolbox.utils.label_manipulation import MergeLabels
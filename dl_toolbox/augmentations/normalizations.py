@@ -1,9 +1,10 @@
+import torch
 import torchvision.transforms.functional as F
 
 
 class ImagenetNormalize:
 
-    def __call__(self, img, label=None):
+    def __call__(self, img, label=None, generator=None):
 
         img = F.normalize(
                 img,
@@ -12,3 +13,35 @@ class ImagenetNormalize:
                 )
         return img, label
 
+
+
+def normalize_raw(image, minmax, raw_dtype=None, imagenet=False):
+    """
+    Min-max scaling and clipping of a batch of raw images (B,C,H,W) with the
+    per-sample band bounds minmax (B,C,2), done on the device of the batch.
+    """
+    if raw_dtype == 'uint16':
+        image = image.to(torch.int32) & 0xFFFF
+    image = image.float()
+    m = minmax[..., 0, None, None].to(image.device)
+    M = minmax[..., 1, None, None].to(image.device)
+    image = ((image - m) / (M - m)).clamp_(0, 1)
+    if imagenet:
+        image, _ = ImagenetNormalize()(image)
+
+    return image
+
+def normalize_raw_batch(batch):
+    """
+    Normalizes in place the images of a batch collated from datasets in raw
+    transport mode, does nothing on other batches.
+    """
+    raw = batch.get('raw')
+    if not raw:
+        return batch
+    for key in ('image', 'orig_image'):
+        if batch.get(key) is not None:
+            batch[key] = normalize_raw(batch[key], batch['minmax'], raw['dtype'], raw['imagenet'])
+    batch['raw'] = None
+
+    return batch
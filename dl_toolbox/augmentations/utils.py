@@ -1,13 +1,20 @@
 import numpy as np
 import torch
 
+def apply(t, img, label=None, generator=None):
+
+    # The generator is only passed when given, to transforms that take one
+    if generator is None:
+        return t(img, label)
+    return t(img, label, generator=generator)
+
 class NoOp():
 
     def __init__(self):
 
         pass
 
-    def __call__(self, img, label=None):
+    def __call__(self, img, label=None, generator=None):
 
         return img, label
 
@@ -16,9 +23,11 @@ class Compose:
     def __init__(self, transforms):
         self.transforms = transforms
 
-    def __call__(self, img, label=None):
+    def __call__(self, img, label=None, generator=None):
+        # A torch.Generator, if given, draws the random parameters of the
+        # transforms instead of the global generators
         for t in self.transforms:
-            img, label = t(img, label)
+            img, label = apply(t, img, label, generator)
         return img, label
 
 
@@ -29,10 +38,13 @@ class OneOf:
         s = sum(transforms_ps)
         self.transforms_ps = [p / s for p in transforms_ps]
 
-    def __call__(self, img, label=None):
-        t = np.random.choice(self.transforms, p=self.transforms_ps)
-        img, label = t(img, label)
-        return img, label
+    def __call__(self, img, label=None, generator=None):
+        if generator is None:
+            t = np.random.choice(self.transforms, p=self.transforms_ps)
+        else:
+            ps = torch.tensor(self.transforms_ps)
+            t = self.transforms[int(torch.multinomial(ps, 1, generator=generator))]
+        return apply(t, img, label, generator)
 
 
 def rand_bbox(size, lam):
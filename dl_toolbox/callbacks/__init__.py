@@ -3,3 +3,4 @@ from .swa import CustomSwa
 from .confusion_matrix import ConfMatLogger, plot_confusion_matrix, compute_conf_mat
 from .calibration import CalibrationLogger, plot_calib, compute_calibration_bins
 from .class_distrib import ClassDistribLogger
+from .block_cache import BlockCacheLogger
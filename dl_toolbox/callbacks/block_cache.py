@@ -0,0 +1,16 @@
+import pytorch_lightning as pl
+
+
+class BlockCacheLogger(pl.Callback):
+    """
+    Logs the hit rate of the shared block cache of the datamodule, if any,
+    at the end of each training epoch.
+    """
+
+    def on_train_epoch_end(self, trainer, pl_module):
+
+        block_cache = getattr(trainer.datamodule, 'block_cache', None)
+        if block_cache is not None:
+            stats = block_cache.stats()
+            pl_module.log('block_cache_hit_rate', stats['hit_rate'])
+            pl_module.log('block_cache_used_slots', float(stats['used_slots']))
@@ -11,7 +11,8 @@ def display_batch(batch, visu_fn):
     nb_col = 8
 
     img = batch['image'].cpu()
-    orig_img = batch['orig_image'].cpu()
+    # orig_image is only collated on some batches
+    orig_img = batch['orig_image'].cpu() if batch.get('orig_image') is not None else None
     #preds = batch['preds'].cpu()
 
     #preds_rgb = visu_fn(preds).transpose((0,3,1,2))
@@ -36,9 +37,11 @@ def display_batch(batch, visu_fn):
             end = start + remainder
 
         img_grid = torchvision.utils.make_grid(img[start:end, :, :, :], padding=10, normalize=True)
-        orig_img_grid = torchvision.utils.make_grid(orig_img[start:end, :, :, :], padding=10, normalize=True)
         #out_grid = torchvision.utils.make_grid(np_preds_rgb[start:end, :, :, :], padding=10, normalize=True)
-        grids = [orig_img_grid, img_grid]
+        grids = [img_grid]
+        if orig_img is not None:
+            orig_img_grid = torchvision.utils.make_grid(orig_img[start:end, :, :, :], padding=10, normalize=True)
+            grids.insert(0, orig_img_grid)
 
         #if batch['mask'] is not None:
         #    mask_grid = torchvision.utils.make_grid(np_labels_rgb[start:end, :, :, :], padding=10, normalize=True)
@@ -93,7 +96,7 @@ class SegmentationImagesVisualisation(pl.Callback):
     def display_batch(self, trainer, batch, prefix):
 
         img = batch['image'].cpu()
-        orig_img = batch['orig_image'].cpu()
+        orig_img = batch['orig_image'].cpu() if batch.get('orig_image') is not None else None
         preds = batch['preds'].cpu()
 
         preds_rgb = self.visu_fn(preds).transpose((0,3,1,2))
@@ -117,9 +120,11 @@ class SegmentationImagesVisualisation(pl.Callback):
                 end = start + remainder
 
             img_grid = torchvision.utils.make_grid(img[start:end, :, :, :], padding=10, normalize=True)
-            orig_img_grid = torchvision.utils.make_grid(orig_img[start:end, :, :, :], padding=10, normalize=True)
             out_grid = torchvision.utils.make_grid(np_preds_rgb[start:end, :, :, :], padding=10, normalize=True)
-            grids = [orig_img_grid, img_grid, out_grid]
+            grids = [img_grid, out_grid]
+            if orig_img is not None:
+                orig_img_grid = torchvision.utils.make_grid(orig_img[start:end, :, :, :], padding=10, normalize=True)
+                grids.insert(0, orig_img_grid)
 
             if batch['mask'] is not None:
                 mask_grid = torchvision.utils.make_grid(np_labels_rgb[start:end, :, :, :], padding=10, normalize=True)
@@ -1 +1,5 @@
 from .utils import *
+from .streaming import stream_probas, StripAccumulator
+from .blending import crop_weights, blend
+from .tta import tta_probas, tta_variants
+from .precision import inference_context, prepare_module, precisions
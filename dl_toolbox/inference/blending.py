@@ -0,0 +1,45 @@
+import torch
+
+
+def crop_weights(crop_size, mode='uniform', sigma=0.25, device=None):
+    """
+    (crop_size, crop_size) weights of the pixels of a crop when averaging
+    overlapping crops: 'uniform', 'edge' (distance to the crop edge) or
+    'gaussian' (of std sigma * crop_size around the crop center).
+    """
+    pos = torch.arange(crop_size, dtype=torch.float32, device=device)
+    if mode == 'uniform':
+        return torch.ones(crop_size, crop_size, device=device)
+    if mode == 'edge':
+        dist = torch.minimum(pos + 1, crop_size - pos)
+        return torch.minimum(dist[:, None], dist[None, :])
+    if mode == 'gaussian':
+        g = torch.exp(-0.5 * ((pos - (crop_size - 1) / 2) / (sigma * crop_size)) ** 2)
+        return g[:, None] * g[None, :]
+    raise ValueError(f'Unknown blending mode {mode}')
+
+def blend(pred_sum, weight_sum, probas, windows, weights):
+    """
+    Adds the (B, C, h, w) probas of crops weighted by (h, w) weights into
+    (C, H, W) pred_sum, and the weights into (H, W) weight_sum, with one
+    index_add_ per buffer on their device. windows are the (B, 4) (col, row,
+    width, height) of the crops in the buffers; all crops have the same size.
+    """
+    B, C, h, w = probas.shape
+    W = pred_sum.shape[-1]
+    windows = windows.to(pred_sum.device, torch.long)
+    rows = windows[:, 1, None] + torch.arange(h, device=pred_sum.device)
+    cols = windows[:, 0, None] + torch.arange(w, device=pred_sum.device)
+    index = (rows[:, :, None] * W + cols[:, None, :]).reshape(-1)
+    weights = weights[:h, :w].to(pred_sum.device)
+    weighted = (probas.to(pred_sum.dtype) * weights).permute(1, 0, 2, 3).reshape(C, -1)
+    pred_sum.view(C, -1).index_add_(1, index, weighted)
+    weight_sum.view(-1).index_add_(0, index, weights.expand(B, h, w).reshape(-1))
+
+def normalize(pred_sum, weight_sum, nodata=0.):
+
+    # Weighted average, nodata where no crop was added
+    valid = weight_sum > 0
+    probas = pred_sum / weight_sum.clamp(min=1e-8)
+
+    return probas.masked_fill_(~valid, nodata), valid
@@ -7,7 +7,10 @@ import dl_toolbox.inference as dl_inf
 from dl_toolbox.torch_datasets import *
 #from dl_toolbox.torch_datasets.utils import *
 from sklearn.metrics import confusion_matrix as confusion_matrix
-from dl_toolbox.utils import MergeLabels, OneHot
+from dl_toolbox.utils import MergeLabels, OneHot, load_valid_masks
+
+# Value of the float32 outputs where no crop was predicted
+NODATA = -1.
 
 datasets = {
     'semcity': SemcityBdsdDs,
@@ -45,6 +48,16 @@ def main():
     parser.add_argument("--encoder", type=str)
     parser.add_argument("--train_with_void", action='store_true')
     parser.add_argument("--eval_with_void", action='store_true')
+    parser.add_argument("--skip_invalid", action='store_true')
+    parser.add_argument("--valid_cell_size", type=int, default=32)
+    parser.add_argument("--merge", action='store_true')
+    parser.add_argument("--streaming", action='store_true')
+    parser.add_argument("--blending", type=str, choices=['uniform', 'edge', 'gaussian'])
+    parser.add_argument("--tta_chunk", type=int)
+    parser.add_argument("--precision", type=str, default='fp32', choices=['fp32', 'bf16', 'fp16'])
+    parser.add_argument("--channels_last", action='store_true')
+    parser.add_argument("--check_precision", type=int, default=0, help='batches compared to fp32')
+    parser.add_argument("--max_pred_change", type=float, default=0.005)
 
     args = parser.parse_args()
 
@@ -62,8 +75,7 @@ def main():
     )
 
     module.load_state_dict(ckpt['state_dict'])
-    module.eval()
-    module.to(device)
+    dl_inf.prepare_module(module, device, channels_last=args.channels_last)
 
     window = dl_inf.get_window(args.tile)
     dataset = datasets[args.dataset](
@@ -74,24 +86,87 @@ def main():
         crop_step=args.crop_step,
         img_aug='no'
     )
+    if args.skip_invalid:
+        # Crops without valid pixels are not predicted
+        masks = load_valid_masks([args.image_path], cell_size=args.valid_cell_size)
+        dataset.set_valid_mask(masks[str(args.image_path)])
+
+    if args.check_precision and (args.precision != 'fp32' or args.channels_last):
+        # Fails before the whole tile is processed if predictions change
+        dl_inf.check_precision(
+            dataset=dataset,
+            module=module,
+            batch_size=args.batch_size,
+            device=device,
+            precision=args.precision,
+            channels_last=args.channels_last,
+            tta=args.tta,
+            num_batches=args.check_precision,
+            max_pred_change=args.max_pred_change
+        )
+
+    MERGE_DIGI_TO_SEMCITY = [[0, 9], [1, 2], [3, 10], [4], [5], [6, 7, 8]]
+
+    def merge_preds(preds):
+
+        # Adding 1 to prediction when the void class has been ignored
+        return MergeLabels(MERGE_DIGI_TO_SEMCITY)(preds + int(not args.train_with_void))
+
+    def preds_to_rgb(preds):
+
+        # (3, H, W) colors of the merged predictions, as in the non-streaming output
+        return np.moveaxis(dataset.labels_to_rgb(preds), -1, 0)
+
+    if args.streaming:
+        # Probas and prediction colors written strip by strip, without
+        # holding the tile in memory nor computing metrics
+        print('Streaming probas')
+        with rasterio.open(args.image_path) as f:
+            profile = f.profile
+        dl_inf.stream_probas(
+            dataset=dataset,
+            module=module,
+            batch_size=args.batch_size,
+            workers=args.workers,
+            tta=args.tta,
+            merge=args.merge,
+            blending=args.blending,
+            tta_chunk=args.tta_chunk,
+            precision=args.precision,
+            channels_last=args.channels_last,
+            device=device,
+            profile=profile,
+            output_probas=args.output_probas,
+            output_preds=args.output_preds,
+            nodata=NODATA,
+            preds_fn=lambda preds: preds_to_rgb(merge_preds(preds)),
+            preds_count=3,
+            preds_nodata=None
+        )
+        return
     
     print('Computing probas')
-    probas = dl_inf.compute_probas(
+    probas, valid = dl_inf.compute_probas(
         dataset=dataset,
         module=module,
         batch_size=args.batch_size,
         workers=args.workers,
         tta=args.tta,
-        mode='sigmoid'
+        merge=args.merge,
+        blending=args.blending,
+        tta_chunk=args.tta_chunk,
+        precision=args.precision,
+        channels_last=args.channels_last,
+        device=device,
+        nodata=NODATA,
+        return_valid=True
     )
+    # Pixels of no predicted crop are nodata in the outputs and left out of
+    # the metrics
+    valid = valid.numpy()
 
     # Adding batch dimension 1 to probas before extracting predictions
-    preds = np.argmax(np.expand_dims(probas, 0), 1)
-    # Adding 1 to prediction when the void class has been ignored
-    preds += int(not args.train_with_void)
-    
-    MERGE_DIGI_TO_SEMCITY = [[0, 9], [1, 2], [3, 10], [4], [5], [6, 7, 8]]
-    preds = MergeLabels(MERGE_DIGI_TO_SEMCITY)(preds)
+    preds = merge_preds(np.argmax(np.expand_dims(probas, 0), 1))
 
     initial_profile = rasterio.open(args.image_path).profile
 
@@ -101,18 +176,20 @@ def main():
             inputs=probas,
             tile=args.tile,
             output_path=args.output_probas,
-            profile=initial_profile
+            profile=initial_profile,
+            nodata=NODATA
         )
 
     if args.output_preds:
 
-        rgb = DigitanieToulouseDs.labels_to_rgb(preds)
-        
+        rgb = preds_to_rgb(np.squeeze(preds, 0)).astype(np.float32)
+        rgb[:, ~valid] = NODATA
         dl_inf.write_array(
-            inputs=np.squeeze(rgb).transpose((2,0,1)),
+            inputs=rgb,
             tile=args.tile,
             output_path=args.output_preds,
-            profile=initial_profile
+            profile=initial_profile,
+            nodata=NODATA
         )
 
 
@@ -123,8 +200,8 @@ def main():
         MERGE_SEMCITY = [[0,7], [3], [6], [2], [4], [1, 5]]
         labels = MergeLabels(MERGE_SEMCITY)(labels)
         cm = confusion_matrix(
-            labels.flatten(),
-            np.squeeze(preds).flatten(),
+            labels.flatten()[valid.flatten()],
+            np.squeeze(preds).flatten()[valid.flatten()],
             labels = np.arange(6)
         )
 
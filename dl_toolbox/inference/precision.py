@@ -0,0 +1,43 @@
+from contextlib import ExitStack, contextmanager
+
+import torch
+
+
+# Autocast dtype of each inference precision
+precisions = {
+    'fp32': None,
+    'bf16': torch.bfloat16,
+    'fp16': torch.float16
+}
+
+@contextmanager
+def inference_context(device, precision='fp32'):
+    """
+    torch.inference_mode, with autocast to the precision on the device type
+    unless fp32. fp16 autocast needs a CUDA device, bf16 is also supported
+    on CPUs, where it is fast with AVX512-BF16 or AMX.
+    """
+    if precision not in precisions:
+        raise ValueError(f'Unknown precision {precision}')
+    device_type = torch.device(device).type
+    if precision == 'fp16' and device_type != 'cuda':
+        raise ValueError('fp16 inference needs a CUDA device')
+    with ExitStack() as stack:
+        stack.enter_context(torch.inference_mode())
+        if precisions[precision] is not None:
+            stack.enter_context(torch.autocast(device_type=device_type, dtype=precisions[precision]))
+        yield
+
+def prepare_module(module, device, channels_last=False):
+
+    # Weights stay in fp32, autocast casting them per op
+    module.eval()
+    module.to(device)
+    if channels_last:
+        module.to(memory_format=torch.channels_last)
+
+    return module
+
+def to_memory_format(x, channels_last=False):
+
+    return x.contiguous(memory_format=torch.channels_last) if channels_last else x
@@ -0,0 +1,236 @@
+import numpy as np
+import rasterio
+import torch
+from rasterio.windows import Window
+from torch.utils.data import DataLoader
+
+import dl_toolbox.augmentations as aug
+from dl_toolbox.torch_collate import CustomCollate
+from dl_toolbox.utils import worker_init_function
+from .utils import get_window_transform
+from .tta import tta_probas
+from .blending import crop_weights, blend, normalize
+
+
+def tiled_profile(profile, tile, count, dtype, nodata, block=256):
+
+    # Tiled, compressed GeoTIFF covering the tile of the source raster
+    return {
+        'driver': 'GTiff',
+        'dtype': dtype,
+        'nodata': nodata,
+        'width': int(tile.width),
+        'height': int(tile.height),
+        'count': count,
+        'crs': profile['crs'],
+        'transform': get_window_transform(tile, profile),
+        'tiled': True,
+        'blockxsize': block,
+        'blockysize': block,
+        'compress': 'deflate',
+        'predictor': 3 if dtype == 'float32' else 2,
+        'BIGTIFF': 'IF_SAFER'
+    }
+
+
+class StripAccumulator:
+    """
+    Sums the weighted probas of the crops of a tile on the device, in a band
+    of rows twice as high as the crops and spanning the tile width. Crops
+    must come in row-major order of their offsets: rows above the row offset
+    of a crop then receive no more crop, and are moved to the host and
+    written out as a strip before the band moves down. Device memory is
+    bounded by num_classes x 2 crop heights x tile width, whatever the tile
+    height.
+
+    :param write: called with (first row in the tile, probas (C, n, W) with
+        nodata where no crop was added, (n, W) mask of the pixels of some
+        crop), on the host, for each finished strip.
+    """
+
+    def __init__(self, tile, num_classes, crop_height, write, nodata=0., device=None):
+
+        self.tile = tile
+        self.width = int(tile.width)
+        self.crop_height = crop_height
+        self.pred_sum = torch.zeros(num_classes, 2 * crop_height, self.width, device=device)
+        self.weight_sum = torch.zeros(2 * crop_height, self.width, device=device)
+        self.offset = torch.tensor([int(tile.col_off), int(tile.row_off), 0, 0])
+        self.write = write
+        self.nodata = nodata
+        # Tile row of the first row of the band
+        self.base = 0
+
+    def flush(self, until):
+
+        # Writes the rows of the tile up to until, moving the band down
+        height = self.weight_sum.shape[0]
+        while self.base < until:
+            n = min(until - self.base, height)
+            probas, valid = normalize(self.pred_sum[:, :n], self.weight_sum[:n], self.nodata)
+            self.write(self.base, probas.cpu(), valid.cpu())
+            self.pred_sum = torch.roll(self.pred_sum, -n, dims=1)
+            self.weight_sum = torch.roll(self.weight_sum, -n, dims=0)
+            self.pred_sum[:, -n:] = 0
+            self.weight_sum[-n:] = 0
+            self.base += n
+
+    def add(self, probas, windows, weights):
+        """
+        Adds the (B, C, h, w) probas of crops with (B, 4) windows in the
+        source raster, in chunks whose rows fit in the band.
+        """
+        windows = windows - self.offset
+        rows = windows[:, 1].tolist()
+        start = 0
+        while start < len(rows):
+            end = start + 1
+            while end < len(rows) and rows[end] - rows[start] <= self.crop_height:
+                end += 1
+            self.flush(rows[start])
+            band_windows = windows[start:end].clone()
+            band_windows[:, 1] -= self.base
+            blend(self.pred_sum, self.weight_sum, probas[start:end], band_windows, weights)
+            start = end
+
+    def close(self):
+
+        self.flush(int(self.tile.height))
+
+
+class BlockRowWriter:
+    """
+    Buffers the strips of a StripAccumulator on the host and passes them on
+    to write in strips of a multiple of block rows, so that each block row
+    of a tiled GeoTIFF is written and compressed once; the remaining rows
+    are written by close().
+    """
+
+    def __init__(self, write, block):
+
+        self.write = write
+        self.block = block
+        self.strips = []
+        # Tile row of the first buffered row
+        self.base = 0
+
+    def __call__(self, row, probas, valid):
+
+        if not self.strips:
+            self.base = row
+        self.strips.append((probas, valid))
+        buffered = sum(v.shape[0] for _, v in self.strips)
+        n = buffered - (self.base + buffered) % self.block
+        if n > 0:
+            self.flush(n)
+
+    def flush(self, n=None):
+
+        if not self.strips:
+            return
+        probas = torch.cat([p for p, _ in self.strips], dim=1)
+        valid = torch.cat([v for _, v in self.strips], dim=0)
+        n = valid.shape[0] if n is None else n
+        self.write(self.base, probas[:, :n], valid[:n])
+        self.base += n
+        self.strips = [(probas[:, n:], valid[n:])] if n < valid.shape[0] else []
+
+    def close(self):
+
+        self.flush()
+
+
+def stream_probas(
+    dataset,
+    module,
+    batch_size,
+    workers,
+    tta,
+    merge,
+    device,
+    profile,
+    output_probas=None,
+    output_preds=None,
+    nodata=0.,
+    preds_nodata=255,
+    preds_fn=None,
+    preds_count=1,
+    blending=None,
+    tta_chunk=None,
+    precision='fp32',
+    channels_last=False,
+    block=256
+):
+    """
+    Sliding-window inference over the fixed crops of dataset, read in
+    row-major order, writing the averaged probas and/or their argmax to
+    tiled, compressed GeoTIFFs strip by strip, so that memory does not grow
+    with the tile size. profile is the one of the source raster.
+
+    :param preds_fn: maps the (n, W) class indices of a strip to the
+        (preds_count, n, W) uint8 values written to output_preds, e.g.
+        merged labels or their colors; the indices are written if None.
+    :param preds_nodata: value of output_preds where no crop was predicted;
+        if None, those pixels are masked by the mask band of the file, as
+        for colours, which may take any value.
+    """
+    windows = dataset.crop_windows
+    order = np.lexsort((windows[:, 0], windows[:, 1]))
+    dataloader = DataLoader(
+        dataset=dataset,
+        sampler=order.tolist(),
+        collate_fn=CustomCollate(),
+        batch_size=batch_size,
+        num_workers=workers,
+        pin_memory=True,
+        worker_init_fn=worker_init_function
+    )
+    if getattr(dataset, 'skipped', 0.):
+        print(f'Skipping {100 * dataset.skipped:.1f}% of crops without valid pixels')
+
+    num_classes = module.out_channels
+    tile = dataset.tile
+    outputs = {}
+    if output_probas:
+        outputs['probas'] = rasterio.open(
+            output_probas, 'w', **tiled_profile(profile, tile, num_classes, 'float32', nodata, block)
+        )
+    if output_preds:
+        outputs['preds'] = rasterio.open(
+            output_preds, 'w', **tiled_profile(profile, tile, preds_count, 'uint8', preds_nodata, block)
+        )
+
+    def write(row, probas, valid):
+
+        window = Window(0, row, probas.shape[2], probas.shape[1])
+        if 'probas' in outputs:
+            outputs['probas'].write(probas.numpy().astype(np.float32), window=window)
+        if 'preds' in outputs:
+            preds = probas.argmax(dim=0).numpy()
+            preds = preds_fn(preds) if preds_fn is not None else preds[None]
+            preds = preds.astype(np.uint8)
+            if preds_nodata is not None:
+                preds[:, ~valid.numpy()] = preds_nodata
+            outputs['preds'].write(preds, window=window)
+            if preds_nodata is None:
+                outputs['preds'].write_mask(valid.numpy().astype(np.uint8) * 255, window=window)
+
+    # Strips are written by block rows of the outputs
+    writer = BlockRowWriter(write, block)
+    crop_height = int(windows[:, 3].max()) if len(windows) else 1
+    accumulator = StripAccumulator(tile, num_classes, crop_height, writer, nodata, device)
+    weights = crop_weights(dataset.crop_size, blending or ('edge' if merge else 'uniform'), device=device)
+
+    try:
+        for batch in dataloader:
+            if batch.get('raw'):
+                batch['image'] = batch['image'].to(device)
+                batch = aug.normalize_raw_batch(batch)
+            inputs = batch['image']
+            probas = tta_probas(inputs, module, device, tta, tta_chunk, precision, channels_last)
+            accumulator.add(probas, batch['window'], weights)
+        accumulator.close()
+        writer.close()
+    finally:
+        for output in outputs.values():
+            output.close()
@@ -0,0 +1,54 @@
+import torch
+
+from dl_toolbox.augmentations import d4_transform, d4_elements
+from dl_toolbox.torch_datasets.utils import aug_dict
+from .precision import inference_context, to_memory_format
+
+
+def tta_variants(tta):
+    """
+    D4 elements of the variants of a batch for the tta names, the identity
+    first; 'd4' stands for the 8 elements. Other names of aug_dict (e.g.
+    color) are returned apart, as they are not inverted.
+    """
+    elements, others = [0], []
+    for name in tta:
+        if name == 'd4':
+            elements += list(d4_elements.values())
+        elif name in d4_elements:
+            elements.append(d4_elements[name])
+        elif name in aug_dict:
+            others.append(name)
+        else:
+            raise ValueError(f'Unknown TTA {name}')
+
+    return list(dict.fromkeys(elements)), others
+
+def tta_probas(inputs, module, device, tta=(), chunk_size=None, precision='fp32', channels_last=False):
+    """
+    Probas of a (B,C,H,W) batch averaged over its TTA variants: all variants
+    are stacked on the device and run through one forward, in chunks of
+    chunk_size samples if given, then the outputs are brought back with the
+    inverse D4 transforms, one scatter for all, and averaged. The forward
+    runs in the precision and memory format given (inference.precision),
+    probas are returned in fp32.
+    """
+    x = inputs.to(device)
+    B = x.shape[0]
+    elements, others = tta_variants(tta)
+    elements = torch.tensor(elements, device=device)
+    V = len(elements)
+
+    with inference_context(device, precision):
+        stacked = d4_transform(x.repeat(V, 1, 1, 1), elements.repeat_interleave(B))
+        if others:
+            stacked = torch.cat([stacked] + [aug_dict[name](p=1)(x)[0] for name in others])
+            elements = torch.cat([elements, elements.new_zeros(len(others))])
+            V += len(others)
+        stacked = to_memory_format(stacked, channels_last)
+        chunks = stacked.split(chunk_size) if chunk_size else [stacked]
+        outputs = torch.cat([module.forward(c) for c in chunks]).float()
+        probas = module._compute_probas(outputs).float().contiguous()
+        probas = d4_transform(probas, elements.repeat_interleave(B), inverse=True)
+
+        return probas.view(V, B, *probas.shape[1:]).mean(dim=0)
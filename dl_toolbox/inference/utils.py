@@ -13,7 +13,8 @@ import dl_toolbox.augmentations as aug
 import pandas as pd
 from sklearn.metrics._plot.confusion_matrix import ConfusionMatrixDisplay
 from dl_toolbox.torch_datasets.utils import *
-from functools import partial
+from .blending import crop_weights, blend, normalize
+from .tta import tta_probas
 
 anti_t_dict = {
     'hflip': 'hflip',
@@ -42,6 +43,12 @@ def get_window(tile):
 
     return window
 
+def get_crop_mask(crop_size, merge, device=None):
+
+    # Weights of the pixels of a crop when averaging overlapping crops: with
+    # merge, their distance to the crop edge
+    return crop_weights(crop_size, 'edge' if merge else 'uniform', device=device)
+
 def compute_probas(
     dataset,
     module,
@@ -49,13 +56,34 @@ def compute_probas(
     workers,
     tta,
     merge,
-    device
+    device,
+    nodata=0.,
+    blending=None,
+    tta_chunk=None,
+    precision='fp32',
+    channels_last=False,
+    return_valid=False
 ):
-    
+    """
+    Averages the probas of the fixed crops of dataset over its tile, on the
+    device (see stream_probas for tiles too large for it). Pixels of no
+    crop, such as those of crops skipped for having no valid pixel
+    (RasterDs.set_valid_mask), are set to nodata; with return_valid, the
+    (H, W) mask of the other pixels is returned too.
+
+    :param blending: crop weights mode of inference.crop_weights, overrides
+        merge.
+    :param tta_chunk: samples per forward of the stacked TTA variants.
+    :param precision: fp32, bf16 or fp16 forward (inference.precision);
+        check_precision measures its effect on predictions.
+    """
+    if getattr(dataset, 'skipped', 0.):
+        print(f'Skipping {100 * dataset.skipped:.1f}% of crops without valid pixels')
+
     dataloader = DataLoader(
         dataset=dataset,
         shuffle=False,
-        collate_fn=CustomCollate(batch_aug='no'),
+        collate_fn=CustomCollate(),
         batch_size=batch_size,
         num_workers=workers,
         pin_memory=True,
@@ -63,67 +91,88 @@ def compute_probas(
     )
 
     num_classes = module.out_channels
-    pred_sum = torch.zeros(size=(num_classes, dataset.tile.height, dataset.tile.width))
-    mask_sum = torch.zeros(size=(dataset.tile.height, dataset.tile.width))
-    
-    if merge:
-        def dist_to_edge(i, j, h, w):
-
-            mi = np.minimum(i+1, h-i)
-            mj = np.minimum(j+1, w-j)
-            return np.minimum(mi, mj)
-
-        crop_mask = np.fromfunction(
-            function=partial(
-                dist_to_edge,
-                h=dataset.crop_size,
-                w=dataset.crop_size
-            ),
-            shape=(dataset.crop_size, dataset.crop_size),
-            dtype=int
-        )
-        crop_mask = torch.from_numpy(crop_mask).float()
-    else:
-        crop_mask = torch.ones(dataset.crop_size, dataset.crop_size)
+    # Accumulated on the inference device, all crops of a batch at once
+    pred_sum = torch.zeros(num_classes, dataset.tile.height, dataset.tile.width, device=device)
+    weight_sum = torch.zeros(dataset.tile.height, dataset.tile.width, device=device)
+    weights = crop_weights(dataset.crop_size, blending or ('edge' if merge else 'uniform'), device=device)
+    tile_offset = torch.tensor([dataset.tile.col_off, dataset.tile.row_off, 0, 0])
 
     for i, batch in enumerate(dataloader):
         
         print('batch ', i)
-        inputs, labels, windows = batch['image'], batch['mask'], batch['window']
-
-        outputs = batch_forward(inputs, module, device)
-        window_list = windows[:]
+        # Raw transport batches are normalized on the inference device
+        if batch.get('raw'):
+            batch['image'] = batch['image'].to(device)
+            batch = aug.normalize_raw_batch(batch)
+        inputs, windows = batch['image'], batch['window'] - tile_offset
+
+        probas = tta_probas(inputs, module, device, tta, tta_chunk, precision, channels_last)
+        blend(pred_sum, weight_sum, probas, windows, weights)
+                
+    probas, valid = normalize(pred_sum, weight_sum, nodata)
+    if return_valid:
+        return probas.cpu(), valid.cpu()
 
-        for t in tta:
+    return probas.cpu()
 
-            outputs_tta = batch_forward(inputs, module, device, t)
-            outputs = torch.vstack([outputs, outputs_tta])
-            window_list += windows[:]
-            
-        probas = module._compute_probas(outputs)
-        probas_list = [torch.squeeze(e, dim=0) for e in torch.split(probas, 1, dim=0)]
-        
-        for prob, w in zip(probas_list, window_list):
-            pred_sum[
-                :, 
-                w.row_off-dataset.tile.row_off:w.row_off-dataset.tile.row_off+w.height,
-                w.col_off-dataset.tile.col_off:w.col_off-dataset.tile.col_off+w.width
-            ] += prob * crop_mask
-            mask_sum[
-                w.row_off-dataset.tile.row_off:w.row_off-dataset.tile.row_off+w.height,
-                w.col_off-dataset.tile.col_off:w.col_off-dataset.tile.col_off+w.width
-            ] += crop_mask
-                
-    probas = torch.div(pred_sum, mask_sum)
+def check_precision(
+    dataset,
+    module,
+    batch_size,
+    device,
+    precision,
+    channels_last=False,
+    tta=(),
+    num_batches=4,
+    max_pred_change=0.005
+):
+    """
+    Compares the probas of the first num_batches batches of dataset in the
+    precision and memory format given with those in fp32. Raises an error if
+    the fraction of pixels whose predicted class changes exceeds
+    max_pred_change, returns the deltas otherwise.
+    """
+    dataloader = DataLoader(
+        dataset=dataset,
+        shuffle=False,
+        collate_fn=CustomCollate(),
+        batch_size=batch_size
+    )
+    max_abs, abs_sum, changed, pixels = 0., 0., 0, 0
+    for i, batch in enumerate(dataloader):
+        if i == num_batches:
+            break
+        if batch.get('raw'):
+            batch['image'] = batch['image'].to(device)
+            batch = aug.normalize_raw_batch(batch)
+        ref = tta_probas(batch['image'], module, device, tta)
+        probas = tta_probas(batch['image'], module, device, tta, precision=precision, channels_last=channels_last)
+        delta = (probas - ref).abs()
+        max_abs = max(max_abs, float(delta.max()))
+        abs_sum += float(delta.mean(dim=1).sum())
+        changed += int((probas.argmax(dim=1) != ref.argmax(dim=1)).sum())
+        pixels += ref.shape[0] * ref.shape[2] * ref.shape[3]
+
+    deltas = {
+        'max_abs_proba': max_abs,
+        'mean_abs_proba': abs_sum / max(pixels, 1),
+        'pred_change': changed / max(pixels, 1)
+    }
+    print(f'{precision}{" channels last" if channels_last else ""} vs fp32: {deltas}')
+    if deltas['pred_change'] > max_pred_change:
+        raise ValueError(
+            f'{precision} inference changes {100 * deltas["pred_change"]:.2f}% of the predictions, '
+            f'more than {100 * max_pred_change:.2f}%'
+        )
 
-    return probas.detach().cpu()
+    return deltas
 
 def batch_forward(inputs, module, device, tta=None):
     
     if tta:
         inputs, _ = aug_dict[tta](p=1)(inputs)
     with torch.no_grad():
-        outputs = module.forward(inputs.to(device)).cpu()
+        outputs = module.forward(inputs.to(device))
     if tta and tta in anti_t_dict:
         outputs, _ = aug_dict[anti_t_dict[tta]](p=1)(outputs)
 
@@ -143,7 +192,7 @@ def get_window_transform(window, profile):
 
     return new_transform
  
-def write_array(inputs, tile, output_path, profile):
+def write_array(inputs, tile, output_path, profile, nodata=None):
 
     window = get_window(tile)
     transform = get_window_transform(
@@ -153,7 +202,7 @@ def write_array(inputs, tile, output_path, profile):
     new_profile = {
         'driver': 'GTiff',
         'dtype': 'float32',
-        'nodata': None,
+        'nodata': nodata,
         'width': window.width,
         'height': window.height,
         'count': inputs.shape[0],
@@ -21,6 +21,10 @@ class FromFolderDataset(LightningDataModule):
         unsup_train_idxs=None,
         img_aug=None,
         unsup_img_aug=None,
+        decoder='pil',
+        decode_size=None,
+        cache_path=None,
+        raw_transport=False,
         *args,
         **kwargs
     ):
@@ -29,11 +33,19 @@ class FromFolderDataset(LightningDataModule):
         self.batch_size = batch_size
         self.num_workers = workers
         dataset_factory = DatasetFactory()
+        # Decoding options of ResiscDs
+        decode_args = {
+            'decoder': decoder,
+            'decode_size': decode_size,
+            'cache_path': cache_path,
+            'raw_transport': raw_transport
+        }
         
         self.train_set = Subset(
             dataset=dataset_factory.create(folder_dataset)(
                 data_path=data_path,
                 img_aug=img_aug,
+                **decode_args
             ),
             indices=train_idxs
             #indices=[700*i+j for i in range(45) for j in range(50)]
@@ -42,7 +54,8 @@ class FromFolderDataset(LightningDataModule):
         self.val_set = Subset(
             dataset=dataset_factory.create(folder_dataset)(
                 data_path=data_path,
-                img_aug='no'
+                img_aug='no',
+                **decode_args
             ),
             indices=test_idxs
         )
@@ -53,7 +66,8 @@ class FromFolderDataset(LightningDataModule):
             self.unsup_train_set = Subset(
                 dataset=dataset_factory.create(folder_dataset)(
                     data_path=data_path,
-                    img_aug=unsup_img_aug
+                    img_aug=unsup_img_aug,
+                    **decode_args
                 ),
                 indices=unsup_train_idxs
             )
@@ -73,6 +87,10 @@ class FromFolderDataset(LightningDataModule):
         parser.add_argument("--data_path", type=str)
         parser.add_argument('--img_aug', type=str)
         parser.add_argument('--unsup_img_aug', type=str)
+        parser.add_argument('--decoder', type=str, default='pil')
+        parser.add_argument('--decode_size', type=int)
+        parser.add_argument('--cache_path', type=str)
+        parser.add_argument('--raw_transport', action='store_true')
 
         return parser
     
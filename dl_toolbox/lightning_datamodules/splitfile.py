@@ -1,13 +1,128 @@
 from argparse import ArgumentParser
 from pathlib import Path
 import csv
+from concurrent.futures import ProcessPoolExecutor
 from pytorch_lightning import LightningDataModule
 
-from torch.utils.data import DataLoader, RandomSampler, ConcatDataset
+import numpy as np
+from torch.utils.data import DataLoader, RandomSampler, WeightedRandomSampler, ConcatDataset
 from rasterio.windows import Window
 from dl_toolbox.torch_datasets import *
+from dl_toolbox.utils import RasterHandleCache, RasterIndex, SharedBlockCache, get_stats_store
+from dl_toolbox.utils import load_class_grids, class_weights, load_valid_masks
+from dl_toolbox.torch_collate import CustomCollate, BufferedCollate
 
 
+def parse_splitfile(splitfile_path):
+    """
+    Rows (ds_name, image_path, label_path, tile window, fold) of a splitfile.
+    """
+    rows = []
+    with open(splitfile_path, newline='') as splitfile:
+            
+        reader = csv.reader(splitfile)
+        next(reader)
+        for row in reader:
+
+            ds_name, _, image_path, label_path, x0, y0, w, h, fold = row[:9]
+            window = Window(
+                col_off=int(x0),
+                row_off=int(y0),
+                width=int(w),
+                height=int(h)
+            )
+            rows.append((ds_name, image_path, label_path, window, int(fold)))
+
+    return rows
+
+def _build_dataset(args):
+
+    ds_name, kwargs = args
+    return DatasetFactory().create(ds_name)(**kwargs)
+
+def build_datasets(
+    data_path,
+    rows,
+    fixed_crops,
+    crop_size,
+    img_aug,
+    labels,
+    handle_cache=None,
+    stats_mode='approx',
+    stats_on_tile=False,
+    workers=0,
+    bands=None,
+    raw_transport=False,
+    supercrop_size=None,
+    num_subcrops=1,
+    image_index=None,
+    label_index=None,
+    resolution=None,
+    block_cache=None
+):
+    """
+    Builds one dataset per splitfile row, with a pool of workers processes
+    if workers > 1. Band stats must already be in the store. Objects shared
+    between datasets (handle cache, spatial indexes, block cache) are set
+    once the datasets are back in this process.
+    """
+    requests = [
+        (ds_name, dict(
+            image_path=data_path/image_path,
+            label_path=data_path/label_path if label_path else None,
+            tile=window,
+            crop_size=crop_size,
+            fixed_crops=fixed_crops,
+            img_aug=img_aug,
+            labels=labels,
+            stats_mode=stats_mode,
+            stats_on_tile=stats_on_tile,
+            bands=bands,
+            raw_transport=raw_transport,
+            supercrop_size=supercrop_size,
+            num_subcrops=num_subcrops,
+            resolution=resolution
+        )) for ds_name, image_path, label_path, window, _ in rows
+    ]
+    if workers > 1 and len(requests) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            sets = list(pool.map(_build_dataset, requests, chunksize=max(1, len(requests) // (4 * workers))))
+    else:
+        sets = [_build_dataset(request) for request in requests]
+
+    for ds in sets:
+        if handle_cache is not None:
+            ds.handle_cache = handle_cache
+        ds.image_index = image_index
+        ds.label_index = label_index
+        ds.block_cache = block_cache
+
+    return sets
+
+def fill_stats(data_path, rows, stats_mode='approx', stats_on_tile=False, workers=0):
+
+    # Band stats missing from the store are computed in parallel once here,
+    # datasets built afterwards only read them back.
+    get_stats_store().fill(
+        [(data_path/image_path, window if stats_on_tile else None, stats_mode)
+         for _, image_path, _, window, _ in rows],
+        workers=workers
+    )
+
+def build_indexes(data_path, rows, handle_cache=None):
+
+    # Spatial indexes over the image and label rasters of the rows: tiles and
+    # crops may then extend beyond their raster and are read from all the
+    # rasters they overlap
+    image_index = RasterIndex(
+        [data_path/image_path for _, image_path, _, _, _ in rows],
+        handle_cache=handle_cache
+    )
+    label_paths = [data_path/label_path for _, _, label_path, _, _ in rows if label_path]
+    label_index = RasterIndex(label_paths, handle_cache=handle_cache) if label_paths else None
+
+    return image_index, label_index
+
 def read_splitfile(
     data_path,
     splitfile_path,
@@ -15,38 +130,44 @@ def read_splitfile(
     fixed_crops,
     crop_size,
     img_aug,
-    labels
+    labels,
+    handle_cache=None,
+    stats_mode='approx',
+    stats_on_tile=False,
+    stats_workers=0,
+    bands=None,
+    raw_transport=False,
+    supercrop_size=None,
+    num_subcrops=1,
+    mosaic=False,
+    resolution=None,
+    block_cache=None
 ):
     
-    sets = []
-    dataset_factory = DatasetFactory()
-    
-    with open(splitfile_path, newline='') as splitfile:
-            
-        reader = csv.reader(splitfile)
-        next(reader)
-        for row in reader:
+    rows = [row for row in parse_splitfile(splitfile_path) if row[4] in folds]
+    fill_stats(data_path, rows, stats_mode, stats_on_tile, stats_workers)
+    image_index, label_index = build_indexes(data_path, rows, handle_cache) if mosaic else (None, None)
 
-            ds_name, _, image_path, label_path, x0, y0, w, h, fold = row[:9]
-            if int(fold) in folds:
-                window = Window(
-                    col_off=int(x0),
-                    row_off=int(y0),
-                    width=int(w),
-                    height=int(h)
-                )
-                ds = dataset_factory.create(ds_name)(
-                    image_path=data_path/image_path,
-                    label_path=data_path/label_path if label_path else None,
-                    tile=window,
-                    crop_size=crop_size,
-                    fixed_crops=fixed_crops,
-                    img_aug=img_aug,
-                    labels=labels
-                )
-                sets.append(ds)
-    
-    return sets
+    return build_datasets(
+        data_path,
+        rows,
+        fixed_crops=fixed_crops,
+        crop_size=crop_size,
+        img_aug=img_aug,
+        labels=labels,
+        handle_cache=handle_cache,
+        stats_mode=stats_mode,
+        stats_on_tile=stats_on_tile,
+        workers=stats_workers,
+        bands=bands,
+        raw_transport=raw_transport,
+        supercrop_size=supercrop_size,
+        num_subcrops=num_subcrops,
+        image_index=image_index,
+        label_index=label_index,
+        resolution=resolution,
+        block_cache=block_cache
+    )
 
 class Splitfile(LightningDataModule):
 
@@ -64,6 +185,27 @@ class Splitfile(LightningDataModule):
         unsup_img_aug=None,
         labels='base',
         unsup_train_folds=None,
+        max_open_rasters=64,
+        gdal_cachemax=None,
+        stats_mode='approx',
+        stats_on_tile=False,
+        chip_store=None,
+        bands=None,
+        raw_transport=False,
+        supercrop_size=None,
+        num_subcrops=1,
+        class_balance=None,
+        class_cell_size=64,
+        mosaic=False,
+        resolution=None,
+        loader_backend='process',
+        loader_threads=None,
+        block_cache_mb=None,
+        block_size=256,
+        buffered_collate=False,
+        plan_seed=None,
+        min_valid=None,
+        valid_cell_size=32,
         #crop_step=None,
         #one_hot=False,
         *args,
@@ -74,43 +216,204 @@ class Splitfile(LightningDataModule):
         self.epoch_len = epoch_len
         self.batch_size = batch_size
         self.num_workers = workers
-        test_sets, train_sets = [], []
-        data_path = Path(data_path)
-        train_sets = read_splitfile(
-            data_path,
-            splitfile_path,
-            folds=train_folds,
-            fixed_crops=False,
-            crop_size=crop_size,
-            img_aug=img_aug,
-            labels=labels            
+        # 'process': DataLoader with workers processes; 'thread': batches read
+        # by a pool of loader_threads threads in the main process
+        if loader_backend not in ('process', 'thread'):
+            raise ValueError(f'Unknown loader backend {loader_backend}')
+        self.loader_backend = loader_backend
+        self.loader_threads = loader_threads if loader_threads else max(workers, 1)
+        self.buffered_collate = buffered_collate
+        # With a seed, random crops follow a crop plan drawn from (seed, epoch)
+        # and resumed from checkpoints (torch_datasets.CropPlanSampler)
+        self.plan_seed = plan_seed if not chip_store else None
+        self.plan_samplers = {}
+        self.plan_state = None
+        # Random crops need a min_valid fraction of valid pixels, fixed crops
+        # at least one (utils.ValidMask)
+        self.min_valid = min_valid
+        self.valid_cell_size = valid_cell_size
+        self.data_path = Path(data_path)
+        self.splitfile_path = splitfile_path
+        self.train_folds = train_folds
+        self.test_folds = test_folds
+        self.unsup_train_folds = unsup_train_folds
+        self.crop_size = crop_size
+        self.img_aug = img_aug
+        self.unsup_img_aug = unsup_img_aug
+        self.labels = labels
+        self.stats_mode = stats_mode
+        self.stats_on_tile = stats_on_tile
+        self.bands = bands
+        self.raw_transport = raw_transport
+        self.supercrop_size = supercrop_size
+        self.class_balance = class_balance
+        self.class_cell_size = class_cell_size
+        self.mosaic = mosaic
+        # One handle cache for all tiles, so that the bound on open files
+        # holds for the whole datamodule in each worker
+        self.handle_cache = RasterHandleCache(
+            max_open=max_open_rasters,
+            gdal_cachemax=gdal_cachemax
         )
-        test_sets = read_splitfile(
-            data_path,
-            splitfile_path,
-            folds=test_folds,
-            fixed_crops=True,
-            crop_size=crop_size,
-            img_aug=None,
-            labels=labels            
+        self.chip_store = chip_store
+        # Decoded blocks shared by all workers, created before they start
+        self.block_cache = SharedBlockCache(
+            capacity_mb=block_cache_mb,
+            block=block_size
+        ) if block_cache_mb and not chip_store else None
+        # One target resolution, or a (low, high) range drawn per training crop
+        if resolution is not None and len(resolution) == 1:
+            resolution = resolution[0]
+        self.resolution = resolution
+        # Each training sample is a supercrop holding num_subcrops crops, cut
+        # on the device: loaders yield batch_size crops per batch as before
+        self.num_subcrops = num_subcrops if supercrop_size and not chip_store else 1
+        if self.num_subcrops > 1 and batch_size % self.num_subcrops:
+            raise ValueError(
+                f'batch_size {batch_size} is not a multiple of num_subcrops {num_subcrops}'
+            )
+        if supercrop_size and supercrop_size < crop_size:
+            raise ValueError(f'supercrop_size {supercrop_size} is smaller than crop_size {crop_size}')
+        # The splitfile is parsed once here, datasets are built in setup
+        self.rows = parse_splitfile(splitfile_path) if not chip_store else None
+        self.train_set, self.val_set, self.unsup_train_set = None, None, None
+        self.train_weights = None
+        self._class_names = None
+
+    def read_sets(self, folds, fixed_crops, img_aug, image_index=None, label_index=None):
+
+        # Tiles are read from the chip store when one has been built from
+        # the splitfile (utils/build_chip_store.py)
+        if self.chip_store:
+            return read_chip_store(
+                self.chip_store,
+                folds=folds,
+                fixed_crops=fixed_crops,
+                crop_size=self.crop_size,
+                img_aug=img_aug,
+                raw_transport=self.raw_transport
+            )
+        return build_datasets(
+            self.data_path,
+            [row for row in self.rows if row[4] in folds],
+            fixed_crops=fixed_crops,
+            crop_size=self.crop_size,
+            img_aug=img_aug,
+            labels=self.labels,
+            handle_cache=self.handle_cache,
+            stats_mode=self.stats_mode,
+            stats_on_tile=self.stats_on_tile,
+            workers=self.num_workers,
+            bands=self.bands,
+            raw_transport=self.raw_transport,
+            supercrop_size=None if fixed_crops else self.supercrop_size,
+            num_subcrops=self.num_subcrops,
+            image_index=image_index,
+            label_index=label_index,
+            resolution=self.resolution,
+            block_cache=self.block_cache
         )
-        self.train_set = ConcatDataset(train_sets)
+
+    def setup(self, stage=None):
+
+        if self.train_set is not None:
+            return
+
+        image_index, label_index = None, None
+        if not self.chip_store:
+            folds = set(self.train_folds) | set(self.test_folds) | set(self.unsup_train_folds or [])
+            rows = [row for row in self.rows if row[4] in folds]
+            fill_stats(self.data_path, rows, self.stats_mode, self.stats_on_tile, self.num_workers)
+            if self.mosaic:
+                image_index, label_index = build_indexes(self.data_path, rows, self.handle_cache)
+
+        train_sets = self.read_sets(self.train_folds, False, self.img_aug, image_index, label_index)
+        test_sets = self.read_sets(self.test_folds, True, None, image_index, label_index)
+        unsup_train_sets = []
+        if self.unsup_train_folds:
+            unsup_train_sets = self.read_sets(
+                self.unsup_train_folds, False, self.unsup_img_aug, image_index, label_index
+            )
+
+        valid_pixels = None
+        if self.min_valid is not None and not self.chip_store:
+            valid_pixels = self.init_valid_masks(
+                train_sets + test_sets + unsup_train_sets,
+                self.min_valid,
+                self.valid_cell_size,
+                self.num_workers
+            )[:len(train_sets)]
+
+        self.train_set = PlannedConcatDataset(train_sets)
+        if self.class_balance is not None and not self.chip_store:
+            self.train_weights = self.init_class_sampling(
+                train_sets,
+                self.class_balance,
+                self.class_cell_size,
+                self.num_workers
+            )
+        elif valid_pixels is not None:
+            # Tiles drawn in proportion to their valid pixels
+            self.train_weights = valid_pixels
         self.val_set = ConcatDataset(test_sets)
-        self.class_names = list(self.val_set.datasets[0].labels.keys())
+        self._class_names = list(test_sets[0].labels.keys())
         
-        if unsup_train_folds:
-            unsup_train_sets = read_splitfile(
-                data_path,
-                splitfile_path,
-                folds=unsup_train_folds,
-                fixed_crops=False,
-                crop_size=crop_size,
-                img_aug=unsup_img_aug,
-                labels=labels            
-            )
-            self.unsup_train_set = ConcatDataset(unsup_train_sets)
-        else:
-            self.unsup_train_set = None
+        if unsup_train_sets:
+            self.unsup_train_set = PlannedConcatDataset(unsup_train_sets)
+
+    @staticmethod
+    def init_valid_masks(datasets, min_valid, cell_size, workers=0):
+        """
+        Sets the valid mask of its image on each dataset, so that random crops
+        are mostly valid and fixed crops without valid pixels skipped.
+        Returns the number of valid pixels of each tile.
+        """
+        masks = load_valid_masks(
+            [ds.image_path for ds in datasets],
+            cell_size=cell_size,
+            workers=workers
+        )
+        valid_pixels = [ds.set_valid_mask(masks[str(ds.image_path)], min_valid) for ds in datasets]
+        skipped = [ds.skipped for ds in datasets if ds.crop_windows is not None]
+        if skipped:
+            print(f'Skipped {100 * np.mean(skipped):.1f}% of fixed crops without valid pixels')
+
+        return valid_pixels
+
+    @property
+    def class_names(self):
+
+        # Available before setup from a single validation tile
+        if self._class_names is None:
+            if self.chip_store:
+                ds = self.read_sets(self.test_folds, True, None)[0]
+            else:
+                row = next(row for row in self.rows if row[4] in self.test_folds)
+                fill_stats(self.data_path, [row], self.stats_mode, self.stats_on_tile)
+                ds = build_datasets(
+                    self.data_path, [row], True, self.crop_size, None, self.labels,
+                    stats_mode=self.stats_mode, stats_on_tile=self.stats_on_tile
+                )[0]
+            self._class_names = list(ds.labels.keys())
+
+        return self._class_names
+
+    @staticmethod
+    def init_class_sampling(train_sets, balance, cell_size, workers=0):
+        """
+        Class-balanced sampling of the training crops: crops are drawn in each
+        tile from a grid of label counts, and tiles are drawn according to
+        their weighted label counts, the weights being computed from the
+        label frequencies over all training tiles.
+        """
+        grids = load_class_grids(train_sets, cell_size, workers=workers)
+        counts = np.sum([grid.sum(axis=(0, 1)) for grid in grids], axis=0)
+        weights = class_weights(counts, balance)
+
+        return [
+            ds.set_class_sampling(grid, cell_size, weights)
+            for ds, grid in zip(train_sets, grids)
+        ]
 
     @classmethod
     def add_model_specific_args(cls, parent_parser):
@@ -129,54 +432,154 @@ class Splitfile(LightningDataModule):
         parser.add_argument('--crop_size', type=int)
         parser.add_argument('--crop_step', type=int)
         parser.add_argument('--labels', type=str)
+        parser.add_argument('--max_open_rasters', type=int, default=64)
+        parser.add_argument('--gdal_cachemax', type=int)
+        parser.add_argument('--stats_mode', type=str, default='approx')
+        parser.add_argument('--stats_on_tile', action='store_true')
+        parser.add_argument('--chip_store', type=str)
+        parser.add_argument('--bands', nargs='+', type=int)
+        parser.add_argument('--raw_transport', action='store_true')
+        parser.add_argument('--supercrop_size', type=int)
+        parser.add_argument('--num_subcrops', type=int, default=1)
+        parser.add_argument('--class_balance', type=float)
+        parser.add_argument('--class_cell_size', type=int, default=64)
+        parser.add_argument('--mosaic', action='store_true')
+        parser.add_argument('--resolution', nargs='+', type=float)
+        parser.add_argument('--loader_backend', type=str, default='process', choices=['process', 'thread'])
+        parser.add_argument('--loader_threads', type=int)
+        parser.add_argument('--block_cache_mb', type=int)
+        parser.add_argument('--block_size', type=int, default=256)
+        parser.add_argument(
+            '--buffered_collate',
+            action='store_true',
+            help='reuse batch buffers, pinned only with --workers 0: with '
+                 'workers they are shared and batches are still copied to '
+                 'pinned memory by the DataLoader'
+        )
+        parser.add_argument('--plan_seed', type=int)
+        parser.add_argument('--min_valid', type=float)
+        parser.add_argument('--valid_cell_size', type=int, default=32)
 
         return parser
     
+    def make_loader(self, dataset, batch_size, sampler=None, drop_last=False):
+
+        if self.loader_backend == 'thread':
+            return ThreadedLoader(
+                dataset=dataset,
+                batch_size=batch_size,
+                sampler=sampler,
+                threads=self.loader_threads,
+                drop_last=drop_last,
+                pin_memory=True
+            )
+
+        collate = CustomCollate()
+        if self.buffered_collate:
+            # Pinned in the main process, shared by workers otherwise: the
+            # DataLoader then still copies each batch to pinned memory
+            num_samples = len(sampler if sampler is not None else dataset)
+            if drop_last:
+                batches_per_epoch = num_samples // batch_size
+            else:
+                batches_per_epoch = -(-num_samples // batch_size)
+            collate = BufferedCollate(
+                batches_per_epoch=batches_per_epoch,
+                pin_memory=self.num_workers == 0
+            )
+
+        return DataLoader(
+            dataset=dataset,
+            batch_size=batch_size,
+            collate_fn=collate,
+            sampler=sampler,
+            shuffle=False,
+            num_workers=self.num_workers,
+            pin_memory=True,
+            drop_last=drop_last
+        )
+
+    def current_epoch(self):
+
+        return self.trainer.current_epoch if self.trainer is not None else 0
+
+    def train_sampler(self, name, dataset, num_samples, weights=None):
+
+        if self.plan_seed is None:
+            if weights is None:
+                return RandomSampler(
+                    data_source=dataset,
+                    replacement=True,
+                    num_samples=num_samples
+                )
+            return WeightedRandomSampler(
+                weights=weights,
+                num_samples=num_samples,
+                replacement=True
+            )
+
+        sampler = CropPlanSampler(
+            dataset,
+            num_samples=num_samples,
+            seed=self.plan_seed + len(self.plan_samplers),
+            weights=weights,
+            epoch_fn=self.current_epoch
+        )
+        if self.plan_state and name in self.plan_state:
+            sampler.load_state_dict(self.plan_state[name])
+        self.plan_samplers[name] = sampler
+
+        return sampler
+
     def train_dataloader(self):
         
+        batch_size = max(1, self.batch_size // self.num_subcrops)
+        num_samples = max(1, self.epoch_len // self.num_subcrops)
+        self.plan_samplers = {}
         train_dataloaders = {}
-        train_dataloaders['sup'] = DataLoader(
+        train_dataloaders['sup'] = self.make_loader(
             dataset=self.train_set,
-            batch_size=self.batch_size,
-            collate_fn=CustomCollate(),
-            sampler=RandomSampler(
-                data_source=self.train_set,
-                replacement=True,
-                num_samples=self.epoch_len
-            ),
-            num_workers=self.num_workers,
-            pin_memory=True,
+            batch_size=batch_size,
+            sampler=self.train_sampler('sup', self.train_set, num_samples, self.train_weights),
             drop_last=True
         )
         
         if self.unsup_train_set:
     
-            train_dataloaders['unsup'] = DataLoader(
+            train_dataloaders['unsup'] = self.make_loader(
                 dataset=self.unsup_train_set,
-                batch_size=self.batch_size,
-                sampler=RandomSampler(
-                    data_source=self.unsup_train_set,
-                    replacement=True,
-                    num_samples=self.epoch_len
-                ),
-                collate_fn=CustomCollate(),
-                num_workers=self.num_workers,
-                pin_memory=True,
+                batch_size=batch_size,
+                sampler=self.train_sampler('unsup', self.unsup_train_set, num_samples),
                 drop_last=True
             )
 
         return train_dataloaders
 
+    def on_save_checkpoint(self, checkpoint):
+
+        # Samples consumed in the current epoch, from the batches completed;
+        # the trainer restores this count on resumption, so that it includes
+        # the batches before it
+        if self.plan_samplers:
+            completed = self.trainer.fit_loop.epoch_loop.batch_progress.current.completed
+            consumed = completed * max(1, self.batch_size // self.num_subcrops)
+            checkpoint['crop_plan'] = {
+                name: sampler.state_dict(consumed) for name, sampler in self.plan_samplers.items()
+            }
+
+    def on_load_checkpoint(self, checkpoint):
+
+        self.plan_state = checkpoint.get('crop_plan')
+        for name, sampler in self.plan_samplers.items():
+            if self.plan_state and name in self.plan_state:
+                sampler.load_state_dict(self.plan_state[name])
+
     def val_dataloader(self):
 
-        val_dataloader = DataLoader(
+        val_dataloader = self.make_loader(
             dataset=self.val_set,
-            shuffle=False,
-            collate_fn=CustomCollate(),
-            batch_size=self.batch_size,
-            num_workers=self.num_workers,
-            pin_memory=True
+            batch_size=self.batch_size
         )
         self.nb_val_batch = len(self.val_set) // self.batch_size
 
-        return val_dataloader
\ No newline at end of file
+        return val_dataloader
@@ -13,6 +13,7 @@ class CE(BaseModule):
                  weights,
                  mixup=0.,
                  ignore_index=-1,
+                 batch_aug=None,
                  *args,
                  **kwargs):
 
@@ -33,6 +34,9 @@ class CE(BaseModule):
             range(self.num_classes)
         )
         self.mixup = aug.Mixup(alpha=mixup) if mixup > 0. else None
+        # Augmentations of the whole batch on the training device, with the
+        # same syntax as img_aug
+        self.batch_aug = aug.get_batch_transforms(batch_aug) if batch_aug else None
         #self.save_hyperparameters('network', 'weights', 'mixup', 'ignore_index')
         self.save_hyperparameters()
 
@@ -44,6 +48,7 @@ class CE(BaseModule):
         parser.add_argument("--network", type=str)
         parser.add_argument("--weights", type=float, nargs="+", default=())
         parser.add_argument("--mixup", type=float, default=0.)
+        parser.add_argument("--batch_aug", type=str)
 
         return parser
 
@@ -66,6 +71,10 @@ class CE(BaseModule):
         batch = batch["sup"]
         inputs = batch['image']
         labels = batch['mask']
+        if self.batch_aug:
+            batch['orig_image'] = inputs
+            inputs, labels = self.batch_aug(inputs, labels)
+            batch['image'] = inputs
         if self.mixup:
             labels = self.onehot(labels).float()
             inputs, labels = self.mixup(inputs, labels)
@@ -5,6 +5,7 @@ from copy import deepcopy
 from dl_toolbox.lightning_modules import CE
 import dl_toolbox.utils as utils
 from dl_toolbox.torch_datasets.utils import get_transforms
+from dl_toolbox.augmentations import get_batch_transforms
 from dl_toolbox.callbacks import log_batch_images
 
 
@@ -17,6 +18,7 @@ class CE_MT(CE):
         pseudo_threshold,
         consist_aug,
         emas,
+        unsup_batch_aug=None,
         *args,
         **kwargs
     ):
@@ -26,6 +28,7 @@ class CE_MT(CE):
         self.ramp = ramp
         self.pseudo_threshold = pseudo_threshold
         self.consist_aug = get_transforms(consist_aug)
+        self.unsup_batch_aug = get_batch_transforms(unsup_batch_aug) if unsup_batch_aug else None
         self.emas = emas
         self.pl_loss = nn.CrossEntropyLoss(
             reduction='none'
@@ -40,6 +43,7 @@ class CE_MT(CE):
         parser.add_argument("--ramp", nargs=2, type=int)
         parser.add_argument("--pseudo_threshold", type=float)
         parser.add_argument("--consist_aug", type=str)
+        parser.add_argument("--unsup_batch_aug", type=str)
 
         return parser
 
@@ -66,6 +70,10 @@ class CE_MT(CE):
         if self.alpha > 0:
             
             unsup_inputs = unsup_batch['image']
+            if self.unsup_batch_aug:
+                unsup_batch['orig_image'] = unsup_inputs
+                unsup_inputs, _ = self.unsup_batch_aug(unsup_inputs)
+                unsup_batch['image'] = unsup_inputs
             with torch.no_grad():
                 pl_logits = self.teacher_network(unsup_inputs)
             pl_probas = self._compute_probas(pl_logits)
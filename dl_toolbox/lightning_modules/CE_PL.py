@@ -4,6 +4,7 @@ import torch.nn as nn
 from dl_toolbox.lightning_modules import CE
 import dl_toolbox.utils as utils
 from dl_toolbox.torch_datasets.utils import get_transforms
+from dl_toolbox.augmentations import get_batch_transforms
 
 
 class CE_PL(CE):
@@ -14,6 +15,7 @@ class CE_PL(CE):
         alpha_milestones,
         pseudo_threshold,
         consist_aug,
+        unsup_batch_aug=None,
         *args,
         **kwargs
     ):
@@ -22,6 +24,7 @@ class CE_PL(CE):
         self.alpha_milestones = alpha_milestones
         self.pseudo_threshold = pseudo_threshold
         self.consist_aug = get_transforms(consist_aug)
+        self.unsup_batch_aug = get_batch_transforms(unsup_batch_aug) if unsup_batch_aug else None
         self.pl_loss = nn.CrossEntropyLoss(
             reduction='none'
         )
@@ -34,6 +37,7 @@ class CE_PL(CE):
         parser.add_argument("--alpha_milestones", nargs=2, type=int)
         parser.add_argument("--pseudo_threshold", type=float)
         parser.add_argument("--consist_aug", type=str)
+        parser.add_argument("--unsup_batch_aug", type=str)
 
         return parser
 
@@ -54,6 +58,10 @@ class CE_PL(CE):
         if self.alpha > 0:
             
             unsup_inputs = unsup_batch['image']
+            if self.unsup_batch_aug:
+                unsup_batch['orig_image'] = unsup_inputs
+                unsup_inputs, _ = self.unsup_batch_aug(unsup_inputs)
+                unsup_batch['image'] = unsup_inputs
             pl_logits = self.network(unsup_inputs).detach()
             pl_probas = self._compute_probas(pl_logits)
             aug_unsup_inputs, aug_pl_probas = self.consist_aug(
@@ -8,6 +8,8 @@ import torchmetrics.functional as torchmetrics
 from dl_toolbox.callbacks import plot_confusion_matrix, plot_calib, compute_calibration_bins, compute_conf_mat, log_batch_images
 import numpy as np
 from dl_toolbox.networks import NetworkFactory
+from dl_toolbox.augmentations import normalize_raw_batch
+from dl_toolbox.torch_collate import extract_subcrops
 
 
 class BaseModule(pl.LightningModule):
@@ -53,6 +55,19 @@ class BaseModule(pl.LightningModule):
 
         return [self.optimizer], [scheduler]
 
+    def on_after_batch_transfer(self, batch, dataloader_idx):
+
+        # Batches from datasets in raw transport mode are normalized here, on
+        # the training device, and supercrops are cut into crops; training
+        # batches are dicts of batches.
+        def prepare(b):
+            return extract_subcrops(normalize_raw_batch(b))
+
+        if 'image' in batch:
+            return prepare(batch)
+
+        return {key: prepare(b) for key, b in batch.items()}
+
     def validation_step(self, batch, batch_idx):
 
         inputs = batch['image']
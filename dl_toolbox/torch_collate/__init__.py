@@ -1 +1,3 @@
-from .custom import CustomCollate
\ No newline at end of file
+from .custom import CustomCollate
+from .buffered import BufferedCollate
+from .subcrops import extract_subcrops, crop_batch
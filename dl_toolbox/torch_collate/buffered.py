@@ -0,0 +1,113 @@
+import torch
+from torch.utils.data import get_worker_info
+from torch.utils.data._utils.collate import default_collate
+
+
+class BufferedCollate():
+    """
+    Collate writing the samples of the requested keys into a ring of batch
+    buffers allocated once and reused, instead of new tensors per batch.
+
+    In worker processes buffers are in shared memory, so that batches are not
+    copied into new shared segments to reach the main process; in the main
+    process they can be pinned. A buffer is reused num_buffers batches later:
+    num_buffers must exceed the number of batches a consumer keeps alive,
+    which for a DataLoader is its prefetch_factor plus the batch in use.
+
+    orig_image and orig_mask, only used to log images, are collated on the
+    first orig_batches batches of each epoch only (of the first worker when
+    there are workers, which are restarted each epoch).
+
+    :param keys: keys collated in all batches; minmax, subcrops, scale, seed
+        and window are always collated when present as batches are processed
+        with them.
+    :param batches_per_epoch: number of batches per epoch, to find epoch
+        starts when collating in the main process.
+    """
+
+    always_collated = ('minmax', 'subcrops', 'scale', 'seed', 'window')
+
+    def __init__(
+        self,
+        keys=('image', 'mask'),
+        orig_batches=1,
+        batches_per_epoch=None,
+        num_buffers=4,
+        pin_memory=False
+    ):
+
+        self.keys = list(keys)
+        self.orig_batches = orig_batches
+        self.batches_per_epoch = batches_per_epoch
+        self.num_buffers = num_buffers
+        self.pin_memory = pin_memory
+        self._buffers = {}
+        self._count = 0
+
+    def __getstate__(self):
+
+        # Buffers are allocated in each worker
+        state = self.__dict__.copy()
+        state['_buffers'] = {}
+        return state
+
+    def with_orig(self):
+
+        info = get_worker_info()
+        if info is not None:
+            return info.id == 0 and self._count < self.orig_batches
+        if self.batches_per_epoch:
+            return self._count % self.batches_per_epoch < self.orig_batches
+        return self._count < self.orig_batches
+
+    def buffer(self, key, values):
+
+        shape = (len(values), *values[0].shape)
+        dtype = values[0].dtype
+        ring = self._buffers.get(key)
+        if ring is None or ring[0].shape[1:] != shape[1:] or ring[0].dtype != dtype \
+                or ring[0].shape[0] < shape[0]:
+            in_worker = get_worker_info() is not None
+            ring = []
+            for _ in range(self.num_buffers):
+                buffer = torch.empty(
+                    shape,
+                    dtype=dtype,
+                    pin_memory=self.pin_memory and not in_worker
+                )
+                if in_worker:
+                    buffer.share_memory_()
+                ring.append(buffer)
+            self._buffers[key] = ring
+
+        return ring[self._count % self.num_buffers][:shape[0]]
+
+    def __call__(self, batch, *args, **kwargs):
+
+        keys = list(self.keys)
+        if self.with_orig():
+            keys += ['orig_image', 'orig_mask']
+
+        out = {}
+        for key in keys:
+            values = [elem.get(key) for elem in batch]
+            if any(v is None for v in values):
+                continue
+            out[key] = torch.stack(values, out=self.buffer(key, values))
+        for key in self.always_collated:
+            values = [elem.get(key) for elem in batch]
+            if all(v is not None for v in values):
+                out[key] = default_collate(values)
+        if 'mask' not in out:
+            out['mask'] = None
+
+        out['path'] = [elem['path'] for elem in batch if 'path' in elem]
+        raw = batch[0].get('raw')
+        if raw:
+            out['raw'] = raw
+        subcrop_aug = batch[0].get('subcrop_aug')
+        if subcrop_aug:
+            out['subcrop_aug'] = subcrop_aug
+        self._count += 1
+
+        return out
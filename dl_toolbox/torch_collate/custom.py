@@ -2,19 +2,28 @@ from torch.utils.data._utils.collate import default_collate
 import torch
 
 
+# Windows are (col_off, row_off, width, height) int32 tensors, collated into
+# (B, 4) batches
+keys_to_collate = ['image', 'orig_image', 'mask', 'orig_mask', 'minmax', 'subcrops', 'scale', 'seed', 'window']
+
 class CustomCollate():
 
     def __call__(self, batch, *args, **kwargs):
 
-        windows = [elem['window'] for elem in batch if 'window' in elem.keys()]
         paths = [elem['path'] for elem in batch if 'path' in elem.keys()]
-        keys_to_collate = ['image', 'orig_image', 'mask', 'orig_mask']
+        raw = batch[0].get('raw')
+        subcrop_aug = batch[0].get('subcrop_aug')
         to_collate = [{k: v for k, v in elem.items() if (k in keys_to_collate) and (v is not None)} for elem in batch]
         batch = default_collate(to_collate)
         if 'mask' not in batch.keys():
             batch['mask'] = None
         
-        batch['window'] = windows
         batch['path'] = paths
+        # Raw transport batches are normalized once on the device
+        if raw:
+            batch['raw'] = raw
+        # Supercrop batches are augmented per crop once cut on the device
+        if subcrop_aug:
+            batch['subcrop_aug'] = subcrop_aug
 
         return batch
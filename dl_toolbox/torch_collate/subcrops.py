@@ -0,0 +1,86 @@
+from functools import lru_cache
+
+import torch
+
+from dl_toolbox.augmentations import get_batch_transforms
+
+
+@lru_cache()
+def subcrop_transforms(name):
+
+    return get_batch_transforms(name)
+
+
+def _crop_index(subcrops, size):
+
+    offsets = subcrops[..., :2].long()
+    span = torch.arange(size, device=subcrops.device)
+    rows = (offsets[..., 0, None] + span).unsqueeze(-1)
+    cols = (offsets[..., 1, None] + span).unsqueeze(-2)
+
+    return rows, cols
+
+def crop_batch(x, subcrops):
+    """
+    Cuts the (B,K,3) subcrops (row, col, size) out of a (B,...,H,W) tensor
+    with one advanced indexing, on its device: returns (B*K,...,size,size).
+    """
+    B, K = subcrops.shape[:2]
+    size = int(subcrops[0, 0, 2])
+    rows, cols = _crop_index(subcrops.to(x.device), size)
+    batch_idx = torch.arange(B, device=x.device).view(B, 1, 1, 1)
+    # Spatial dims first so that advanced indexing keeps the others at the end
+    out = x.movedim((-2, -1), (1, 2))[batch_idx, rows, cols]
+
+    return out.movedim((2, 3), (-2, -1)).reshape(B*K, *x.shape[1:-2], size, size)
+
+def extract_subcrops(batch):
+    """
+    Turns a batch of B supercrops with K subcrops each into a batch of B*K
+    crops, does nothing on batches without subcrops. Windows and paths are
+    repeated per crop, windows being shifted to the crop position: subcrops
+    are in output pixels, scaled by the (B,) source pixels per output pixel
+    of the batch scale when the crops were resampled. Crops are then
+    augmented each with its own parameters by the batch version of the
+    subcrop_aug of the batch, drawn from the seed of its first supercrop
+    when they were planned.
+    """
+    subcrops = batch.get('subcrops')
+    if subcrops is None:
+        return batch
+    K = subcrops.shape[1]
+    for key in ('image', 'orig_image', 'mask', 'orig_mask'):
+        if batch.get(key) is not None:
+            batch[key] = crop_batch(batch[key], subcrops)
+    if batch.get('minmax') is not None:
+        batch['minmax'] = batch['minmax'].repeat_interleave(K, dim=0)
+    if batch.get('window') is not None:
+        windows = batch['window'].to(subcrops.device)
+        source = subcrops.float()
+        if batch.get('scale') is not None:
+            source = source * batch['scale'].to(subcrops.device)[:, None, None]
+        source = source.round().to(windows.dtype)
+        crops = torch.stack([
+            windows[:, None, 0] + source[..., 1],
+            windows[:, None, 1] + source[..., 0],
+            source[..., 2],
+            source[..., 2]
+        ], dim=-1)
+        batch['window'] = crops.reshape(-1, 4).to(windows.dtype)
+    if batch.get('path'):
+        batch['path'] = [p for p in batch['path'] for _ in range(K)]
+    name = batch.get('subcrop_aug')
+    if name:
+        generator = None
+        if batch.get('seed') is not None:
+            generator = torch.Generator(device=batch['image'].device)
+            generator.manual_seed(int(batch['seed'][0]))
+        batch['image'], batch['mask'] = subcrop_transforms(name)(
+            batch['image'], batch.get('mask'), generator=generator
+        )
+    batch['subcrops'] = None
+    batch['scale'] = None
+    batch['seed'] = None
+    batch['subcrop_aug'] = None
+
+    return batch
@@ -3,7 +3,11 @@ from .digitanie_v2 import *
 #from .old_digitanie import *
 from .semcity_bdsd_ds import *
 from .resisc import *
+from .shard_ds import ShardDs
 from .airs import *
 from .miniworld import *
+from .chip_ds import ChipDs, read_chip_store
 #from .inria import *
 from .dataset_factory import DatasetFactory
+from .threaded_loader import ThreadedLoader
+from .crop_plan import CropPlanSampler, PlannedConcatDataset
@@ -0,0 +1,183 @@
+import json
+from pathlib import Path
+
+import torch
+import numpy as np
+from rasterio.windows import Window
+
+from dl_toolbox.utils import get_tiles_array, LabelsToRGB
+from dl_toolbox.torch_datasets.utils import *
+
+
+# Quantization of the normalized [0, 1] images in the store
+store_dtypes = {
+    'uint8': (np.uint8, 255.),
+    'uint16': (np.uint16, 65535.)
+}
+
+def chunk_shape(height, width, chunk):
+
+    return -(-height // chunk), -(-width // chunk)
+
+def read_chunked(array, window, chunk):
+    """
+    Assembles a window (col_off, row_off, width, height) from an array stored
+    as (rows of chunks, cols of chunks, ..., chunk, chunk); a window aligned
+    on the chunk grid touches one chunk, any other window at most four when
+    its size is the chunk size.
+    """
+    col_off, row_off, width, height = window
+    out = np.empty((*array.shape[2:-2], height, width), dtype=array.dtype)
+    for r in range(row_off // chunk, (row_off + height - 1) // chunk + 1):
+        y0, y1 = max(row_off, r * chunk), min(row_off + height, (r+1) * chunk)
+        for c in range(col_off // chunk, (col_off + width - 1) // chunk + 1):
+            x0, x1 = max(col_off, c * chunk), min(col_off + width, (c+1) * chunk)
+            out[..., y0-row_off:y1-row_off, x0-col_off:x1-col_off] = array[
+                r, c, ..., y0-r*chunk:y1-r*chunk, x0-c*chunk:x1-c*chunk
+            ]
+
+    return out
+
+
+class ChipDs(torch.utils.data.Dataset):
+    """
+    Serves crops of one tile of a chip store built by utils/build_chip_store.py,
+    with the same outputs as RasterDs. Tiles are memory-mapped: images are
+    already normalized and labels already merged, so a sample costs a copy
+    and a rescaling.
+    """
+
+    def __init__(
+        self,
+        store_path,
+        tile_idx,
+        crop_size,
+        img_aug=None,
+        fixed_crops=False,
+        crop_step=None,
+        raw_transport=False
+    ):
+
+        self.store_path = Path(store_path)
+        with open(self.store_path / 'index.json') as f:
+            index = json.load(f)
+        self.chunk = index['chunk']
+        self.labels = index['labels']
+        self.scale = store_dtypes[index['dtype']][1]
+        self.info = index['tiles'][tile_idx]
+        self.image_path = self.info['image_path']
+        self.crop_size = crop_size
+        self.raw_transport = raw_transport
+        self.imagenet = False
+        if raw_transport:
+            img_aug, self.imagenet = split_raw_transforms(img_aug)
+        self.img_aug = get_transforms(img_aug)
+        # Crops are in the coordinates of the tile in its source raster, as for
+        # RasterDs, so that windows of both datasets can be compared
+        self.tile = Window(*self.info['tile'])
+        self.crop_windows = get_tiles_array(
+            nols=self.tile.width,
+            nrows=self.tile.height,
+            size=crop_size,
+            step=crop_step if crop_step else crop_size,
+            row_offset=self.tile.row_off,
+            col_offset=self.tile.col_off) if fixed_crops else None
+        self.labels_to_rgb = LabelsToRGB(self.labels)
+        self._arrays = None
+        self.minmax = None
+
+    @property
+    def arrays(self):
+
+        # Opened lazily in each worker, memory maps are not sent to workers
+        if self._arrays is None:
+            image = np.load(self.store_path / self.info['image'], mmap_mode='r')
+            label = None
+            if self.info['label']:
+                label = np.load(self.store_path / self.info['label'], mmap_mode='r')
+            self._arrays = (image, label)
+        return self._arrays
+
+    def __getstate__(self):
+
+        state = self.__dict__.copy()
+        state['_arrays'] = None
+        return state
+
+    def __len__(self):
+
+        return len(self.crop_windows) if self.crop_windows is not None else 1
+
+    def __getitem__(self, idx):
+
+        if self.crop_windows is not None:
+            window = Window(*self.crop_windows[idx].tolist())
+        else:
+            cx = self.tile.col_off + np.random.randint(0, self.tile.width - self.crop_size + 1)
+            cy = self.tile.row_off + np.random.randint(0, self.tile.height - self.crop_size + 1)
+            window = Window(cx, cy, self.crop_size, self.crop_size)
+
+        chunk_window = (
+            int(window.col_off - self.tile.col_off),
+            int(window.row_off - self.tile.row_off),
+            int(window.width),
+            int(window.height)
+        )
+        image_array, label_array = self.arrays
+        image = read_chunked(image_array, chunk_window, self.chunk)
+        if self.raw_transport:
+            # Stored images are already quantized from [0, 1]
+            if self.minmax is None:
+                self.minmax = torch.tensor([[0., self.scale]] * image.shape[0])
+            image, raw_dtype = to_transport_dtype(image)
+            image = torch.from_numpy(image).contiguous()
+        else:
+            image = torch.from_numpy(image.astype(np.float32) / self.scale).contiguous()
+
+        label = None
+        if label_array is not None:
+            label = read_chunked(label_array, chunk_window, self.chunk)
+            label = torch.from_numpy(label).long().contiguous()
+
+        if self.img_aug is not None:
+            end_image, end_mask = self.img_aug(img=image, label=label)
+        else:
+            end_image, end_mask = image, label
+
+        sample = {
+            'orig_image':image,
+            'orig_mask':label,
+            'image':end_image,
+            'window':window_array(window),
+            'mask':end_mask,
+            'path': self.image_path
+        }
+        if self.raw_transport:
+            sample['minmax'] = self.minmax
+            sample['raw'] = {'dtype': raw_dtype, 'imagenet': self.imagenet}
+
+        return sample
+
+
+def read_chip_store(
+    store_path,
+    folds,
+    fixed_crops,
+    crop_size,
+    img_aug,
+    raw_transport=False
+):
+
+    with open(Path(store_path) / 'index.json') as f:
+        tiles = json.load(f)['tiles']
+
+    return [
+        ChipDs(
+            store_path=store_path,
+            tile_idx=i,
+            crop_size=crop_size,
+            img_aug=img_aug,
+            fixed_crops=fixed_crops,
+            raw_transport=raw_transport
+        ) for i, tile in enumerate(tiles) if tile['fold'] in folds
+    ]
@@ -0,0 +1,122 @@
+import numpy as np
+from torch.utils.data import ConcatDataset, Sampler
+
+
+# One planned training sample: dataset in the ConcatDataset, top left corner
+# of the crop and seed of its scale, subcrops and augmentations
+plan_dtype = np.dtype([
+    ('dataset', np.int32),
+    ('col', np.int32),
+    ('row', np.int32),
+    ('seed', np.uint32)
+])
+
+
+class PlannedConcatDataset(ConcatDataset):
+    """
+    ConcatDataset also accepting the (dataset, col, row, seed) samples of a
+    CropPlanSampler, passed on as (col, row, seed) to the dataset.
+    """
+
+    def __getitem__(self, idx):
+
+        if isinstance(idx, tuple):
+            ds_idx, col, row, seed = idx
+            return self.datasets[ds_idx][(col, row, seed)]
+
+        return super().__getitem__(idx)
+
+
+class CropPlanSampler(Sampler):
+    """
+    Sampler of random training crops whose whole epoch, datasets, crop
+    positions and augmentation seeds, is drawn from (seed, epoch) at the
+    start of the epoch: runs with the same seed read the same samples, and
+    a run resumed from a checkpoint continues its epoch where it stopped.
+
+    :param dataset: PlannedConcatDataset of random-crop RasterDs.
+    :param weights: probabilities of the datasets, uniform if None.
+    :param epoch_fn: returns the current epoch, e.g. from the trainer;
+        epochs are counted by iterations over the sampler if None.
+    """
+
+    def __init__(self, dataset, num_samples, seed=0, weights=None, epoch_fn=None):
+
+        self.datasets = dataset.datasets
+        self.num_samples = num_samples
+        self.seed = seed
+        self.weights = None
+        if weights is not None:
+            weights = np.asarray(weights, dtype=np.float64)
+            self.weights = weights / weights.sum()
+        self.epoch_fn = epoch_fn
+        self.epoch = 0
+        self.start = 0
+        # Epoch and position of a checkpoint, applied when that epoch starts
+        self.resume = None
+
+    def plan(self, epoch):
+        """
+        Samples of an epoch, as a plan_dtype array.
+        """
+        rng = np.random.RandomState([self.seed, epoch])
+        plan = np.empty(self.num_samples, dtype=plan_dtype)
+        if self.weights is None:
+            plan['dataset'] = rng.randint(len(self.datasets), size=self.num_samples)
+        else:
+            plan['dataset'] = rng.choice(len(self.datasets), size=self.num_samples, p=self.weights)
+        plan['seed'] = rng.randint(0, 2**32, size=self.num_samples, dtype=np.uint32)
+        for ds_idx in np.unique(plan['dataset']):
+            where = plan['dataset'] == ds_idx
+            plan['col'][where], plan['row'][where] = self.datasets[ds_idx].plan_crops(
+                int(where.sum()), rng
+            )
+
+        return plan
+
+    def start_epoch(self):
+
+        if self.epoch_fn is not None:
+            self.epoch = self.epoch_fn()
+        self.start = 0
+        if self.resume is not None:
+            epoch, position = self.resume
+            if epoch == self.epoch:
+                self.start = min(position, self.num_samples)
+            self.resume = None
+
+    def __iter__(self):
+
+        self.start_epoch()
+        plan = self.plan(self.epoch)[self.start:]
+        if self.epoch_fn is None:
+            self.epoch += 1
+
+        return iter(plan.tolist())
+
+    def __len__(self):
+
+        # Constant even when resuming: the trainer restores its count of the
+        # batches done in the epoch and stops after the remaining ones
+        return self.num_samples
+
+    def state_dict(self, consumed):
+        """
+        State after consumed samples of the current epoch, counted from its
+        start, including those before a resumption (as the trainer's batch
+        count is).
+        """
+        epoch = self.epoch if self.epoch_fn is not None else max(self.epoch - 1, 0)
+
+        return {
+            'seed': self.seed,
+            'epoch': epoch,
+            'position': consumed
+        }
+
+    def load_state_dict(self, state):
+
+        self.seed = state['seed']
+        self.resume = (state['epoch'], state['position'])
+        if self.epoch_fn is None:
+            self.epoch = state['epoch']
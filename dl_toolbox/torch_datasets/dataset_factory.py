@@ -3,6 +3,7 @@ from dl_toolbox.torch_datasets import *
 
 datasets = {
     'Resisc': ResiscDs,
+    'ResiscShards': ShardDs,
     'DigitanieV2': DigitanieV2,
     #'DigitanieToulouse': DigitanieToulouseDs,
     #'DigitanieBiarritz': DigitanieBiarritzDs,
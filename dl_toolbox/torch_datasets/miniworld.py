@@ -1,8 +1,5 @@
-import torch
-import rasterio
 import numpy as np
 
-from dl_toolbox.utils import minmax
 from dl_toolbox.torch_datasets import RasterDs
 
 
@@ -17,26 +14,16 @@ labels_dict = {
 
 class Miniworld(RasterDs):
 
+    bands = (1, 2, 3)
+
     def __init__(self, labels, *args, **kwargs):
  
         self.labels = labels_dict[labels]
         super().__init__(*args, **kwargs)
 
-    def read_image(self, image_path, window):
-        
-        with rasterio.open(image_path) as image_file:
-            image = image_file.read(window=window, out_dtype=np.float32)
-            
-        mins = np.array([stat.min for stat in self.info['stats']])
-        maxs = np.array([stat.max for stat in self.info['stats']])
-        image = minmax(image[:3], mins[:3], maxs[:3])
-
-        return image
-
-    def read_label(self, label_path, window):
+    def read_label(self, label_path, window, out_shape=None):
     
-        with rasterio.open(label_path) as label_file:
-            label = label_file.read(window=window, out_dtype=np.float32)
+        label = self.read_window(label_path, window, out_dtype=np.float32, out_shape=out_shape)
             
         label = np.squeeze(label) / 255
         
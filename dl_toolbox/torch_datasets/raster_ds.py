@@ -4,15 +4,25 @@ import imagesize
 import numpy as np
 
 from rasterio.windows import Window
+from rasterio.enums import Resampling
 from argparse import ArgumentParser 
 
-from dl_toolbox.utils import get_tiles
+from dl_toolbox.utils import get_tiles_array
 from dl_toolbox.utils import MergeLabels, OneHot, LabelsToRGB, RGBToLabels
+from dl_toolbox.utils import handle_cache as default_handle_cache
+from dl_toolbox.utils import get_stats_store, minmax
 from dl_toolbox.torch_datasets.utils import *
 
 
 class RasterDs(torch.utils.data.Dataset):
 
+    # 1-based indexes of the image bands fed to the network, in order; None
+    # reads all bands. Subclasses declare the bands of their source.
+    bands = None
+    # Resampling of labels read at another resolution; colour labels need
+    # nearest since mode would work band by band
+    label_resampling = Resampling.mode
+
     def __init__(
         self,
         image_path,
@@ -22,6 +32,18 @@ class RasterDs(torch.utils.data.Dataset):
         label_path=None,
         fixed_crops=False,
         crop_step=None,
+        handle_cache=None,
+        stats_mode='approx',
+        stats_on_tile=False,
+        stats_store=None,
+        bands=None,
+        raw_transport=False,
+        supercrop_size=None,
+        num_subcrops=1,
+        image_index=None,
+        label_index=None,
+        resolution=None,
+        block_cache=None,
         #one_hot=False,
         #*args,
         #**kwargs
@@ -30,62 +52,330 @@ class RasterDs(torch.utils.data.Dataset):
         self.image_path = image_path
         self.tile = tile
         self.crop_size = crop_size
+        # With random crops, a supercrop_size window can be read once and
+        # num_subcrops crops of crop_size cut from it on the device
+        # (torch_collate.extract_subcrops) instead of one read per crop
+        self.supercrop_size = min(supercrop_size, tile.width, tile.height) if supercrop_size else None
+        self.num_subcrops = num_subcrops
+        # In raw mode images leave the worker in their native dtype and are
+        # normalized on the device (augmentations.normalize_raw_batch): only
+        # geometric transforms can be applied before.
+        self.raw_transport = raw_transport
+        self.imagenet = False
+        if raw_transport:
+            img_aug, self.imagenet = split_raw_transforms(img_aug)
         self.img_aug = get_transforms(img_aug)
-        self.info = self.init_stats()
+        # Supercrops are not augmented in the worker but each of their crops,
+        # on the device (torch_collate.extract_subcrops)
+        self.subcrop_aug = img_aug if self.supercrop_size else None
+        self.handle_cache = handle_cache if handle_cache is not None else default_handle_cache
+        # Spatial indexes (utils.RasterIndex) over the image and label rasters
+        # of the dataset: windows are then read across raster boundaries
+        self.image_index = image_index
+        self.label_index = label_index
+        # Decoded blocks shared between workers (utils.SharedBlockCache)
+        self.block_cache = block_cache
+        # Target ground resolution in CRS units per pixel, or (low, high) to
+        # draw it for each random crop: crops are read with out_shape, hence
+        # from the overviews of the rasters when coarser than the source
+        self.resolution = resolution
+        self.native_res = None
+        if resolution is not None:
+            self.native_res = abs(self.handle_cache.open(image_path).res[0])
+        self.stats_mode = stats_mode
+        self.stats_window = tile if stats_on_tile else None
+        self.info = self.init_stats(stats_store)
+        bands = bands if bands is not None else self.bands
+        self.bands = list(bands) if bands is not None else None
+        # Only the selected bands are read, min and max are sliced once here
+        stats = self.info['stats']
+        if self.bands is not None:
+            stats = [stats[i-1] for i in self.bands]
+        self.mins = np.array([stat.min for stat in stats], dtype=np.float32)
+        self.maxs = np.array([stat.max for stat in stats], dtype=np.float32)
+        self.minmax = torch.from_numpy(np.stack([self.mins, self.maxs], axis=1))
         self.label_path = label_path
-        self.crop_windows = list(get_tiles(
+        # Set by set_class_sampling for class-balanced random crops
+        self.cell_cdf = None
+        # Set by set_valid_mask to avoid crops of nodata pixels
+        self.valid_mask = None
+        self.min_valid = 0.
+        self.max_tries = 1
+        self.skipped = 0.
+        # Fixed crops are read at the middle of the resolution range
+        fixed_size = self.source_size(crop_size, self.sample_scale(random=False))
+        # (N, 4) int32 array of (col_off, row_off, width, height)
+        self.crop_windows = get_tiles_array(
             nols=tile.width, 
             nrows=tile.height, 
-            size=crop_size, 
-            step=crop_step if crop_step else crop_size,
+            size=fixed_size, 
+            step=crop_step if crop_step else fixed_size,
             row_offset=tile.row_off, 
-            col_offset=tile.col_off)) if fixed_crops else None
+            col_offset=tile.col_off) if fixed_crops else None
         #self.one_hot = OneHot(list(range(len(self.labels)))) if one_hot else None
         self.labels_to_rgb = LabelsToRGB(self.labels)
         self.rgb_to_labels = RGBToLabels(self.labels)
     
-    def init_stats(self):
+    def init_stats(self, stats_store=None):
         
-        with rasterio.open(self.image_path) as f:
-            infos = {}
-            # technically we should not compute stats on the whole image if the dataset is built only on a subtile
-            infos['stats'] = [f.statistics(bidx=i, approx=True) for i in range(1, f.count+1)]
-            infos['shape'] = f.shape
+        # Stats are computed once per raster (or per tile with stats_on_tile)
+        # and mode, then read back from the store
+        store = stats_store if stats_store is not None else get_stats_store()
+        infos = store.stats(
+            self.image_path,
+            window=self.stats_window,
+            mode=self.stats_mode
+        )
         
         return infos        
 
+    def read_window(self, path, window, indexes=None, out_dtype=None, out_shape=None):
+        """
+        Reads a window of path, in the pixel grid of path, either from path
+        alone or through the spatial index containing path, resampled to
+        out_shape (height, width) if given.
+        """
+        is_label = path == self.label_path
+        if is_label and out_shape is not None:
+            # Labels are read at full resolution and resampled here: GDAL
+            # would serve coarser reads from overviews, whose resampling
+            # (often averaging) was set when they were built
+            label = self.read_window(path, window, indexes, out_dtype)
+            return resample_labels(label, out_shape, self.label_resampling)
+        resampling = self.label_resampling if is_label else Resampling.bilinear
+        index = self.label_index if is_label else self.image_index
+        if index is None:
+            raster = self.handle_cache.open(path)
+            if self.block_cache is not None and out_shape is None:
+                data = self.block_cache.read(raster, path, window, indexes)
+                return data.astype(out_dtype, copy=False) if out_dtype else data
+            return raster.read(
+                indexes=indexes,
+                window=window,
+                out_dtype=out_dtype,
+                out_shape=out_shape,
+                resampling=resampling
+            )
+
+        return index.read(
+            index.window_bounds(path, window),
+            out_shape if out_shape else (int(window.height), int(window.width)),
+            indexes=indexes,
+            out_dtype=out_dtype,
+            resampling=resampling
+        )
+
+    def read_image(self, image_path, window, out_shape=None):
+
+        image = self.read_window(
+            image_path,
+            window,
+            indexes=self.bands,
+            out_dtype=np.float32,
+            out_shape=out_shape
+        )
+        image = minmax(image, self.mins, self.maxs)
+
+        return image
+
+    def read_raw(self, image_path, window, out_shape=None):
+
+        return self.read_window(image_path, window, indexes=self.bands, out_shape=out_shape)
+
+    def sample_scale(self, random=True, rng=np.random):
+
+        # Source pixels per output pixel
+        if self.resolution is None:
+            return 1.
+        if np.isscalar(self.resolution):
+            return self.resolution / self.native_res
+        low, high = self.resolution
+        res = rng.uniform(low, high) if random else (low + high) / 2
+
+        return res / self.native_res
+
+    def source_size(self, size, scale):
+
+        return min(int(round(size * scale)), int(self.tile.width), int(self.tile.height))
+
+    def set_class_sampling(self, class_grid, cell_size, class_weights):
+        """
+        Draws the random crops from the cells of the class grid of the tile
+        (utils.compute_class_grid) with probabilities given by their weighted
+        label counts. Returns the total weight of the tile.
+        """
+        weights = class_grid.reshape(-1, class_grid.shape[-1]) @ class_weights
+        self.cell_size = cell_size
+        self.grid_cols = class_grid.shape[1]
+        self.cell_cdf = np.cumsum(weights) if weights.sum() > 0 else None
+
+        return float(weights.sum())
+
+    def crop_offsets(self, size, n=1, rng=np.random):
+        """
+        Offsets (cols, rows) in the tile of n random size x size crops, drawn
+        with rng, np.random or a RandomState.
+        """
+        width, height = int(self.tile.width), int(self.tile.height)
+        if self.cell_cdf is None:
+            cx = rng.randint(0, width - size + 1, size=n)
+            cy = rng.randint(0, height - size + 1, size=n)
+        else:
+            # A pixel of the drawn cell, then a crop containing this pixel
+            cells = np.searchsorted(self.cell_cdf, rng.random_sample(n) * self.cell_cdf[-1], side='right')
+            r, c = np.divmod(cells, self.grid_cols)
+            cell_h = np.minimum(self.cell_size, height - r * self.cell_size)
+            cell_w = np.minimum(self.cell_size, width - c * self.cell_size)
+            y = r * self.cell_size + (rng.random_sample(n) * cell_h).astype(int)
+            x = c * self.cell_size + (rng.random_sample(n) * cell_w).astype(int)
+            cy = np.clip(y - rng.randint(size, size=n), 0, height - size)
+            cx = np.clip(x - rng.randint(size, size=n), 0, width - size)
+
+        return cx, cy
+
+    def set_valid_mask(self, valid_mask, min_valid=0.5, max_tries=10):
+        """
+        Random crops with a valid fraction below min_valid in the valid mask
+        (utils.ValidMask) of the image are drawn again, up to max_tries
+        times; fixed crops without valid pixels are skipped. Returns the
+        number of valid pixels of the tile.
+        """
+        self.valid_mask = valid_mask
+        self.min_valid = min_valid
+        self.max_tries = max_tries
+        if self.crop_windows is not None:
+            keep = valid_mask.fractions(self.crop_windows) > 0
+            self.skipped = 1. - keep.mean() if len(keep) else 0.
+            self.crop_windows = self.crop_windows[keep]
+
+        return valid_mask.fraction(self.tile) * int(self.tile.width) * int(self.tile.height)
+
+    def valid_offsets(self, size, n=1, rng=np.random):
+
+        # Offsets of crop_offsets, invalid crops being drawn again
+        cx, cy = self.crop_offsets(size, n, rng)
+        if self.valid_mask is None:
+            return cx, cy
+        for _ in range(self.max_tries - 1):
+            windows = np.stack([
+                self.tile.col_off + cx, self.tile.row_off + cy, np.full(n, size), np.full(n, size)
+            ], axis=1)
+            invalid = np.flatnonzero(self.valid_mask.fractions(windows) < self.min_valid)
+            if not len(invalid):
+                break
+            cx[invalid], cy[invalid] = self.crop_offsets(size, len(invalid), rng)
+
+        return cx, cy
+
+    def sample_window(self, size, rng=np.random):
+
+        cx, cy = self.valid_offsets(size, rng=rng)
+
+        return Window(self.tile.col_off + int(cx[0]), self.tile.row_off + int(cy[0]), size, size)
+
+    def plan_crops(self, n, rng):
+        """
+        Top left corners (col_off, row_off) of n random crops, for a crop plan
+        (torch_datasets.CropPlanSampler). They are drawn for the smallest
+        crops in source pixels, larger ones being moved back into the tile.
+        """
+        scale = self.sample_scale(random=False)
+        if self.resolution is not None and not np.isscalar(self.resolution):
+            scale = min(self.resolution) / self.native_res
+        size = self.source_size(self.supercrop_size or self.crop_size, scale)
+        cx, cy = self.valid_offsets(size, n, rng)
+
+        return self.tile.col_off + cx, self.tile.row_off + cy
+
+    def planned_window(self, col_off, row_off, size):
+
+        col_off = min(col_off, self.tile.col_off + self.tile.width - size)
+        row_off = min(row_off, self.tile.row_off + self.tile.height - size)
+
+        return Window(col_off, row_off, size, size)
+
+    def sample_subcrops(self, rng=np.random):
+
+        # Offsets (row, col) of the crops in the supercrop, and crop size
+        offsets = rng.randint(
+            0,
+            self.supercrop_size - self.crop_size + 1,
+            size=(self.num_subcrops, 2)
+        )
+        sizes = np.full((self.num_subcrops, 1), self.crop_size)
+
+        return torch.from_numpy(np.concatenate([offsets, sizes], axis=1))
+
     def __len__(self):
 
-        return len(self.crop_windows) if self.crop_windows else 1 # Attention 1 ou la taille du dataset pour le concat
+        return len(self.crop_windows) if self.crop_windows is not None else 1 # Attention 1 ou la taille du dataset pour le concat
 
     def __getitem__(self, idx):
         
-        if self.crop_windows:
-            window = self.crop_windows[idx]
+        # A planned crop is given as (col_off, row_off, seed): scale, subcrops
+        # and augmentations are then drawn from seed
+        planned = isinstance(idx, tuple)
+        rng = np.random.RandomState(idx[2]) if planned else np.random
+        subcrops = None
+        size = self.crop_size
+        if self.crop_windows is not None:
+            window = Window(*self.crop_windows[idx].tolist())
         else:
-            cx = self.tile.col_off + np.random.randint(0, self.tile.width - self.crop_size + 1)
-            cy = self.tile.row_off + np.random.randint(0, self.tile.height - self.crop_size + 1)
-            window = Window(cx, cy, self.crop_size, self.crop_size)
+            if self.supercrop_size:
+                size = self.supercrop_size
+            source = self.source_size(size, self.sample_scale(rng=rng))
+            if planned:
+                window = self.planned_window(idx[0], idx[1], source)
+            else:
+                window = self.sample_window(source)
+            if self.supercrop_size:
+                subcrops = self.sample_subcrops(rng)
+        out_shape = (size, size) if self.resolution is not None else None
             
-        image = self.read_image(self.image_path, window)
-        image = torch.from_numpy(image).float().contiguous()
+        if self.raw_transport:
+            image = self.read_raw(self.image_path, window, out_shape)
+            image, raw_dtype = to_transport_dtype(image)
+            image = torch.from_numpy(image).contiguous()
+        else:
+            image = self.read_image(self.image_path, window, out_shape)
+            image = torch.from_numpy(image).float().contiguous()
 
         label = None
         if self.label_path:
-            label = self.read_label(self.label_path, window)
+            label = self.read_label(self.label_path, window, out_shape)
             #if self.one_hot: label = self.one_hot(label)
             label = torch.from_numpy(label).long().contiguous()
 
-        if self.img_aug is not None:
+        if subcrops is not None:
+            end_image, end_mask = image, label
+        elif self.img_aug is not None and planned:
+            # Own generator, not the global ones: threads of the threaded
+            # loader augment samples concurrently
+            generator = torch.Generator().manual_seed(int(idx[2]))
+            end_image, end_mask = self.img_aug(img=image, label=label, generator=generator)
+        elif self.img_aug is not None:
             end_image, end_mask = self.img_aug(img=image, label=label)
         else:
             end_image, end_mask = image, label
 
-        return {
+        sample = {
             'orig_image':image,
             'orig_mask':label,
             'image':end_image,
-            'window':window,
+            'window':window_array(window),
             'mask':end_mask,
             'path': self.image_path
-        }
\ No newline at end of file
+        }
+        if self.raw_transport:
+            sample['minmax'] = self.minmax
+            sample['raw'] = {'dtype': raw_dtype, 'imagenet': self.imagenet}
+        if subcrops is not None:
+            sample['subcrops'] = subcrops
+            # Source pixels of the window per pixel of the subcrops
+            sample['scale'] = torch.tensor(window.width / size, dtype=torch.float32)
+            if self.subcrop_aug:
+                sample['subcrop_aug'] = self.subcrop_aug
+            if planned:
+                sample['seed'] = torch.tensor(int(idx[2]), dtype=torch.int64)
+
+        return sample
\ No newline at end of file
@@ -4,7 +4,13 @@ from argparse import ArgumentParser
 from PIL import Image
 from dl_toolbox.torch_datasets.utils import *
 import matplotlib.pyplot as plt
+import io
 import os
+import json
+import hashlib
+import shutil
+import tempfile
+from pathlib import Path
 import torch
 
 from dl_toolbox.utils import MergeLabels, OneHot
@@ -70,20 +76,143 @@ def pil_to_torch_loader(path: str):
         img = torch.from_numpy(img).permute(2,0,1).float() / 255.
         return img
 
-class ResiscDs(DatasetFolder):
+def resize_uint8(img, size):
 
-    def __init__(
-        self,
-        data_path,
-        img_aug,
-    ):
-        super().__init__(
-            root=data_path,
-            loader=pil_to_torch_loader,
-            extensions=('jpg',)
-        )
+    # (3,H,W) uint8 image resized to (3,size,size), averaging when reducing
+    if tuple(img.shape[1:]) == (size, size):
+        return img
+    mode = 'area' if img.shape[1] > size and img.shape[2] > size else 'bilinear'
+    img = torch.nn.functional.interpolate(
+        img[None].float(), size=(size, size), mode=mode, align_corners=False if mode == 'bilinear' else None
+    )
+    return img[0].round().clamp(0, 255).to(torch.uint8)
+
+def pil_decode(source, size=None):
+
+    # source is a path or the bytes of the file
+    img = Image.open(io.BytesIO(source) if isinstance(source, bytes) else source)
+    if size is not None:
+        # JPEG DCT scaling: decodes directly at 1/2, 1/4 or 1/8 of the size
+        # when it is still at least size, the rest is resized
+        img.draft('RGB', (size, size))
+        img = img.convert('RGB')
+        if img.size != (size, size):
+            img = img.resize((size, size), Image.BILINEAR)
+    img = np.asarray(img.convert('RGB'))
+    return torch.from_numpy(img).permute(2,0,1).contiguous()
+
+def torchvision_decode(source, size=None):
+
+    from torchvision.io import read_file, decode_jpeg, ImageReadMode
+    if isinstance(source, bytes):
+        data = torch.frombuffer(bytearray(source), dtype=torch.uint8)
+    else:
+        data = read_file(str(source))
+    img = decode_jpeg(data, mode=ImageReadMode.RGB)
+    return resize_uint8(img, size) if size is not None else img
+
+# Decoders of JPEG files to (3,H,W) uint8 tensors, (3,size,size) if size is given
+decoders = {
+    'pil': pil_decode,
+    'torchvision': torchvision_decode
+}
+
+class DecodedImagesDs(Dataset):
+    """
+    Dataset of the JPEG images of its (path, class) samples, read with
+    source(idx) and decoded by one of decoders, possibly through a cache of
+    decoded images. Subclasses list samples and classes, then call
+    init_decoding.
+    """
+
+    def init_decoding(self, img_aug, decoder, decode_size, cache_path, image_size, raw_transport):
+
+        self.decoder = decoder
+        self.decode = decoders[decoder]
+        self.decode_size = decode_size
+        # uint8 images go to the device and are converted there, as raw
+        # transport raster images (augmentations.normalize_raw_batch)
+        self.raw_transport = raw_transport
+        self.imagenet = False
+        if raw_transport:
+            img_aug, self.imagenet = split_raw_transforms(img_aug)
         self.img_aug = get_transforms(img_aug)
         self.class_names = self.classes
+        self.minmax = torch.tensor([[0., 255.]] * 3)
+        self.image_size = decode_size if decode_size else image_size
+        self.cache_path = Path(cache_path) if cache_path else None
+        self._cache = None
+        if self.cache_path:
+            self.init_cache()
+
+    def init_cache(self):
+        """
+        Decoded images are kept across epochs in a memory-mapped (N,3,S,S)
+        uint8 array, filled by the workers as they decode: later epochs do not
+        decode JPEGs anymore. Images are decoded and resized to S, the
+        image_size. Each set of files, image size and decoder has its own
+        cache directory, named by a hash of them.
+        """
+        paths = [path for path, _ in self.samples]
+        index = json.dumps({'paths': paths, 'image_size': self.image_size, 'decoder': self.decoder})
+        self.cache_dir = self.cache_path / hashlib.sha1(index.encode()).hexdigest()[:16]
+        if self.cache_dir.exists():
+            return
+        # Built in a temporary directory renamed into place: processes (e.g.
+        # DDP ranks) building it at the same time never truncate arrays
+        # another one is filling, the first rename wins
+        self.cache_path.mkdir(parents=True, exist_ok=True)
+        tmp_dir = Path(tempfile.mkdtemp(dir=self.cache_path))
+        S = self.image_size
+        np.lib.format.open_memmap(
+            tmp_dir / 'images.npy', mode='w+', dtype=np.uint8, shape=(len(paths), 3, S, S)
+        ).flush()
+        np.save(tmp_dir / 'filled.npy', np.zeros(len(paths), dtype=np.uint8))
+        with open(tmp_dir / 'index.json', 'w') as f:
+            f.write(index)
+        try:
+            os.rename(tmp_dir, self.cache_dir)
+        except OSError:
+            shutil.rmtree(tmp_dir)
+
+    @property
+    def cache(self):
+
+        # Opened lazily in each worker, memory maps are not sent to workers
+        if self._cache is None:
+            self._cache = (
+                np.load(self.cache_dir / 'images.npy', mmap_mode='r+'),
+                np.load(self.cache_dir / 'filled.npy', mmap_mode='r+')
+            )
+        return self._cache
+
+    def __getstate__(self):
+
+        state = self.__dict__.copy()
+        state['_cache'] = None
+        return state
+
+    def __len__(self):
+
+        return len(self.samples)
+
+    def source(self, idx):
+
+        # What the decoder reads sample idx from
+        return self.samples[idx][0]
+
+    def read_image(self, idx):
+
+        if self.cache_path is None:
+            return self.decode(self.source(idx), self.decode_size)
+        images, filled = self.cache
+        if filled[idx]:
+            return torch.from_numpy(np.array(images[idx]))
+        # Decoded at the size of the cache, whatever the size of the file
+        image = self.decode(self.source(idx), self.image_size)
+        images[idx] = image.numpy()
+        filled[idx] = 1
+        return image
 
     @classmethod
     def add_model_specific_args(cls, parent_parser):
@@ -97,15 +226,42 @@ class ResiscDs(DatasetFolder):
     def __getitem__(self, idx):
 
         path, label = self.samples[idx]
-        image = self.loader(path)
+        image = self.read_image(idx)
+        if not self.raw_transport:
+            image = image.float() / 255.
         end_image, _ = self.img_aug(img=image)
 
-        return {
+        sample = {
             'orig_image': image,
             'image': end_image,
             'mask': torch.tensor(label),
             'path': path
         }
+        if self.raw_transport:
+            sample['minmax'] = self.minmax
+            sample['raw'] = {'dtype': 'uint8', 'imagenet': self.imagenet}
+
+        return sample
+
+class ResiscDs(DecodedImagesDs, DatasetFolder):
+
+    def __init__(
+        self,
+        data_path,
+        img_aug,
+        decoder='pil',
+        decode_size=None,
+        cache_path=None,
+        image_size=256,
+        raw_transport=False
+    ):
+        DatasetFolder.__init__(
+            self,
+            root=data_path,
+            loader=pil_to_torch_loader,
+            extensions=('jpg',)
+        )
+        self.init_decoding(img_aug, decoder, decode_size, cache_path, image_size, raw_transport)
 
 
 
@@ -1,8 +1,9 @@
-import torch
-import rasterio
+from functools import lru_cache
+
 import numpy as np
+from rasterio.enums import Resampling
 
-from dl_toolbox.utils import minmax, MergeLabels
+from dl_toolbox.utils import MergeLabels, LabelCodec
 from dl_toolbox.torch_datasets import RasterDs
 
 
@@ -38,8 +39,22 @@ mergers = {
     'building' : [[0,1,4,3,5,6,7],[2]]
 }
 
+@lru_cache()
+def semcity_codec(labels):
+
+    # Colours of the BDSD ground truth are decoded and merged in one lookup
+    return LabelCodec(
+        semcity_labels['base'],
+        merger=mergers[labels],
+        merged_labels=semcity_labels[labels]
+    )
+
+
 class SemcityBdsdDs(RasterDs):
 
+    bands = (4, 3, 2)
+    label_resampling = Resampling.nearest
+
     #stats = {
     #    'min': np.array([0, 0, 0, 0, 0, 0, 0, 0]),
     #    'max': np.array([2902,4174,4726,5196,4569,4653,5709,3939])
@@ -50,31 +65,17 @@ class SemcityBdsdDs(RasterDs):
         self.labels = semcity_labels[labels]
         super().__init__(*args, **kwargs)
         self.label_merger = MergeLabels(mergers[labels])
+        self.label_scheme = labels
 
-    def read_image(self, image_path, window):
-
-        with rasterio.open(image_path) as image_file:
-            image = image_file.read(window=window, out_dtype=np.float32)
-            
-        mins = np.array([stat.min for stat in self.info['stats']])
-        maxs = np.array([stat.max for stat in self.info['stats']])
-        image = minmax(image[[3,2,1]], mins[[3,2,1]], maxs[[3,2,1]])
+    @property
+    def label_codec(self):
 
-        return image
+        # One codec per label scheme and process, shared by all tiles
+        return semcity_codec(self.label_scheme)
 
-    def read_label(self, label_path, window):
+    def read_label(self, label_path, window, out_shape=None):
  
-        with rasterio.open(label_path) as label_file:
-            rgb = label_file.read(window=window, out_dtype=np.float32)
-            
-        rgb = rgb.transpose((1,2,0))
-        labels = np.zeros(shape=rgb.shape[:-1], dtype=np.uint8)
-        for label, key in enumerate(semcity_labels['base']):
-            c = semcity_labels['base'][key]['color']
-            d = rgb[..., 0] == c[0]
-            d = np.logical_and(d, (rgb[..., 1] == c[1]))
-            d = np.logical_and(d, (rgb[..., 2] == c[2]))
-            labels[d] = label
-        label = self.label_merger(labels)
-
-        return label
\ No newline at end of file
+        rgb = self.read_window(label_path, window, out_dtype=np.uint8, out_shape=out_shape)
+        label = self.label_codec.from_rgb(rgb, channels_first=True)
+
+        return label
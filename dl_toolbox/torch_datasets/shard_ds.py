@@ -0,0 +1,77 @@
+import os
+import json
+from pathlib import Path
+
+import numpy as np
+
+from dl_toolbox.torch_datasets.resisc import DecodedImagesDs
+
+
+# One entry per sample of a shard store, in the order of the source folder
+index_dtype = np.dtype([
+    ('shard', np.int32),
+    ('offset', np.int64),
+    ('length', np.int64),
+    ('label', np.int32)
+])
+
+
+class ShardDs(DecodedImagesDs):
+    """
+    Folder dataset packed by utils/pack_shards.py into a few large shard files
+    with an index of (shard, offset, length, class) per sample: building it
+    reads the index only, and a sample is one positioned read in an open
+    shard. Samples keep the order of the folder, so Subset indices of
+    ResiscDs apply unchanged; decoding options are those of ResiscDs.
+    Shards stay open until close() or the dataset is collected.
+    """
+
+    def __init__(
+        self,
+        data_path,
+        img_aug,
+        decoder='pil',
+        decode_size=None,
+        cache_path=None,
+        image_size=256,
+        raw_transport=False
+    ):
+
+        self.root = Path(data_path)
+        with open(self.root / 'index.json') as f:
+            meta = json.load(f)
+        self.index = np.load(self.root / 'index.npy')
+        self.shards = meta['shards']
+        self.classes = meta['classes']
+        self.class_to_idx = {name: i for i, name in enumerate(self.classes)}
+        self.samples = list(zip(meta['paths'], self.index['label'].tolist()))
+        self.targets = [label for _, label in self.samples]
+        self._files = {}
+        self.init_decoding(img_aug, decoder, decode_size, cache_path, image_size, raw_transport)
+
+    def __getstate__(self):
+
+        state = super().__getstate__()
+        state['_files'] = {}
+        return state
+
+    def source(self, idx):
+
+        shard, offset, length, _ = self.index[idx]
+        fd = self._files.get(shard)
+        if fd is None:
+            # Opened lazily in each worker and kept open
+            fd = os.open(self.root / self.shards[shard], os.O_RDONLY)
+            self._files[shard] = fd
+
+        return os.pread(fd, int(length), int(offset))
+
+    def close(self):
+
+        for fd in self._files.values():
+            os.close(fd)
+        self._files = {}
+
+    def __del__(self):
+
+        self.close()
@@ -0,0 +1,129 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+from torch.utils.data import BatchSampler, SequentialSampler
+
+from dl_toolbox.torch_collate.buffered import BufferedCollate
+
+
+class ThreadedLoader:
+    """
+    Batch iterator reading the samples of a batch concurrently with a pool of
+    threads in the main process, as an alternative to DataLoader worker
+    processes: GDAL releases the GIL while reading and decoding, and samples
+    are not pickled between processes.
+
+    Each sample is copied by its thread into a ring of prefetch + 2 batch
+    buffers, allocated (and pinned) once at the first iteration and reused:
+    a batch must not be kept once the next ones are consumed, as when it is
+    moved to the device. All samples must have the same shapes, as with
+    default collation.
+
+    :param keys: keys copied into batches; minmax, subcrops, scale, seed and
+        window are always copied when present, as batches are processed with them.
+        orig_image and orig_mask, only used to log images, are not by default.
+    :param threads: number of reading threads.
+    :param prefetch: number of batches being read ahead of the one consumed.
+    """
+
+    def __init__(
+        self,
+        dataset,
+        batch_size,
+        sampler=None,
+        threads=4,
+        prefetch=2,
+        drop_last=False,
+        pin_memory=False,
+        keys=('image', 'mask')
+    ):
+
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.sampler = sampler if sampler is not None else SequentialSampler(dataset)
+        self.batch_sampler = BatchSampler(self.sampler, batch_size, drop_last)
+        self.threads = max(1, threads)
+        self.prefetch = max(1, prefetch)
+        self.pin_memory = pin_memory and torch.cuda.is_available()
+        self.keys = list(keys) + list(BufferedCollate.always_collated)
+        self.shapes = None
+        self.buffers = None
+        self._count = 0
+
+    def __len__(self):
+
+        return len(self.batch_sampler)
+
+    def allocate(self):
+
+        return {
+            key: torch.empty(
+                (self.batch_size, *shape),
+                dtype=dtype,
+                pin_memory=self.pin_memory
+            ) for key, (shape, dtype) in self.shapes.items()
+        }
+
+    def fill(self, batch, j, idx):
+
+        sample = self.dataset[idx]
+        for key, buffer in batch.items():
+            value = sample.get(key)
+            if value is None:
+                raise ValueError(
+                    f'Sample {idx} has no {key}, which the first sample of the dataset has'
+                )
+            if value.shape != buffer.shape[1:]:
+                raise ValueError(
+                    f'Sample {idx} has a {key} of shape {tuple(value.shape)}, '
+                    f'expected {tuple(buffer.shape[1:])}'
+                )
+            buffer[j].copy_(value)
+
+        return sample.get('path'), sample.get('raw'), sample.get('subcrop_aug')
+
+    def submit(self, pool, indices):
+
+        # The buffer of this batch was last used prefetch + 2 batches ago
+        ring = self.buffers[self._count % len(self.buffers)]
+        self._count += 1
+        batch = {key: buffer[:len(indices)] for key, buffer in ring.items()}
+        futures = [pool.submit(self.fill, batch, j, idx) for j, idx in enumerate(indices)]
+
+        return batch, futures
+
+    def finish(self, batch, futures):
+
+        infos = [future.result() for future in futures]
+        if 'mask' not in batch:
+            batch['mask'] = None
+        batch['path'] = [info[0] for info in infos if info[0] is not None]
+        if infos[0][1]:
+            batch['raw'] = infos[0][1]
+        if infos[0][2]:
+            batch['subcrop_aug'] = infos[0][2]
+
+        return batch
+
+    def __iter__(self):
+
+        indices = iter(self.batch_sampler)
+        if self.shapes is None:
+            # Keys, shapes and dtypes of batch tensors, from a first sample;
+            # not drawn from the sampler, whose iterations may have effects
+            sample = self.dataset[0]
+            self.shapes = {
+                key: (value.shape, value.dtype) for key, value in sample.items()
+                if key in self.keys and value is not None
+            }
+            self.buffers = [self.allocate() for _ in range(self.prefetch + 2)]
+
+        with ThreadPoolExecutor(max_workers=self.threads) as pool:
+            pending = deque()
+            for batch_indices in indices:
+                pending.append(self.submit(pool, batch_indices))
+                if len(pending) > self.prefetch:
+                    yield self.finish(*pending.popleft())
+            while pending:
+                yield self.finish(*pending.popleft())
@@ -1,5 +1,7 @@
 import numpy as np
 import rasterio
+from rasterio.enums import Resampling
+import torch
 #import gdal
 import dl_toolbox.augmentations as aug
 
@@ -77,3 +79,70 @@ def get_transforms(name):
     else:
         return aug.NoOp()
 
+
+
+# Transforms that only move pixels, hence usable on raw integer images
+geometric_augs = ['no', 'd4', 'hflip', 'vflip', 'd1flip', 'd2flip', 'rot90', 'rot180', 'rot270']
+
+def split_raw_transforms(name):
+    """
+    For raw transport, keeps the geometric parts of an img_aug string to be
+    applied in the worker and tells whether ImageNet normalization must be
+    done on the device.
+    """
+    if not name:
+        return name, False
+    parts = name.split('_')
+    imagenet = 'imagenet' in parts
+    parts = [part for part in parts if part != 'imagenet']
+    others = [part for part in parts if part not in geometric_augs]
+    if others:
+        raise ValueError(f'Transforms {others} cannot be applied to raw images in the workers')
+
+    return '_'.join(parts) if parts else None, imagenet
+
+def to_transport_dtype(image):
+    """
+    Torch has no uint16 tensors: uint16 images are sent as int16 views of the
+    same bytes instead of being widened, and restored on the device.
+    """
+    if image.dtype == np.uint16:
+        return image.view(np.int16), 'uint16'
+
+    return image, str(image.dtype)
+
+def resample_labels(label, out_shape, resampling=Resampling.nearest):
+    """
+    Resamples a (C, H, W) label array to out_shape (h, w), taking in each
+    output pixel the source pixel at its center (nearest) or the most
+    frequent class of the source pixels it covers (mode, on one band only:
+    several bands, as colour labels, are taken at nearest).
+    """
+    C, H, W = label.shape
+    h, w = out_shape
+    if resampling == Resampling.mode and C == 1:
+        # Source pixels grouped by output pixel, classes counted per group
+        rows = np.arange(H) * h // H
+        cols = np.arange(W) * w // W
+        cells = (rows[:, None] * w + cols[None, :]).ravel()
+        values = label[0].ravel().astype(np.int64)
+        num_values = int(values.max()) + 1 if values.size else 1
+        counts = np.bincount(cells * num_values + values, minlength=h * w * num_values)
+        mode = counts.reshape(h * w, num_values).argmax(axis=1)
+        return mode.reshape(1, h, w).astype(label.dtype)
+    if resampling not in (Resampling.mode, Resampling.nearest):
+        raise ValueError(f'Labels cannot be resampled with {resampling}')
+    rows = ((np.arange(h) + 0.5) * H / h).astype(np.int64)
+    cols = ((np.arange(w) + 0.5) * W / w).astype(np.int64)
+
+    return label[:, rows[:, None], cols[None, :]]
+
+def window_array(window):
+    """
+    Window as the int32 tensor (col_off, row_off, width, height) carried by
+    samples and collated into (B, 4) batches.
+    """
+    return torch.tensor(
+        [int(window.col_off), int(window.row_off), int(window.width), int(window.height)],
+        dtype=torch.int32
+    )
@@ -7,6 +7,7 @@ from dl_toolbox.lightning_modules import *
 from dl_toolbox.lightning_datamodules import *
 from dl_toolbox.networks import *
 from dl_toolbox.torch_datasets import *
+from dl_toolbox.callbacks import BlockCacheLogger
 
 def main():
 
@@ -52,6 +53,7 @@ def main():
         #profiler=SimpleProfiler(),
         callbacks=[
             ModelCheckpoint(),
+            BlockCacheLogger(),
             #DeviceStatsMonitor(),
         ],
         num_sanity_val_steps=0,
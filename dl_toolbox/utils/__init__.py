@@ -1,5 +1,11 @@
-from .tiles import get_tiles
+from .tiles import get_tiles, get_tiles_array
 from .worker_init_function import worker_init_function
-from .label_manipulation import MergeLabels, OneHot, RGBToLabels, LabelsToRGB, TorchOneHot
+from .label_manipulation import MergeLabels, OneHot, RGBToLabels, LabelsToRGB, TorchOneHot, LabelCodec
 from .scalar_tb_event_accumulator import EventAccumulator
 from .utils import *
+from .raster_cache import RasterHandleCache, handle_cache, open_raster
+from .raster_stats import BandStats, BandStatsStore, get_stats_store, compute_band_stats
+from .class_index import load_class_grids, compute_class_grid, class_weights
+from .spatial_index import RasterIndex
+from .block_cache import SharedBlockCache
+from .valid_mask import ValidMask, load_valid_masks, compute_valid_counts
@@ -0,0 +1,286 @@
+from argparse import ArgumentParser
+from itertools import product
+from pathlib import Path
+import json
+import pickle
+import tempfile
+import time
+
+import numpy as np
+import rasterio
+import torch
+from rasterio.transform import from_origin
+from rasterio.windows import Window
+from torch.multiprocessing.reductions import ForkingPickler
+from torch.utils.data import ConcatDataset, DataLoader, RandomSampler
+
+from dl_toolbox.torch_collate import CustomCollate
+from dl_toolbox.utils import RasterHandleCache
+from dl_toolbox.torch_datasets import DatasetFactory, ResiscDs, DecodedImagesDs
+from dl_toolbox.torch_datasets.semcity_bdsd_ds import semcity_labels
+from dl_toolbox.lightning_datamodules.splitfile import read_splitfile
+
+
+stages = ['open', 'read', 'normalize', 'label', 'decode', 'augment', 'sample', 'collate', 'ipc']
+
+
+class StageTimer:
+    """
+    Accumulates the time spent in each stage, excluding the time of the
+    stages called from within it, so that stage times add up.
+    """
+
+    def __init__(self):
+
+        self.totals = dict.fromkeys(stages, 0.)
+        self._children = []
+
+    def time(self, stage, fn, *args, **kwargs):
+
+        self._children.append(0.)
+        start = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - start
+            children = self._children.pop()
+            self.totals[stage] += elapsed - children
+            if self._children:
+                self._children[-1] += elapsed
+
+    def wrap(self, stage, fn):
+
+        def timed(*args, **kwargs):
+            return self.time(stage, fn, *args, **kwargs)
+
+        return timed
+
+def instrument(datasets, timer):
+
+    # Timed versions of the reading methods are set on the instances
+    caches = set()
+    for ds in datasets:
+        if isinstance(ds, DecodedImagesDs):
+            ds.decode = timer.wrap('decode', ds.decode)
+        else:
+            for name, stage in [
+                ('read_window', 'read'),
+                ('read_image', 'normalize'),
+                ('read_raw', 'normalize'),
+                ('read_label', 'label')
+            ]:
+                setattr(ds, name, timer.wrap(stage, getattr(ds, name)))
+            if id(ds.handle_cache) not in caches:
+                caches.add(id(ds.handle_cache))
+                ds.handle_cache.open = timer.wrap('open', ds.handle_cache.open)
+        ds.img_aug = timer.wrap('augment', ds.img_aug)
+
+def write_synthetic(output_path, ds_name, size):
+    """
+    Writes a tiled, compressed uint16 image and a label raster of size x size
+    pixels in the layout the dataset class expects.
+    """
+    ds_cls = DatasetFactory().create(ds_name)
+    if ds_cls is ResiscDs:
+        from PIL import Image
+        for c in range(4):
+            class_dir = output_path / f'class_{c}'
+            class_dir.mkdir(parents=True, exist_ok=True)
+            for i in range(16):
+                array = np.random.randint(0, 256, (256, 256, 3), dtype=np.uint8)
+                Image.fromarray(array).save(class_dir / f'{i}.jpg', quality=90)
+        return output_path, None
+
+    profile = {
+        'driver': 'GTiff',
+        'width': size,
+        'height': size,
+        'transform': from_origin(0, size, 1, 1),
+        'crs': 'EPSG:32631',
+        'tiled': True,
+        'blockxsize': 256,
+        'blockysize': 256,
+        'compress': 'deflate'
+    }
+    image_path = output_path / 'image.tif'
+    count = max(ds_cls.bands) if ds_cls.bands else 3
+    with rasterio.open(image_path, 'w', count=count, dtype='uint16', **profile) as f:
+        f.write(np.random.randint(0, 4096, (count, size, size), dtype=np.uint16))
+
+    label_path = output_path / 'label.tif'
+    index = np.random.randint(0, 10, (size, size))
+    if ds_name == 'SemcityToulouse':
+        # Colour labels
+        colors = np.array([v['color'] for v in semcity_labels['base'].values()], dtype=np.uint8)
+        label = colors[index % len(colors)].transpose(2, 0, 1)
+    else:
+        label = index[None].astype(np.uint8)
+    with rasterio.open(label_path, 'w', count=label.shape[0], dtype='uint8', **profile) as f:
+        f.write(label)
+
+    return image_path, label_path
+
+def build_dataset(args, crop_size, img_aug, synthetic_paths=None, handle_cache=None):
+
+    if args.splitfile_path:
+        return ConcatDataset(read_splitfile(
+            Path(args.data_path),
+            args.splitfile_path,
+            folds=args.folds,
+            fixed_crops=False,
+            crop_size=crop_size,
+            img_aug=img_aug,
+            labels=args.labels,
+            handle_cache=handle_cache,
+            raw_transport=args.raw_transport
+        ))
+
+    image_path, label_path = synthetic_paths
+    ds_cls = DatasetFactory().create(args.dataset)
+    if ds_cls is ResiscDs:
+        return ConcatDataset([ResiscDs(data_path=image_path, img_aug=img_aug)])
+
+    with rasterio.open(image_path) as f:
+        tile = Window(0, 0, f.width, f.height)
+    return ConcatDataset([ds_cls(
+        image_path=image_path,
+        label_path=label_path,
+        tile=tile,
+        crop_size=crop_size,
+        img_aug=img_aug,
+        labels=args.labels,
+        handle_cache=handle_cache,
+        raw_transport=args.raw_transport
+    )])
+
+def batch_bytes(batch):
+
+    return sum(
+        batch[key].numel() * batch[key].element_size()
+        for key in ('image', 'mask') if torch.is_tensor(batch.get(key))
+    )
+
+def profile_stages(dataset, batch_size, num_batches):
+    """
+    Time per batch of each stage, measured in the main process.
+    """
+    timer = StageTimer()
+    instrument(dataset.datasets, timer)
+    collate = CustomCollate()
+    sampler = iter(RandomSampler(dataset, replacement=True, num_samples=batch_size*num_batches))
+    for _ in range(num_batches):
+        samples = [timer.time('sample', dataset.__getitem__, next(sampler)) for _ in range(batch_size)]
+        batch = timer.time('collate', collate, samples)
+        # What a worker process pays to send the batch and the main process
+        # to receive it
+        timer.time('ipc', lambda: pickle.loads(ForkingPickler.dumps(batch)))
+
+    return {stage: 1000 * t / num_batches for stage, t in timer.totals.items()}
+
+def measure_loader(dataset, workers, batch_size, pin_memory, num_batches, warmup):
+
+    loader = DataLoader(
+        dataset=dataset,
+        batch_size=batch_size,
+        sampler=RandomSampler(dataset, replacement=True, num_samples=batch_size*(num_batches+warmup)),
+        collate_fn=CustomCollate(),
+        num_workers=workers,
+        pin_memory=pin_memory,
+        drop_last=True
+    )
+    nbytes, first_batch = 0, None
+    start = time.perf_counter()
+    for i, batch in enumerate(loader):
+        if i < warmup:
+            # Worker startup and first reads are excluded
+            if i == 0:
+                first_batch = time.perf_counter() - start
+            if i == warmup - 1:
+                start = time.perf_counter()
+            continue
+        nbytes += batch_bytes(batch)
+    elapsed = time.perf_counter() - start
+
+    return {
+        'first_batch_s': first_batch,
+        'samples_per_s': num_batches * batch_size / elapsed,
+        'mb_per_s': nbytes / 2**20 / elapsed
+    }
+
+def main():
+
+    """
+    Measures the throughput of DataLoaders over a dataset class, built from a
+    splitfile or from a synthetic raster, for all combinations of the given
+    workers, batch sizes, crop sizes, augmentations and pin memory settings,
+    along with the time per batch of each loading stage.
+    """
+
+    parser = ArgumentParser()
+    parser.add_argument("--dataset", type=str, default='DigitanieV2')
+    parser.add_argument("--splitfile_path", type=str)
+    parser.add_argument("--data_path", type=str)
+    parser.add_argument("--folds", nargs='+', type=int, default=list(range(10)))
+    parser.add_argument("--labels", type=str, default='base')
+    parser.add_argument("--synthetic_size", type=int, default=4096)
+    parser.add_argument("--workers", nargs='+', type=int, default=[0, 4])
+    parser.add_argument("--batch_size", nargs='+', type=int, default=[16])
+    parser.add_argument("--crop_size", nargs='+', type=int, default=[256])
+    parser.add_argument("--img_aug", nargs='+', type=str, default=['no'])
+    parser.add_argument("--pin_memory", nargs='+', type=int, default=[1])
+    parser.add_argument("--raw_transport", action='store_true')
+    parser.add_argument("--num_batches", type=int, default=50)
+    parser.add_argument("--warmup", type=int, default=2)
+    parser.add_argument("--profile_batches", type=int, default=10)
+    parser.add_argument("--output", type=str)
+    args = parser.parse_args()
+
+    tmp_dir = None
+    synthetic_paths = None
+    if not args.splitfile_path:
+        tmp_dir = tempfile.TemporaryDirectory()
+        synthetic_paths = write_synthetic(Path(tmp_dir.name), args.dataset, args.synthetic_size)
+
+    results = []
+    for workers, batch_size, crop_size, img_aug, pin_memory in product(
+        args.workers, args.batch_size, args.crop_size, args.img_aug, args.pin_memory
+    ):
+        config = {
+            'workers': workers,
+            'batch_size': batch_size,
+            'crop_size': crop_size,
+            'img_aug': img_aug,
+            'pin_memory': bool(pin_memory),
+            'raw_transport': args.raw_transport
+        }
+        dataset = build_dataset(args, crop_size, img_aug, synthetic_paths)
+        throughput = measure_loader(
+            dataset, workers, batch_size, bool(pin_memory), args.num_batches, args.warmup
+        )
+        # Instrumenting modifies the datasets and their handle cache, hence
+        # done on new ones
+        dataset = build_dataset(args, crop_size, img_aug, synthetic_paths, RasterHandleCache())
+        stage_ms = profile_stages(dataset, batch_size, args.profile_batches)
+        results.append({**config, **throughput, 'stage_ms_per_batch': stage_ms})
+
+    header = f'{"workers":>8}{"batch":>6}{"crop":>6}{"img_aug":>12}{"pin":>5}{"samples/s":>11}{"MB/s":>8}'
+    header += ''.join(f'{stage:>10}' for stage in stages)
+    print(f'{args.dataset} {"splitfile" if args.splitfile_path else "synthetic"}, stage times in ms per batch')
+    print(header)
+    for r in results:
+        line = f'{r["workers"]:>8}{r["batch_size"]:>6}{r["crop_size"]:>6}{r["img_aug"]:>12}{int(r["pin_memory"]):>5}'
+        line += f'{r["samples_per_s"]:>11.1f}{r["mb_per_s"]:>8.1f}'
+        line += ''.join(f'{r["stage_ms_per_batch"][stage]:>10.2f}' for stage in stages)
+        print(line)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'dataset': args.dataset, 'args': vars(args), 'results': results}, f, indent=1)
+
+    if tmp_dir is not None:
+        tmp_dir.cleanup()
+
+
+if __name__ == "__main__":
+
+    main()
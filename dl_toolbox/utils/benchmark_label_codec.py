@@ -0,0 +1,110 @@
+from argparse import ArgumentParser
+import time
+
+import numpy as np
+import torch
+
+from dl_toolbox.utils.label_manipulation import LabelCodec
+from dl_toolbox.torch_datasets.semcity_bdsd_ds import semcity_labels, mergers
+
+
+# Per-class mask implementations the codec replaces, kept here as reference
+
+def loop_merge(L, merger):
+
+    ret = np.zeros(L.shape, dtype=L.dtype)
+    for i, lab in enumerate(merger):
+        for j in lab:
+            ret[L == j] = i
+
+    return ret
+
+def loop_from_rgb(rgb, labels):
+
+    out = np.zeros(shape=rgb.shape[:-1], dtype=np.uint8)
+    for label, key in enumerate(labels):
+        c = labels[key]['color']
+        d = rgb[..., 0] == c[0]
+        d = np.logical_and(d, (rgb[..., 1] == c[1]))
+        d = np.logical_and(d, (rgb[..., 2] == c[2]))
+        out[d] = label
+
+    return out
+
+def loop_to_rgb(L, labels):
+
+    rgb = np.zeros(shape=(*L.shape, 3), dtype=np.uint8)
+    for label, key in enumerate(labels):
+        mask = np.array(L == label)
+        rgb[mask] = np.array(labels[key]['color'])
+
+    return rgb
+
+def timeit(fn, repeats, sync=None):
+
+    fn()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        fn()
+    if sync: sync()
+
+    return (time.perf_counter() - start) / repeats
+
+def main():
+
+    parser = ArgumentParser()
+    parser.add_argument("--size", type=int, default=1024)
+    parser.add_argument("--repeats", type=int, default=10)
+    parser.add_argument("--labels", type=str, default='semcity')
+    parser.add_argument("--device", type=str, default=None)
+    args = parser.parse_args()
+
+    base = semcity_labels['base']
+    merger = mergers[args.labels]
+    codec = LabelCodec(base, merger=merger, merged_labels=semcity_labels[args.labels])
+    codec.rgb_lut
+
+    colors = np.array([base[key]['color'] for key in base], dtype=np.uint8)
+    idx = np.random.randint(0, len(colors), size=(args.size, args.size))
+    rgb = colors[idx]
+    L = idx.astype(np.uint8)
+    merged = codec.merge(L)
+
+    assert np.array_equal(loop_merge(loop_from_rgb(rgb, base), merger), codec.from_rgb(rgb))
+    assert np.array_equal(loop_merge(L, merger), merged)
+    assert np.array_equal(loop_to_rgb(merged, semcity_labels[args.labels]), codec.to_rgb(merged))
+
+    results = [
+        ('merge',
+         timeit(lambda: loop_merge(L, merger), args.repeats),
+         timeit(lambda: codec.merge(L), args.repeats)),
+        ('rgb to labels + merge',
+         timeit(lambda: loop_merge(loop_from_rgb(rgb, base), merger), args.repeats),
+         timeit(lambda: codec.from_rgb(rgb), args.repeats)),
+        ('labels to rgb',
+         timeit(lambda: loop_to_rgb(merged, semcity_labels[args.labels]), args.repeats),
+         timeit(lambda: codec.to_rgb(merged), args.repeats))
+    ]
+
+    if args.device:
+        device = torch.device(args.device)
+        sync = torch.cuda.synchronize if device.type == 'cuda' else None
+        t_rgb = torch.from_numpy(rgb).to(device)
+        t_L = torch.from_numpy(L).to(device)
+        results += [
+            (f'merge ({device})', None, timeit(lambda: codec.merge(t_L), args.repeats, sync)),
+            (f'rgb to labels + merge ({device})', None, timeit(lambda: codec.from_rgb(t_rgb), args.repeats, sync)),
+            (f'labels to rgb ({device})', None, timeit(lambda: codec.to_rgb(t_L), args.repeats, sync))
+        ]
+
+    print(f'{args.size}x{args.size} labels, {args.repeats} repeats, time per call in ms')
+    print(f'{"op":<40}{"loops":>10}{"codec":>10}{"speedup":>10}')
+    for name, t_loop, t_codec in results:
+        loop = f'{1000*t_loop:.2f}' if t_loop else '-'
+        speedup = f'{t_loop/t_codec:.1f}x' if t_loop else '-'
+        print(f'{name:<40}{loop:>10}{1000*t_codec:>10.2f}{speedup:>10}')
+
+
+if __name__ == "__main__":
+
+    main()
@@ -0,0 +1,271 @@
+import hashlib
+import multiprocessing as mp
+from multiprocessing import shared_memory, resource_tracker
+from multiprocessing.util import Finalize
+
+import numpy as np
+from rasterio.windows import Window
+
+
+def path_hash(path):
+
+    digest = hashlib.blake2b(str(path).encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'little', signed=True)
+
+# One row per slot of the arena: key (path hash, band, block row, block col),
+# shape and dtype of the block, and last use for LRU eviction (-1: empty)
+slot_dtype = np.dtype([
+    ('path', np.int64),
+    ('band', np.int32),
+    ('row', np.int32),
+    ('col', np.int32),
+    ('height', np.int32),
+    ('width', np.int32),
+    ('dtype', 'S8'),
+    ('last_used', np.int64)
+])
+
+
+class SharedBlockCache:
+    """
+    Cache of decoded raster blocks in shared memory, used by all DataLoader
+    workers of a process tree, so that a block read by one worker is not
+    decoded again by the others.
+
+    Rasters are cut into a grid of block x block pixels per band, cached in
+    fixed-size slots of one shared arena, with approximate LRU eviction when
+    the byte budget is reached. The slot table, an open addressing hash
+    index of the slots by key and the counters are numpy arrays in another
+    shared segment, so that a lookup probes a few entries; all accesses hold
+    one multiprocessing lock.
+
+    The cache is created in the main process before workers start: forked
+    workers inherit it, spawned ones attach to the segments by name.
+
+    :param capacity_mb: byte budget of the arena, in MB.
+    :param block: side of the cached blocks, ideally the tile size of the
+        GeoTIFFs.
+    :param max_itemsize: largest pixel size in bytes that can be cached,
+        other rasters are read directly.
+    """
+
+    # Slots compared to pick the one evicted
+    eviction_samples = 16
+
+    def __init__(self, capacity_mb=1024, block=256, max_itemsize=4):
+
+        self.block = block
+        self.max_itemsize = max_itemsize
+        self.slot_bytes = block * block * max_itemsize
+        self.num_slots = max(1, int(capacity_mb * 2**20) // self.slot_bytes)
+        # Power of two at least twice the number of slots, keeping probe
+        # sequences short
+        self.index_size = 1 << (2 * self.num_slots - 1).bit_length()
+        self.lock = mp.Lock()
+        self._arena = shared_memory.SharedMemory(create=True, size=self.num_slots * self.slot_bytes)
+        table_bytes = self.num_slots * slot_dtype.itemsize + self.index_size * 4 + 4 * 8
+        self._meta = shared_memory.SharedMemory(create=True, size=table_bytes)
+        self._owner = True
+        self._attach()
+        self.table['last_used'] = -1
+        self.index[:] = -1
+        self.counters[:] = 0
+        # Segments are unlinked when the creating process exits
+        Finalize(self, self.unlink, exitpriority=10)
+
+    def _attach(self):
+
+        table_bytes = self.num_slots * slot_dtype.itemsize
+        self.table = np.ndarray((self.num_slots,), dtype=slot_dtype, buffer=self._meta.buf)
+        # Slot of each key, -1 for empty entries
+        self.index = np.ndarray(
+            (self.index_size,), dtype=np.int32, buffer=self._meta.buf, offset=table_bytes
+        )
+        # clock, hits, misses, filled slots
+        self.counters = np.ndarray(
+            (4,), dtype=np.int64, buffer=self._meta.buf, offset=table_bytes + self.index_size * 4
+        )
+
+    def __getstate__(self):
+
+        state = {k: v for k, v in self.__dict__.items() if k not in ('table', 'index', 'counters')}
+        state['_arena'] = self._arena.name
+        state['_meta'] = self._meta.name
+        state['_owner'] = False
+        return state
+
+    def __setstate__(self, state):
+
+        self.__dict__.update(state)
+        self._arena = shared_memory.SharedMemory(name=state['_arena'])
+        self._meta = shared_memory.SharedMemory(name=state['_meta'])
+        # Attaching registers the segments to this process resource tracker,
+        # which would unlink them when it exits
+        for shm in (self._arena, self._meta):
+            resource_tracker.unregister(shm._name, 'shared_memory')
+        self._attach()
+
+    def unlink(self):
+
+        self.table, self.index, self.counters = None, None, None
+        self._arena.close()
+        self._meta.close()
+        if self._owner:
+            self._arena.unlink()
+            self._meta.unlink()
+
+    def hit_rate(self):
+
+        hits, misses = int(self.counters[1]), int(self.counters[2])
+        return hits / (hits + misses) if hits + misses else 0.
+
+    def stats(self):
+
+        return {
+            'hits': int(self.counters[1]),
+            'misses': int(self.counters[2]),
+            'hit_rate': self.hit_rate(),
+            'used_slots': int(self.counters[3]),
+            'num_slots': self.num_slots
+        }
+
+    def _slot_array(self, slot, height, width, dtype):
+
+        return np.ndarray(
+            (height, width),
+            dtype=dtype,
+            buffer=self._arena.buf,
+            offset=slot * self.slot_bytes
+        )
+
+    def _tick(self):
+
+        self.counters[0] += 1
+        return self.counters[0]
+
+    def _home(self, key):
+
+        # Index entry where the probe sequence of key starts
+        h = 0
+        for v in key:
+            h = ((h ^ int(v)) * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF
+        return (h >> 32) & (self.index_size - 1)
+
+    def _slot_key(self, slot):
+
+        entry = self.table[slot]
+        return (int(entry['path']), int(entry['band']), int(entry['row']), int(entry['col']))
+
+    def _probe(self, key):
+
+        # Index position of key, or of the empty entry ending its sequence
+        mask = self.index_size - 1
+        i = self._home(key)
+        while True:
+            slot = self.index[i]
+            if slot < 0 or self._slot_key(slot) == key:
+                return i
+            i = (i + 1) & mask
+
+    def _find(self, key):
+
+        slot = self.index[self._probe(key)]
+        return int(slot) if slot >= 0 else None
+
+    def _remove(self, key):
+
+        # Linear probing deletion: entries further in the sequence are
+        # moved back so that no lookup stops early on the emptied entry
+        mask = self.index_size - 1
+        i = self._probe(key)
+        if self.index[i] < 0:
+            return
+        j = i
+        while True:
+            j = (j + 1) & mask
+            slot = self.index[j]
+            if slot < 0:
+                break
+            home = self._home(self._slot_key(slot))
+            if (i <= j and (home <= i or home > j)) or (i > j and home <= i and home > j):
+                self.index[i] = slot
+                i = j
+        self.index[i] = -1
+
+    def _get(self, key, out):
+
+        # Copies the block into out if cached, under the lock
+        slot = self._find(key)
+        if slot is None:
+            return False
+        entry = self.table[slot]
+        out[...] = self._slot_array(slot, entry['height'], entry['width'], entry['dtype'].decode())
+        self.table['last_used'][slot] = self._tick()
+        return True
+
+    def _victim(self):
+
+        # Empty slots first, then the least recently used of a few slots
+        filled = int(self.counters[3])
+        if filled < self.num_slots:
+            self.counters[3] += 1
+            return filled
+        candidates = np.random.randint(self.num_slots, size=self.eviction_samples)
+        slot = int(candidates[np.argmin(self.table['last_used'][candidates])])
+        self._remove(self._slot_key(slot))
+        return slot
+
+    def _put(self, key, data):
+
+        # Another worker may have cached the block meanwhile
+        i = self._probe(key)
+        if self.index[i] >= 0:
+            return
+        slot = self._victim()
+        self.table[slot] = (*key, *data.shape, data.dtype.str, self._tick())
+        self._slot_array(slot, *data.shape, data.dtype)[...] = data
+        # Removing the evicted key may have moved the entries
+        self.index[self._probe(key)] = slot
+
+    def read(self, raster, path, window, indexes=None):
+        """
+        Reads a window of an open raster from cached blocks, reading the
+        missing blocks of all requested bands at once and caching them.
+        """
+        dtype = np.dtype(raster.dtypes[0])
+        if dtype.itemsize > self.max_itemsize:
+            return raster.read(indexes=indexes, window=window)
+        bands = list(indexes) if indexes is not None else list(range(1, raster.count+1))
+        key_path = path_hash(path)
+        b = self.block
+        col_off, row_off = int(window.col_off), int(window.row_off)
+        width, height = int(window.width), int(window.height)
+        out = np.zeros((len(bands), height, width), dtype=dtype)
+
+        for r in range(max(row_off, 0) // b, (min(row_off + height, raster.height) - 1) // b + 1):
+            y0, y1 = max(row_off, r * b), min(row_off + height, (r+1) * b, raster.height)
+            for c in range(max(col_off, 0) // b, (min(col_off + width, raster.width) - 1) // b + 1):
+                x0, x1 = max(col_off, c * b), min(col_off + width, (c+1) * b, raster.width)
+                block_h = min(b, raster.height - r * b)
+                block_w = min(b, raster.width - c * b)
+                blocks = np.empty((len(bands), block_h, block_w), dtype=dtype)
+                with self.lock:
+                    missing = [
+                        i for i, band in enumerate(bands)
+                        if not self._get((key_path, band, r, c), blocks[i])
+                    ]
+                    self.counters[1] += len(bands) - len(missing)
+                    self.counters[2] += len(missing)
+                if missing:
+                    blocks[missing] = raster.read(
+                        indexes=[bands[i] for i in missing],
+                        window=Window(c * b, r * b, block_w, block_h)
+                    )
+                    with self.lock:
+                        for i in missing:
+                            self._put((key_path, bands[i], r, c), blocks[i])
+                out[:, y0-row_off:y1-row_off, x0-col_off:x1-col_off] = blocks[
+                    :, y0-r*b:y1-r*b, x0-c*b:x1-c*b
+                ]
+
+        return out
@@ -0,0 +1,126 @@
+from argparse import ArgumentParser
+from pathlib import Path
+import csv
+import json
+
+import numpy as np
+from rasterio.windows import Window
+
+from dl_toolbox.torch_datasets import DatasetFactory
+from dl_toolbox.torch_datasets.chip_ds import store_dtypes, chunk_shape
+
+
+def write_tile(ds, tile, chunk, dtype, image_file, label_file):
+    """
+    Reads a tile once, chunk by chunk, through the dataset reading methods
+    (hence with its normalization and label merge) and writes it to
+    (rows of chunks, cols of chunks, ..., chunk, chunk) arrays, zero padded
+    on the right and bottom edges.
+    """
+    np_dtype, scale = store_dtypes[dtype]
+    nrows, ncols = chunk_shape(tile.height, tile.width, chunk)
+    image, label = None, None
+
+    for r in range(nrows):
+        for c in range(ncols):
+            window = Window(
+                tile.col_off + c * chunk,
+                tile.row_off + r * chunk,
+                chunk,
+                chunk
+            ).intersection(tile)
+            h, w = int(window.height), int(window.width)
+
+            img = ds.read_image(ds.image_path, window)
+            if image is None:
+                image = np.lib.format.open_memmap(
+                    image_file, mode='w+', dtype=np_dtype,
+                    shape=(nrows, ncols, img.shape[0], chunk, chunk)
+                )
+            image[r, c, :, :h, :w] = np.rint(np.clip(img, 0, 1) * scale)
+
+            if ds.label_path:
+                lbl = ds.read_label(ds.label_path, window)
+                if label is None:
+                    label = np.lib.format.open_memmap(
+                        label_file, mode='w+', dtype=np.uint8,
+                        shape=(nrows, ncols, chunk, chunk)
+                    )
+                label[r, c, :h, :w] = lbl
+
+    image.flush()
+    if label is not None: label.flush()
+
+def main():
+
+    """
+    Converts the tiles of a splitfile into a chip store for ChipDs: each tile
+    is read once from the source rasters, normalized and merged as the dataset
+    does, and written as chunked uint8/uint16 images and uint8 labels.
+    """
+
+    parser = ArgumentParser()
+    parser.add_argument("--splitfile_path", type=str)
+    parser.add_argument("--data_path", type=str)
+    parser.add_argument("--output_path", type=str)
+    parser.add_argument("--folds", nargs='+', type=int, default=None)
+    parser.add_argument("--labels", type=str, default='base')
+    parser.add_argument("--crop_size", type=int, default=256)
+    parser.add_argument("--dtype", type=str, default='uint8', choices=list(store_dtypes))
+    args = parser.parse_args()
+
+    data_path = Path(args.data_path)
+    output_path = Path(args.output_path)
+    output_path.mkdir(parents=True, exist_ok=True)
+    dataset_factory = DatasetFactory()
+    tiles, labels = [], None
+
+    with open(args.splitfile_path, newline='') as splitfile:
+
+        reader = csv.reader(splitfile)
+        next(reader)
+        for row in reader:
+
+            ds_name, _, image_path, label_path, x0, y0, w, h, fold = row[:9]
+            if args.folds is not None and int(fold) not in args.folds:
+                continue
+            tile = Window(int(x0), int(y0), int(w), int(h))
+            ds = dataset_factory.create(ds_name)(
+                image_path=data_path/image_path,
+                label_path=data_path/label_path if label_path else None,
+                tile=tile,
+                crop_size=args.crop_size,
+                labels=args.labels
+            )
+            labels = ds.labels
+            i = len(tiles)
+            print(f'Tile {i}: {image_path} {tuple(tile.flatten())}')
+            write_tile(
+                ds,
+                tile,
+                args.crop_size,
+                args.dtype,
+                output_path / f'{i}_image.npy',
+                output_path / f'{i}_label.npy'
+            )
+            tiles.append({
+                'image': f'{i}_image.npy',
+                'label': f'{i}_label.npy' if label_path else None,
+                'image_path': str(data_path/image_path),
+                'ds_name': ds_name,
+                'tile': [int(x0), int(y0), int(w), int(h)],
+                'fold': int(fold)
+            })
+
+    with open(output_path / 'index.json', 'w') as f:
+        json.dump({
+            'chunk': args.crop_size,
+            'dtype': args.dtype,
+            'labels': labels,
+            'tiles': tiles
+        }, f, indent=1)
+
+
+if __name__ == "__main__":
+
+    main()
@@ -0,0 +1,96 @@
+from argparse import ArgumentParser
+from pathlib import Path
+import tempfile
+
+import rasterio
+import torch
+from rasterio.windows import Window
+
+from dl_toolbox.torch_datasets import DatasetFactory, CropPlanSampler, PlannedConcatDataset
+from dl_toolbox.utils.benchmark_dataloader import write_synthetic
+
+
+def resumed_stream(dataset, num_samples, batch_size, seed, stops):
+    """
+    Samples of epoch 0 of a crop plan run interrupted after each number of
+    batches of stops (counted from the epoch start, as the trainer does):
+    each time the state is saved, and a new sampler restored from it takes
+    over, with the length of the epoch unchanged.
+    """
+    stream = []
+    state = None
+    for stop in list(stops) + [None]:
+        sampler = CropPlanSampler(dataset, num_samples, seed=seed, epoch_fn=lambda: 0)
+        if state is not None:
+            sampler.load_state_dict(state)
+        if len(sampler) != num_samples:
+            raise AssertionError(f'Resumed sampler has length {len(sampler)}, not {num_samples}')
+        samples = list(sampler)
+        if stop is None:
+            stream += samples
+        else:
+            stream += samples[:stop * batch_size - len(stream)]
+            state = sampler.state_dict(stop * batch_size)
+
+    return stream
+
+def check_resume(dataset, num_samples, batch_size, seed, stops, num_compared=8):
+    """
+    Checks that a run saved and resumed after each number of batches of stops
+    reads the same samples as an uninterrupted one, indices and images.
+    """
+    full = list(CropPlanSampler(dataset, num_samples, seed=seed, epoch_fn=lambda: 0))
+    resumed = resumed_stream(dataset, num_samples, batch_size, seed, stops)
+    if resumed != full:
+        first = next((i for i, (a, b) in enumerate(zip(resumed, full)) if a != b), min(len(resumed), len(full)))
+        raise AssertionError(
+            f'Resumed stream differs from the uninterrupted one at sample {first} '
+            f'({len(resumed)} vs {len(full)} samples)'
+        )
+    for idx in full[:num_compared]:
+        if not torch.equal(dataset[idx]['image'], dataset[idx]['image']):
+            raise AssertionError(f'Planned sample {idx} is not reproducible')
+
+    print(f'{len(full)} samples, resumed after {stops} batches of {batch_size}: identical')
+
+def main():
+
+    """
+    Save -> resume -> save round trip of the crop plan sampler on a synthetic
+    raster: the sample stream of a run interrupted several times in an epoch
+    must match that of an uninterrupted run.
+    """
+
+    parser = ArgumentParser()
+    parser.add_argument("--dataset", type=str, default='DigitanieV2')
+    parser.add_argument("--img_aug", type=str, default='d4_color-3')
+    parser.add_argument("--size", type=int, default=1024)
+    parser.add_argument("--crop_size", type=int, default=256)
+    parser.add_argument("--num_tiles", type=int, default=4)
+    parser.add_argument("--num_samples", type=int, default=64)
+    parser.add_argument("--batch_size", type=int, default=4)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--stops", nargs='+', type=int, default=[3, 7, 12])
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        image_path, label_path = write_synthetic(Path(tmp_dir), args.dataset, args.size)
+        with rasterio.open(image_path) as f:
+            width, height = f.width, f.height
+        tile_width = width // args.num_tiles
+        ds_cls = DatasetFactory().create(args.dataset)
+        dataset = PlannedConcatDataset([
+            ds_cls(
+                image_path=image_path,
+                label_path=label_path,
+                tile=Window(i * tile_width, 0, tile_width, height),
+                crop_size=args.crop_size,
+                img_aug=args.img_aug
+            ) for i in range(args.num_tiles)
+        ])
+        check_resume(dataset, args.num_samples, args.batch_size, args.seed, args.stops)
+
+
+if __name__ == "__main__":
+
+    main()
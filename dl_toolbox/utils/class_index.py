@@ -0,0 +1,116 @@
+import os
+import copy
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+from rasterio.windows import Window
+
+from .raster_stats import file_key, window_tuple
+from .raster_cache import handle_cache as default_handle_cache
+
+
+def default_index_dir():
+
+    return Path(os.environ.get(
+        'DL_TOOLBOX_CLASS_INDEX',
+        Path.home() / '.cache' / 'dl_toolbox' / 'class_index'
+    ))
+
+def class_grid_path(ds, cell_size, index_dir=None):
+
+    # Keyed by the label file, tile, cell size and label scheme of the dataset
+    key = '|'.join([
+        file_key(ds.label_path),
+        str(tuple(int(v) for v in window_tuple(ds.tile))),
+        str(cell_size),
+        type(ds).__name__,
+        ','.join(ds.labels)
+    ])
+    name = hashlib.sha1(key.encode()).hexdigest()
+
+    return Path(index_dir if index_dir else default_index_dir()) / f'{name}.npy'
+
+def compute_class_grid(ds, cell_size):
+    """
+    Counts the labels of the tile of ds in each cell of a cell_size grid,
+    reading the labels one row of cells at a time through ds.read_label.
+    Returns a (rows, cols, num_classes) array; edge cells may be smaller.
+    """
+    tile = ds.tile
+    num_classes = len(ds.labels)
+    nrows = -(-int(tile.height) // cell_size)
+    ncols = -(-int(tile.width) // cell_size)
+    grid = np.zeros((nrows, ncols, num_classes), dtype=np.int64)
+    cell_cols = np.arange(int(tile.width)) // cell_size
+
+    for r in range(nrows):
+        window = Window(
+            tile.col_off,
+            tile.row_off + r * cell_size,
+            tile.width,
+            min(cell_size, tile.height - r * cell_size)
+        )
+        label = ds.read_label(ds.label_path, window).astype(np.int64)
+        valid = label < num_classes
+        idx = np.broadcast_to(cell_cols * num_classes, label.shape)[valid] + label[valid]
+        grid[r] = np.bincount(idx, minlength=ncols*num_classes).reshape(ncols, num_classes)
+
+    return grid
+
+def _compute_and_save(args):
+
+    ds, cell_size, path = args
+    grid = compute_class_grid(ds, cell_size)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f'{path.name}.{os.getpid()}.tmp.npy')
+    np.save(tmp_path, grid)
+    os.replace(tmp_path, path)
+
+    return grid
+
+def pool_copy(ds):
+
+    # The caches shared by the datasets (the block cache holds a
+    # multiprocessing lock) are not sent to pool processes, which read
+    # through their own default handle cache
+    ds = copy.copy(ds)
+    ds.block_cache = None
+    ds.handle_cache = default_handle_cache
+
+    return ds
+
+def load_class_grids(datasets, cell_size, workers=0, index_dir=None):
+    """
+    Returns the class grid of each dataset, computing the ones missing from
+    the index directory with a pool of workers processes and caching them.
+    """
+    paths = [class_grid_path(ds, cell_size, index_dir) for ds in datasets]
+    grids = [np.load(path) if path.exists() else None for path in paths]
+    missing = [(ds, cell_size, path) for ds, path, grid in zip(datasets, paths, grids) if grid is None]
+
+    if workers > 1 and len(missing) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            computed = list(pool.map(
+                _compute_and_save,
+                [(pool_copy(ds), cell_size, path) for ds, cell_size, path in missing]
+            ))
+    else:
+        computed = [_compute_and_save(args) for args in missing]
+
+    computed = iter(computed)
+    return [grid if grid is not None else next(computed) for grid in grids]
+
+def class_weights(class_counts, balance=1.):
+    """
+    Per-pixel weight of each class, (frequency)^-balance: 0 keeps the label
+    distribution, 1 makes all present classes equally likely to be sampled.
+    """
+    counts = np.asarray(class_counts, dtype=np.float64)
+    freqs = counts / max(counts.sum(), 1.)
+    weights = np.zeros_like(freqs)
+    present = freqs > 0
+    weights[present] = freqs[present] ** -balance
+
+    return weights
@@ -1,11 +1,132 @@
 import numpy as np
 import torch
 
+
+# Label rasters are at most 8-bit in the datasets we use: lookup tables cover
+# at least this range, values beyond the table are mapped to its last entry.
+MIN_LUT_SIZE = 256
+
+def pack_rgb(rgb):
+    """
+    Packs the last dimension (R, G, B) of a uint8 array or tensor into one
+    24-bit integer per pixel.
+    """
+    if torch.is_tensor(rgb):
+        rgb = rgb.long()
+    else:
+        rgb = rgb.astype(np.int64)
+
+    return (rgb[..., 0] << 16) | (rgb[..., 1] << 8) | rgb[..., 2]
+
+def apply_lut(lut, L):
+    """
+    Gathers lut[L] for each pixel of L, on numpy arrays or on torch tensors on
+    their own device; values outside the table are clipped to its bounds.
+    """
+    if torch.is_tensor(L):
+        lut = torch.as_tensor(lut, device=L.device)
+        idx = L.long().clamp_(0, lut.shape[0]-1)
+        return lut[idx]
+
+    if not np.issubdtype(L.dtype, np.integer):
+        L = L.astype(np.int64)
+
+    return np.take(lut, L, axis=0, mode='clip')
+
+
+class LabelCodec:
+    """
+    Compiles a label scheme into lookup tables so that decoding a colour
+    raster, merging labels and colouring predictions are each one gather per
+    pixel.
+
+    :param labels: dict of source classes in index order, each with a 'color'
+        entry, as the labels_dict tables of the dataset modules.
+    :param merger: list of lists of source indices merged into each target
+        class, as the mergers tables; None keeps the source classes.
+    :param merged_labels: dict of target classes with their colour, used by
+        to_rgb; defaults to labels when there is no merger.
+    """
+
+    def __init__(self, labels, merger=None, merged_labels=None):
+
+        self.labels = labels
+        self.merger = merger if merger is not None else [[i] for i in range(len(labels))]
+        self.merged_labels = merged_labels if merged_labels is not None else labels
+        self._rgb_lut = None
+        # Tables already copied to torch devices, by (name, device)
+        self._device_luts = {}
+
+        # index -> merged index, unknown indices are mapped to 0
+        num_sources = max([j for lab in self.merger for j in lab] + [len(labels)-1])
+        self.merge_lut = np.zeros(max(MIN_LUT_SIZE, num_sources+2), dtype=np.uint8)
+        for i, lab in enumerate(self.merger):
+            self.merge_lut[lab] = i
+
+        # merged index -> colour
+        colors = [self.merged_labels[key].get('color', (0, 0, 0)) for key in self.merged_labels]
+        self.color_lut = np.zeros((max(MIN_LUT_SIZE, len(colors)+1), 3), dtype=np.uint8)
+        self.color_lut[:len(colors)] = np.array(colors, dtype=np.uint8).reshape(-1, 3)
+
+    @property
+    def rgb_lut(self):
+
+        # packed colour -> merged index, 16MB so only built when decoding
+        # colour rasters
+        if self._rgb_lut is None:
+            self._rgb_lut = np.zeros(1 << 24, dtype=np.uint8)
+            for i, key in enumerate(self.labels):
+                c = self.labels[key]['color']
+                self._rgb_lut[(c[0] << 16) | (c[1] << 8) | c[2]] = self.merge_lut[i]
+        return self._rgb_lut
+
+    def __getstate__(self):
+
+        state = self.__dict__.copy()
+        state['_device_luts'] = {}
+        return state
+
+    def lut(self, name, L):
+
+        # Table name of the codec, as a tensor on the device of L if L is one
+        table = getattr(self, name)
+        if not torch.is_tensor(L):
+            return table
+        key = (name, L.device)
+        if key not in self._device_luts:
+            self._device_luts[key] = torch.as_tensor(table, device=L.device)
+        return self._device_luts[key]
+
+    def merge(self, L):
+
+        return apply_lut(self.lut('merge_lut', L), L)
+
+    def from_rgb(self, rgb, channels_first=False):
+        """
+        Decodes a (..., 3) colour array into merged indices; channels_first
+        accepts (3, ...) rasters as read by rasterio.
+        """
+        if channels_first:
+            rgb = rgb.movedim(0, -1) if torch.is_tensor(rgb) else np.moveaxis(rgb, 0, -1)
+
+        packed = pack_rgb(rgb)
+
+        return apply_lut(self.lut('rgb_lut', packed), packed)
+
+    def to_rgb(self, L):
+
+        return apply_lut(self.lut('color_lut', L), L)
+
+
 class MergeLabels:
 
     def __init__(self, labels, label_names=None):
 
         self.labels = labels
+        self.codec = LabelCodec(
+            labels={i: {} for i in range(max(j for lab in labels for j in lab)+1)},
+            merger=labels
+        )
 
     def __call__(self, L):
         """
@@ -15,12 +136,9 @@ class MergeLabels:
         :param L:
         :return:
         """
-        ret = np.zeros(L.shape, dtype=L.dtype)
-        for i, lab in enumerate(self.labels):
-            for j in lab:
-                ret[L == j] = i
+        ret = self.codec.merge(L)
 
-        return ret
+        return ret.to(L.dtype) if torch.is_tensor(L) else ret.astype(L.dtype)
 
 class TorchOneHot:
 
@@ -55,14 +173,14 @@ class LabelsToRGB:
     def __init__(self, labels):
 
         self.labels = labels
+        self.codec = LabelCodec(labels)
 
     def __call__(self, labels):
-        rgb = np.zeros(shape=(*labels.shape, 3), dtype=np.uint8)
-        for label, key in enumerate(self.labels):
-            mask = np.array(labels == label)
-            rgb[mask] = np.array(self.labels[key]['color'])
 
-        return rgb
+        if torch.is_tensor(labels):
+            labels = labels.cpu().numpy()
+
+        return self.codec.to_rgb(labels)
 
 class RGBToLabels:
     # Inputs shape : B,H,W,3 or H,W,3
@@ -70,15 +188,8 @@ class RGBToLabels:
     def __init__(self, labels):
 
         self.labels = labels
+        self.codec = LabelCodec(labels)
 
     def __call__(self, rgb):
 
-        labels = np.zeros(shape=rgb.shape[:-1], dtype=np.uint8)
-        for label, key in enumerate(self.labels):
-            c = self.labels[key]['color']
-            d = rgb[..., 0] == c[0]
-            d = np.logical_and(d, (rgb[..., 1] == c[1]))
-            d = np.logical_and(d, (rgb[..., 2] == c[2]))
-            labels[d] = label
-
-        return labels
+        return self.codec.from_rgb(rgb)
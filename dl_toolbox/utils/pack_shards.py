@@ -0,0 +1,63 @@
+from argparse import ArgumentParser
+from pathlib import Path
+import json
+
+import numpy as np
+from torchvision.datasets.folder import find_classes, make_dataset
+
+from dl_toolbox.torch_datasets.shard_ds import index_dtype
+
+
+def main():
+
+    """
+    Packs a folder dataset (one subfolder of images per class, as read by
+    ResiscDs) into shard files of about shard_size MB, written sequentially,
+    plus index.npy (shard, offset, length, class per sample, in the order of
+    ResiscDs) and index.json (class names, shard files, sample paths), to be
+    read by ShardDs.
+    """
+
+    parser = ArgumentParser()
+    parser.add_argument("--data_path", type=str)
+    parser.add_argument("--output_path", type=str)
+    parser.add_argument("--extensions", nargs='+', type=str, default=['jpg'])
+    parser.add_argument("--shard_size", type=int, default=256)
+    args = parser.parse_args()
+
+    data_path = Path(args.data_path)
+    output_path = Path(args.output_path)
+    output_path.mkdir(parents=True, exist_ok=True)
+    classes, class_to_idx = find_classes(data_path)
+    samples = make_dataset(data_path, class_to_idx, extensions=tuple(args.extensions))
+
+    index = np.zeros(len(samples), dtype=index_dtype)
+    shards, shard_file, offset = [], None, 0
+    for i, (path, label) in enumerate(samples):
+        if shard_file is None or offset >= args.shard_size * 2**20:
+            if shard_file is not None:
+                shard_file.close()
+            shards.append(f'shard_{len(shards):05}.bin')
+            shard_file = open(output_path / shards[-1], 'wb')
+            offset = 0
+        with open(path, 'rb') as f:
+            data = f.read()
+        shard_file.write(data)
+        index[i] = (len(shards) - 1, offset, len(data), label)
+        offset += len(data)
+    if shard_file is not None:
+        shard_file.close()
+
+    np.save(output_path / 'index.npy', index)
+    with open(output_path / 'index.json', 'w') as f:
+        json.dump({
+            'classes': classes,
+            'shards': shards,
+            'paths': [str(Path(path).relative_to(data_path)) for path, _ in samples]
+        }, f)
+    print(f'{len(samples)} samples of {len(classes)} classes in {len(shards)} shards')
+
+
+if __name__ == "__main__":
+
+    main()
@@ -0,0 +1,116 @@
+import os
+import threading
+from collections import OrderedDict
+from multiprocessing.util import Finalize
+
+import rasterio
+
+
+class RasterHandleCache:
+    """
+    Process-local LRU cache of open rasterio datasets.
+
+    Opening a GeoTIFF parses its header and IFDs, which is a noticeable part
+    of the cost of reading a small window: keeping the handles open lets
+    repeated crops from the same tile reuse them, along with the blocks
+    already decoded in the GDAL block cache.
+
+    Handles are never shared between processes: the cache notices when it is
+    used in a forked child (DataLoader workers) and starts from scratch there,
+    since file offsets of inherited descriptors are shared with the parent.
+    Handles are also kept per thread as rasterio datasets are not thread-safe.
+    Everything still open is closed when the process exits, including
+    multiprocessing children which do not run atexit hooks.
+
+    :param max_open: maximum number of datasets kept open per thread.
+    :param gdal_cachemax: size of the GDAL block cache in MB for each process
+        using the cache, None to keep the GDAL default.
+    """
+
+    def __init__(self, max_open=64, gdal_cachemax=None):
+
+        self.max_open = max_open
+        self.gdal_cachemax = gdal_cachemax
+        self._reset()
+
+    def _reset(self):
+
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._all_handles = []
+        self._env = None
+        self._finalizer = None
+
+    def _process_init(self):
+
+        # Called once in each process using the cache, after a fork if any
+        if self.gdal_cachemax is not None:
+            self._env = rasterio.Env(GDAL_CACHEMAX=int(self.gdal_cachemax))
+            self._env.__enter__()
+        self._finalizer = Finalize(self, self.close, exitpriority=10)
+
+    def _handles(self):
+
+        if os.getpid() != self._pid:
+            # Inherited handles are dropped without being closed: the parent
+            # still owns them.
+            self._reset()
+        with self._lock:
+            if self._finalizer is None:
+                self._process_init()
+            handles = getattr(self._local, 'handles', None)
+            if handles is None:
+                handles = OrderedDict()
+                self._local.handles = handles
+                self._all_handles.append(handles)
+
+        return handles
+
+    def open(self, path):
+
+        handles = self._handles()
+        key = str(path)
+        if key in handles:
+            handles.move_to_end(key)
+            return handles[key]
+
+        handle = rasterio.open(key)
+        handles[key] = handle
+        while len(handles) > self.max_open:
+            _, old = handles.popitem(last=False)
+            old.close()
+
+        return handle
+
+    def close(self):
+
+        if os.getpid() != self._pid:
+            return
+        with self._lock:
+            for handles in self._all_handles:
+                for handle in handles.values():
+                    handle.close()
+                handles.clear()
+            if self._env is not None:
+                self._env.__exit__()
+                self._env = None
+
+    def __getstate__(self):
+
+        # Open datasets cannot be pickled (spawned workers): only the
+        # configuration is sent.
+        return {'max_open': self.max_open, 'gdal_cachemax': self.gdal_cachemax}
+
+    def __setstate__(self, state):
+
+        self.__dict__.update(state)
+        self._reset()
+
+
+# Default cache shared by all datasets in a process
+handle_cache = RasterHandleCache()
+
+def open_raster(path):
+
+    return handle_cache.open(path)
@@ -0,0 +1,209 @@
+import os
+import json
+import threading
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import rasterio
+from rasterio.windows import Window
+
+
+BandStats = namedtuple('BandStats', ['min', 'max', 'mean', 'std'])
+
+stats_modes = ('approx', 'exact', 'percentile')
+
+# Approximate and percentile statistics are computed on a decimated read whose
+# longest side is at most this many pixels (GDAL uses overviews when present)
+APPROX_SIZE = 1024
+
+def default_store_path():
+
+    return Path(os.environ.get(
+        'DL_TOOLBOX_STATS',
+        Path.home() / '.cache' / 'dl_toolbox' / 'band_stats.json'
+    ))
+
+def file_key(image_path):
+
+    st = os.stat(image_path)
+    return f'{os.path.abspath(image_path)}|{st.st_size}|{st.st_mtime_ns}'
+
+def band_key(band, window, mode):
+
+    window = None if window is None else tuple(int(v) for v in window_tuple(window))
+    return f'{mode}|{window}|{band}'
+
+def window_tuple(window):
+
+    if isinstance(window, Window):
+        return (window.col_off, window.row_off, window.width, window.height)
+    return tuple(window)
+
+def _array_stats(values, mode, percentiles):
+
+    values = values.compressed() if np.ma.isMaskedArray(values) else values.ravel()
+    values = values.astype(np.float64)
+    if values.size == 0:
+        return BandStats(0., 0., 0., 0.)
+    if mode == 'percentile':
+        low, high = np.percentile(values, percentiles)
+    else:
+        low, high = values.min(), values.max()
+
+    return BandStats(float(low), float(high), float(values.mean()), float(values.std()))
+
+def compute_band_stats(image_path, window=None, mode='approx', percentiles=(2, 98)):
+    """
+    Returns the per-band statistics of the raster, or of the given window of
+    the raster, along with its band count and shape.
+    mode 'approx' and 'exact' give the min and max of the band, 'percentile'
+    gives the low and high percentiles instead, on a decimated read.
+    """
+    if mode not in stats_modes:
+        raise ValueError(f'Unknown stats mode {mode}, expected one of {stats_modes}')
+
+    with rasterio.open(image_path) as f:
+        infos = {'count': f.count, 'shape': list(f.shape), 'stats': []}
+        if window is None and mode != 'percentile':
+            for i in range(1, f.count+1):
+                s = f.statistics(bidx=i, approx=(mode == 'approx'))
+                infos['stats'].append(BandStats(s.min, s.max, s.mean, s.std))
+            return infos
+
+        if window is None:
+            window = Window(0, 0, f.width, f.height)
+        else:
+            window = Window(*window_tuple(window))
+        out_shape = None
+        if mode != 'exact':
+            scale = max(1., max(window.width, window.height) / APPROX_SIZE)
+            out_shape = (int(window.height / scale), int(window.width / scale))
+        for i in range(1, f.count+1):
+            values = f.read(i, window=window, out_shape=out_shape, masked=True)
+            infos['stats'].append(_array_stats(values, mode, percentiles))
+
+    return infos
+
+def _compute_request(request):
+
+    image_path, window, mode, percentiles = request
+    return compute_band_stats(image_path, window, mode, percentiles)
+
+
+class BandStatsStore:
+    """
+    Central store of per-band raster statistics, persisted as a JSON file.
+
+    Entries are keyed by the path, size and modification time of the raster,
+    so that a modified file gets new statistics, and then by stats mode,
+    window and band. Missing entries can be computed in parallel with fill
+    before building datasets, which then only read the store.
+    """
+
+    def __init__(self, path=None, percentiles=(2, 98)):
+
+        self.path = Path(path) if path else default_store_path()
+        self.percentiles = tuple(percentiles)
+        self._lock = threading.Lock()
+        self._entries = None
+
+    @property
+    def entries(self):
+
+        if self._entries is None:
+            self._entries = self._load()
+        return self._entries
+
+    def _load(self):
+
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def save(self):
+
+        with self._lock:
+            # Entries written meanwhile by other processes are kept
+            entries = self._load()
+            for key, entry in self.entries.items():
+                entries.setdefault(key, {'count': entry['count'], 'shape': entry['shape'], 'bands': {}})
+                entries[key]['bands'].update(entry['bands'])
+            self._entries = entries
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = self.path.with_name(f'{self.path.name}.{os.getpid()}.tmp')
+            with open(tmp_path, 'w') as f:
+                json.dump(entries, f)
+            os.replace(tmp_path, self.path)
+
+    def get(self, image_path, window=None, mode='approx'):
+
+        entry = self.entries.get(file_key(image_path))
+        if entry is None:
+            return None
+        keys = [band_key(i, window, mode) for i in range(1, entry['count']+1)]
+        if any(k not in entry['bands'] for k in keys):
+            return None
+
+        return {
+            'count': entry['count'],
+            'shape': tuple(entry['shape']),
+            'stats': [BandStats(*entry['bands'][k]) for k in keys]
+        }
+
+    def put(self, image_path, window, mode, infos):
+
+        entry = self.entries.setdefault(
+            file_key(image_path),
+            {'count': infos['count'], 'shape': list(infos['shape']), 'bands': {}}
+        )
+        for i, stats in enumerate(infos['stats'], 1):
+            entry['bands'][band_key(i, window, mode)] = list(stats)
+
+    def fill(self, requests, workers=0):
+        """
+        Computes and saves the statistics of all (image_path, window, mode)
+        requests not yet in the store, with a pool of workers processes.
+        """
+        missing, missing_set = [], set()
+        for image_path, window, mode in requests:
+            request = (str(image_path), None if window is None else window_tuple(window), mode)
+            if request not in missing_set and self.get(*request) is None:
+                missing.append(request)
+                missing_set.add(request)
+        if not missing:
+            return
+
+        requests = [(*request, self.percentiles) for request in missing]
+        if workers > 1 and len(requests) > 1:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                results = list(pool.map(_compute_request, requests))
+        else:
+            results = [_compute_request(request) for request in requests]
+
+        for request, infos in zip(missing, results):
+            self.put(*request, infos)
+        self.save()
+
+    def stats(self, image_path, window=None, mode='approx'):
+
+        infos = self.get(image_path, window, mode)
+        if infos is None:
+            self.fill([(image_path, window, mode)])
+            infos = self.get(image_path, window, mode)
+
+        return infos
+
+
+_stores = {}
+
+def get_stats_store(path=None):
+
+    path = Path(path) if path else default_store_path()
+    if path not in _stores:
+        _stores[path] = BandStatsStore(path)
+
+    return _stores[path]
@@ -0,0 +1,149 @@
+import numpy as np
+import rasterio
+from rasterio.enums import Resampling
+from rasterio.windows import Window
+
+from .raster_cache import handle_cache as default_handle_cache
+
+
+class RasterIndex:
+    """
+    Footprints of a set of north-up rasters in the same CRS, sorted by their
+    left bound, so that geographic bounds resolve to the rasters they
+    intersect and to pixel windows in each of them with a few numpy
+    operations, and can be read as one array across raster boundaries.
+
+    Where rasters overlap, the first one in paths wins; nodata pixels of a
+    raster do not overwrite the others.
+
+    :param paths: raster files, opened once here to read their metadata.
+    :param handle_cache: RasterHandleCache used for reads.
+    """
+
+    def __init__(self, paths, handle_cache=None):
+
+        self.paths = [str(path) for path in dict.fromkeys(str(p) for p in paths)]
+        self.handle_cache = handle_cache if handle_cache is not None else default_handle_cache
+        self.positions = {path: i for i, path in enumerate(self.paths)}
+        crs, transforms, bounds = None, [], []
+        self.nodata, self.count, self.dtypes = [], [], []
+
+        for path in self.paths:
+            with rasterio.open(path) as f:
+                if crs is None:
+                    crs = f.crs
+                elif f.crs != crs:
+                    raise ValueError(f'{path} is not in the CRS {crs} of the other rasters')
+                if f.transform.b != 0 or f.transform.d != 0:
+                    raise ValueError(f'{path} is not north-up')
+                transforms.append(tuple(f.transform)[:6])
+                bounds.append(tuple(f.bounds))
+                self.nodata.append(f.nodata)
+                self.count.append(f.count)
+                self.dtypes.append(f.dtypes[0])
+
+        self.crs = crs
+        # (a, b, c, d, e, f) of each transform: x = a * col + c, y = e * row + f
+        self.transforms = np.array(transforms, dtype=np.float64).reshape(-1, 6)
+        self.bounds = np.array(bounds, dtype=np.float64).reshape(-1, 4)
+        self.order = np.argsort(self.bounds[:, 0], kind='stable')
+        self.sorted_lefts = self.bounds[self.order, 0]
+
+    def __len__(self):
+
+        return len(self.paths)
+
+    def window_bounds(self, path, window):
+        """
+        Geographic (left, bottom, right, top) bounds of a pixel window of one
+        of the indexed rasters.
+        """
+        a, _, c, _, e, f = self.transforms[self.positions[str(path)]]
+        col_off, row_off, width, height = window.flatten()
+
+        return (
+            c + a * col_off,
+            f + e * (row_off + height),
+            c + a * (col_off + width),
+            f + e * row_off
+        )
+
+    def query(self, bounds):
+        """
+        Positions in paths, in increasing order, of the rasters whose
+        footprint intersects (left, bottom, right, top) bounds.
+        """
+        left, bottom, right, top = bounds
+        candidates = self.order[:np.searchsorted(self.sorted_lefts, right, side='left')]
+        b = self.bounds[candidates]
+        hits = candidates[(b[:, 2] > left) & (b[:, 1] < top) & (b[:, 3] > bottom)]
+
+        return np.sort(hits)
+
+    def windows(self, bounds, out_shape):
+        """
+        For each raster intersecting bounds, its path, the window to read in
+        it and the window of the (height, width) output grid it covers.
+        """
+        left, bottom, right, top = bounds
+        height, width = out_shape
+        res_x, res_y = (right - left) / width, (top - bottom) / height
+        for i in self.query(bounds):
+            l, b, r, t = self.bounds[i]
+            l, b, r, t = max(l, left), max(b, bottom), min(r, right), min(t, top)
+            c0, c1 = int(round((l - left) / res_x)), int(round((r - left) / res_x))
+            r0, r1 = int(round((top - t) / res_y)), int(round((top - b) / res_y))
+            if c1 <= c0 or r1 <= r0:
+                continue
+            a, _, c, _, e, f = self.transforms[i]
+            src_window = Window(
+                (l - c) / a,
+                (t - f) / e,
+                (r - l) / a,
+                (b - t) / e
+            )
+            yield self.paths[i], src_window, Window(c0, r0, c1 - c0, r1 - r0)
+
+    def read(
+        self,
+        bounds,
+        out_shape,
+        indexes=None,
+        out_dtype=None,
+        resampling=Resampling.nearest,
+        fill_value=0
+    ):
+        """
+        Reads the (left, bottom, right, top) bounds from all the rasters they
+        intersect into an array of out_shape (height, width) pixels, with the
+        bands indexes (1-based, None for all); uncovered pixels are set to
+        fill_value.
+        """
+        out = None
+        # Reversed so that the first rasters are pasted last and win
+        for path, src_window, dst_window in reversed(list(self.windows(bounds, out_shape))):
+            f = self.handle_cache.open(path)
+            nodata = self.nodata[self.positions[path]]
+            dst_shape = (int(dst_window.height), int(dst_window.width))
+            data = f.read(
+                indexes=indexes,
+                window=src_window,
+                out_shape=((len(indexes),) if indexes else (f.count,)) + dst_shape,
+                out_dtype=out_dtype,
+                resampling=resampling,
+                masked=nodata is not None
+            )
+            if out is None:
+                out = np.full((data.shape[0], *out_shape), fill_value, dtype=data.dtype)
+            dst = out[:, dst_window.row_off:dst_window.row_off + dst_shape[0],
+                      dst_window.col_off:dst_window.col_off + dst_shape[1]]
+            if nodata is None:
+                dst[...] = data
+            else:
+                np.copyto(dst, data.data, where=~np.ma.getmaskarray(data))
+
+        if out is None:
+            count = len(indexes) if indexes else self.count[0]
+            out = np.full((count, *out_shape), fill_value, dtype=out_dtype or self.dtypes[0])
+
+        return out
@@ -1,31 +1,41 @@
-from itertools import product
 from rasterio.windows import Window
 import numpy as np
 
-def get_tiles(nols, nrows, size, size2=None, step=None, step2=None, col_offset=0, row_offset=0):
-    
+def get_tiles_array(nols, nrows, size, size2=None, step=None, step2=None, col_offset=0, row_offset=0):
+    """
+    Windows of get_tiles, in the same order, as a (N, 4) int32 array of
+    (col_off, row_off, width, height).
+    """
     if step is None: step = size
     if size2 is None: size2 = size
     if step2 is None: step2 = step
 
-    max_col_offset = int(np.ceil((nols-size)/step))
-    # Remove all offsets such that offset+size > nols and add one offset to
-    # reach nols
-    col_offsets = list(range(col_offset, col_offset + nols, step))[:max_col_offset+1]
-    col_offsets[max_col_offset] = col_offset + nols - size
-
-    max_row_offset = int(np.ceil((nrows-size2)/step2))
-    # Remove all offsets such that offset+size > nols and add one offset to
-    # reach nols
-    row_offsets = list(range(row_offset, row_offset + nrows, step2))[:max_row_offset+1]
-    row_offsets[max_row_offset] = row_offset + nrows - size2
-
-    offsets = product(col_offsets, row_offsets)
-    big_window = Window(col_off=col_offset, row_off=row_offset, width=nols, height=nrows)
-    for col_off, row_off in offsets:
-        window = Window(col_off=col_off, row_off=row_off, width=size,
-                        height=size2).intersection(big_window)
-        yield window
+    def offsets(length, size, step, offset):
+        # Offsets such that offset+size <= length, plus one offset to reach
+        # length, clipped to the tile when size exceeds length
+        num = int(np.ceil((length-size)/step)) + 1 if length > size else 1
+        starts = np.arange(num, dtype=np.int64) * step
+        starts[-1] = length - size
+        starts = np.maximum(starts, 0)
+        return offset + starts, np.minimum(size, length - starts)
+
+    col_offsets, widths = offsets(nols, size, step, col_offset)
+    row_offsets, heights = offsets(nrows, size2, step2, row_offset)
+
+    tiles = np.empty((len(col_offsets), len(row_offsets), 4), dtype=np.int32)
+    tiles[..., 0] = col_offsets[:, None]
+    tiles[..., 1] = row_offsets[None, :]
+    tiles[..., 2] = widths[:, None]
+    tiles[..., 3] = heights[None, :]
+
+    return tiles.reshape(-1, 4)
+
+def get_tiles(nols, nrows, size, size2=None, step=None, step2=None, col_offset=0, row_offset=0):
+    
+    for col_off, row_off, width, height in get_tiles_array(
+        nols, nrows, size, size2, step, step2, col_offset, row_offset
+    ).tolist():
+        yield Window(col_off=col_off, row_off=row_off, width=width, height=height)
 
 def main():
 
@@ -0,0 +1,147 @@
+import os
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import rasterio
+from rasterio.windows import Window
+
+from .raster_stats import file_key
+
+
+def default_mask_dir():
+
+    return Path(os.environ.get(
+        'DL_TOOLBOX_VALID_MASK',
+        Path.home() / '.cache' / 'dl_toolbox' / 'valid_mask'
+    ))
+
+def valid_counts_path(path, cell_size, mask_dir=None):
+
+    key = f'{file_key(path)}|{cell_size}'
+    name = hashlib.sha1(key.encode()).hexdigest()
+
+    return Path(mask_dir if mask_dir else default_mask_dir()) / f'{name}.npy'
+
+def compute_valid_counts(path, cell_size):
+    """
+    Counts the valid pixels of a raster in each cell of a cell_size grid,
+    from its GDAL dataset mask, which comes from the nodata value, the alpha
+    band or an internal mask. Reads one row of cells at a time. Returns a
+    (rows, cols) int32 array; edge cells may be smaller.
+    """
+    with rasterio.open(path) as f:
+        width, height = f.width, f.height
+        nrows = -(-height // cell_size)
+        col_starts = np.arange(0, width, cell_size)
+        counts = np.zeros((nrows, len(col_starts)), dtype=np.int32)
+        for r in range(nrows):
+            window = Window(0, r * cell_size, width, min(cell_size, height - r * cell_size))
+            valid = (f.dataset_mask(window=window) > 0).sum(axis=0, dtype=np.int32)
+            counts[r] = np.add.reduceat(valid, col_starts)
+
+    return counts
+
+def _compute_and_save(args):
+
+    path, cell_size, counts_path = args
+    counts = compute_valid_counts(path, cell_size)
+    counts_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = counts_path.with_name(f'{counts_path.name}.{os.getpid()}.tmp.npy')
+    np.save(tmp_path, counts)
+    os.replace(tmp_path, counts_path)
+
+    return counts
+
+
+class ValidMask:
+    """
+    Valid pixel counts of a raster in a grid of cells, with their summed-area
+    table: the number of valid pixels in any window is read from four
+    bilinear interpolations of the table, exact for counts spread evenly in
+    each cell, for arrays of windows at once. Pixels outside the raster are
+    invalid.
+
+    :param counts: (rows, cols) valid pixel counts (compute_valid_counts).
+    """
+
+    def __init__(self, counts, cell_size, width, height):
+
+        self.cell_size = cell_size
+        self.width = width
+        self.height = height
+        self.table = np.zeros((counts.shape[0] + 1, counts.shape[1] + 1), dtype=np.float64)
+        self.table[1:, 1:] = counts.cumsum(axis=0).cumsum(axis=1)
+
+    def _grid_coords(self, x, length):
+
+        # Pixel coordinates to fractional cell coordinates, the last cell
+        # being possibly smaller
+        x = np.clip(x, 0, length).astype(np.float64)
+        last = (-(-length // self.cell_size) - 1) * self.cell_size
+        last_size = length - last
+
+        return np.where(x < last, x / self.cell_size, last / self.cell_size + (x - last) / last_size)
+
+    def _integral(self, u, v):
+
+        # Summed-area table at fractional cell coordinates (u cols, v rows)
+        c0 = np.minimum(np.floor(u).astype(int), self.table.shape[1] - 2)
+        r0 = np.minimum(np.floor(v).astype(int), self.table.shape[0] - 2)
+        du, dv = u - c0, v - r0
+        t = self.table
+
+        return (
+            t[r0, c0] * (1 - du) * (1 - dv) + t[r0, c0 + 1] * du * (1 - dv)
+            + t[r0 + 1, c0] * (1 - du) * dv + t[r0 + 1, c0 + 1] * du * dv
+        )
+
+    def fractions(self, windows):
+        """
+        Valid fraction of each window of a (N, 4) array of (col_off,
+        row_off, width, height).
+        """
+        windows = np.asarray(windows, dtype=np.int64).reshape(-1, 4)
+        col, row, width, height = windows.T
+        u0, u1 = self._grid_coords(col, self.width), self._grid_coords(col + width, self.width)
+        v0, v1 = self._grid_coords(row, self.height), self._grid_coords(row + height, self.height)
+        valid = (
+            self._integral(u1, v1) - self._integral(u0, v1)
+            - self._integral(u1, v0) + self._integral(u0, v0)
+        )
+
+        return np.clip(valid / np.maximum(width * height, 1), 0., 1.)
+
+    def fraction(self, window):
+
+        return float(self.fractions([[
+            int(window.col_off), int(window.row_off), int(window.width), int(window.height)
+        ]])[0])
+
+def load_valid_masks(paths, cell_size=32, workers=0, mask_dir=None):
+    """
+    Returns a ValidMask per raster path, computing the valid counts missing
+    from the mask directory with a pool of workers processes and caching them.
+    """
+    paths = list(dict.fromkeys(str(path) for path in paths))
+    counts_paths = [valid_counts_path(path, cell_size, mask_dir) for path in paths]
+    counts = [np.load(p) if p.exists() else None for p in counts_paths]
+    missing = [
+        (path, cell_size, p) for path, p, c in zip(paths, counts_paths, counts) if c is None
+    ]
+
+    if workers > 1 and len(missing) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            computed = list(pool.map(_compute_and_save, missing))
+    else:
+        computed = [_compute_and_save(args) for args in missing]
+
+    computed = iter(computed)
+    masks = {}
+    for path, c in zip(paths, counts):
+        c = c if c is not None else next(computed)
+        with rasterio.open(path) as f:
+            masks[path] = ValidMask(c, cell_size, f.width, f.height)
+
+    return masks